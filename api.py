@@ -3,15 +3,44 @@ Flask API для логирования согласий с документам
 Минимальная версия - только логирование, без платежей
 """
 
+import time
+
+# Начало загрузки приложения (метрика consent_api_boot_seconds, /ready)
+BOOT_STARTED = time.perf_counter()
+
 import os
-import hashlib
+import atexit
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, g, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
+from collections import Counter
+
+from psycopg_pool import PoolTimeout
 
 from database_tickets import TicketDatabase
+from consent_queue import ConsentWriteQueue, ConsentQueueFull, CONSENT_WRITE_MODE
+from document_cache import DocumentCache
+from json_codec import configure_json
+from consent_dedup import RecentConsentIds, skip_recent_duplicates, mark_saved_consents
+from rate_limit import create_rate_limiter, retry_after_header
+from consent_export import parse_export_params, iter_consent_export, export_content_type, export_filename
+from consent_stats import parse_stats_params, get_consent_stats
+from consent_search import parse_search_params, search_consents
+from user_agents import classifier as user_agent_classifier
+from migrations import build_readiness_status
+from metrics import (
+    observe_boot, observe_request, observe_request_phase, record_error, record_consent_duplicates, route_label,
+    is_metrics_request_allowed, render_metrics
+)
+from consent_common import (
+    is_admin_request, get_trusted_client_ip, validate_consent_data, check_consent_document, build_consent_log,
+    prepare_consent_batch, consent_batch_status, build_consent_status,
+    is_valid_session_id, prepare_bulk_verify, validate_idempotency_key,
+    validate_snapshot_data, build_document_snapshot, active_document_summary,
+    ALLOWED_DOCUMENT_TYPES, DEFAULT_DOCUMENT_LANGUAGE, DOCUMENT_CHECK_MODE
+)
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -23,8 +52,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+class TimedRequest(Request):
+    """Запрос с замером разбора JSON тела (метрика json_parse); text/plain разбирается как JSON"""
+
+    def get_json(self, *args, **kwargs):
+        # navigator.sendBeacon (tilda-consent-logger.js) шлёт JSON как
+        # text/plain: такой запрос обходится без CORS preflight
+        if self.mimetype == 'text/plain':
+            kwargs['force'] = True
+        started = time.perf_counter()
+        try:
+            return super().get_json(*args, **kwargs)
+        finally:
+            observe_request_phase(route_label(self), 'json_parse', started)
+
+
 # Инициализация Flask
 app = Flask(__name__)
+app.request_class = TimedRequest
+configure_json(app)
 
 # CORS - разрешаем запросы только с вашего домена Tilda
 # После тестирования замените '*' на ваш домен: 'https://your-site.tilda.ws'
@@ -32,37 +79,105 @@ CORS(app, resources={
     r"/api/*": {
         "origins": os.getenv("ALLOWED_ORIGINS", "*").split(","),
         "methods": ["POST", "GET", "OPTIONS"],
-        "allow_headers": ["Content-Type"]
+        "allow_headers": ["Content-Type", "Idempotency-Key"]
     }
 })
 
-# Инициализация БД
+# Инициализация БД: пул открывается при первом запросе, схему
+# создаёт python migrations.py при деплое, а не каждый воркер
 db = TicketDatabase()
 
-# Константы
-ALLOWED_DOCUMENT_TYPES = ['ticket_terms', 'refund_policy', 'privacy_policy']
-DOCUMENT_VERSION = os.getenv("DOCUMENT_VERSION", "v2025-10-28")
+# Кеш активных версий документов (загружается при первом обращении,
+# инвалидация между воркерами через NOTIFY)
+document_cache = DocumentCache(db)
+if db.database_url:
+    document_cache.start_listener(db.database_url)
 
+# Недавно сохранённые ID согласий - повторы отсекаются без запроса к БД
+recent_consent_ids = RecentConsentIds()
 
-def get_client_ip(request_obj):
-    """Получить реальный IP клиента (с учётом прокси)"""
-    # Render передаёт реальный IP в X-Forwarded-For
-    forwarded_for = request_obj.headers.get('X-Forwarded-For')
-    if forwarded_for:
-        # Берём первый IP из цепочки (клиентский)
-        return forwarded_for.split(',')[0].strip()
-    return request_obj.remote_addr
+# Лимиты запросов на IP и session_id (проверяются до работы с БД)
+rate_limiter = create_rate_limiter()
+# Публичные endpoints, которые обращаются к БД
+RATE_LIMITED_ENDPOINTS = {'log_consent', 'log_consent_batch', 'verify_consents', 'verify_consents_bulk'}
 
+# Очередь отложенной записи согласий (CONSENT_WRITE_MODE=write_behind)
+consent_queue = None
+if CONSENT_WRITE_MODE == 'write_behind':
+    consent_queue = ConsentWriteQueue(db)
+    consent_queue.start()
+    atexit.register(consent_queue.stop)
 
-def get_ip_country(ip_address):
-    """
-    Получить страну по IP (заглушка)
-    TODO: Интегрировать с сервисом геолокации (MaxMind, ip-api.com)
-    """
-    # Пока возвращаем None, можно добавить позже
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def limit_client_ip_rate():
+    if request.method == 'OPTIONS' or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    retry_after = rate_limiter.check_ip(get_trusted_client_ip(request))
+    if retry_after is not None:
+        return rate_limited_response(retry_after, 'ip')
     return None
 
 
+@app.after_request
+def observe_request_duration(response):
+    # Для потоковых ответов (выгрузка) - время до начала отдачи тела
+    started = g.pop('request_started', None)
+    if started is not None:
+        observe_request(request.method, route_label(request), response.status_code, started)
+    return response
+
+
+def db_unavailable_response():
+    """Ответ, когда в пуле нет свободных соединений с БД"""
+    record_error(route_label(request), 'PoolTimeout')
+    return jsonify({
+        'error': 'Service temporarily unavailable',
+        'message': 'Database connection pool exhausted, retry later'
+    }), 503, {'Retry-After': '1'}
+
+
+def queue_full_response():
+    """Ответ, когда очередь отложенной записи переполнена"""
+    record_error(route_label(request), 'ConsentQueueFull')
+    return jsonify({
+        'error': 'Service temporarily unavailable',
+        'message': 'Consent queue is full, retry later'
+    }), 503, {'Retry-After': '1'}
+
+
+def rate_limited_response(retry_after, scope):
+    """Ответ, когда исчерпан лимит запросов на IP или session_id"""
+    record_error(route_label(request), 'RateLimited')
+    return jsonify({
+        'error': 'Too many requests',
+        'message': f'Rate limit per {scope} exceeded, retry later'
+    }), 429, {'Retry-After': retry_after_header(retry_after)}
+
+
+def consent_duplicate_response(consent_log_id, source):
+    """Ответ на повтор уже сохранённого согласия (тот же consent_log_id)"""
+    record_consent_duplicates(source)
+    return jsonify({
+        'success': True,
+        'consent_log_id': consent_log_id,
+        'duplicate': True,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+
+def internal_error_response(e):
+    record_error(route_label(request), type(e).__name__)
+    return jsonify({
+        'error': 'Internal server error',
+        'message': str(e)
+    }), 500
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверка здоровья сервиса"""
@@ -73,6 +188,27 @@ def health_check():
     }), 200
 
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    Готовность воркера принимать запросы (в отличие от /health - с БД)
+    
+    503, если БД недоступна или не применены миграции схемы
+    (python migrations.py). Подходит для Health Check Path на Render.
+    """
+    try:
+        status, status_code = build_readiness_status(db.get_applied_migrations(), BOOT_SECONDS)
+        return jsonify(status), status_code
+    
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {e}")
+        return jsonify({
+            'status': 'not_ready',
+            'error': 'Database unavailable',
+            'message': str(e)
+        }), 503
+
+
 @app.route('/api/consent', methods=['POST', 'OPTIONS'])
 def log_consent():
     """
@@ -88,59 +224,66 @@ def log_consent():
         "consent_timestamp": "2025-10-28T12:34:56.789Z",
         "user_agent": "Mozilla/5.0...",
         "referrer": "https://...",
-        "page_url": "https://..."
+        "page_url": "https://...",
+        "idempotency_key": "..."            (необязательно, или заголовок Idempotency-Key)
     }
+    
+    Повтор того же согласия (ретрай, двойной клик) не создаёт новую
+    запись: ответ 200 с "duplicate": true и тем же consent_log_id.
+    Без ключа идемпотентности повтором считается согласие с теми же
+    session_id, document_type, document_hash и consent_timestamp.
     """
     # OPTIONS для CORS preflight
     if request.method == 'OPTIONS':
         return '', 204
     
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
-        # Валидация обязательных полей
-        required_fields = [
-            'session_id', 'document_type', 'document_version',
-            'document_hash', 'consent_given', 'consent_timestamp'
-        ]
+        validation_error = validate_consent_data(data)
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not validation_error and idempotency_key is not None:
+            validation_error = validate_idempotency_key(idempotency_key)
+        if validation_error:
+            return jsonify(validation_error), 400
         
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            return jsonify({
-                'error': 'Missing required fields',
-                'missing': missing_fields
-            }), 400
+        retry_after = rate_limiter.check_sessions({data['session_id']: 1})
+        if retry_after is not None:
+            return rate_limited_response(retry_after, 'session')
         
-        # Валидация типа документа
-        if data['document_type'] not in ALLOWED_DOCUMENT_TYPES:
-            return jsonify({
-                'error': 'Invalid document_type',
-                'allowed': ALLOWED_DOCUMENT_TYPES
-            }), 400
+        # Сверка версии и хеша с активным документом (из кеша, без запросов к БД)
+        if DOCUMENT_CHECK_MODE != 'off':
+            document_error = check_consent_document(data, document_cache.find(
+                data['document_type'], data.get('language', DEFAULT_DOCUMENT_LANGUAGE)
+            ))
+            if document_error:
+                return jsonify(document_error), 409
         
-        # Получаем технические данные
-        client_ip = get_client_ip(request)
-        client_ip_forwarded = request.headers.get('X-Forwarded-For')
-        ip_country = get_ip_country(client_ip)
-        
-        # Сохраняем в БД
-        consent_log = {
-            'session_id': data['session_id'],
-            'document_type': data['document_type'],
-            'document_version': data['document_version'],
-            'document_hash': data['document_hash'],
-            'consent_given': data['consent_given'],
-            'consent_timestamp': data['consent_timestamp'],
-            'consent_text': data.get('consent_text', f"Я согласен с {data['document_type']}"),
-            'client_ip': client_ip,
-            'client_ip_forwarded': client_ip_forwarded,
-            'user_agent': data.get('user_agent', request.headers.get('User-Agent')),
-            'ip_country': ip_country,
-            'referrer_url': data.get('referrer'),
-            'page_url': data.get('page_url')
-        }
+        consent_log = build_consent_log(data, request, idempotency_key)
+        consent_log_id = consent_log['consent_log_id']
         
-        consent_log_id = db.create_consent_log(consent_log)
+        if consent_log_id in recent_consent_ids:
+            return consent_duplicate_response(consent_log_id, 'memory')
+        
+        if consent_queue:
+            # Запись уже надёжно сохранена в spool, в БД попадёт фоном
+            # (повтор, не замеченный здесь, отбросит INSERT ... ON CONFLICT)
+            consent_queue.enqueue(consent_log)
+            recent_consent_ids.add(consent_log_id)
+            
+            logger.info(f"Consent queued: {consent_log_id} - {data['document_type']} - session: {data['session_id']}")
+            
+            return jsonify({
+                'success': True,
+                'consent_log_id': consent_log_id,
+                'queued': True,
+                'timestamp': datetime.utcnow().isoformat()
+            }), 202
+        
+        created = db.create_consent_log(consent_log) is not None
+        recent_consent_ids.add(consent_log_id)
+        if not created:
+            return consent_duplicate_response(consent_log_id, 'database')
         
         logger.info(f"Consent logged: {consent_log_id} - {data['document_type']} - session: {data['session_id']}")
         
@@ -150,12 +293,105 @@ def log_consent():
             'timestamp': datetime.utcnow().isoformat()
         }), 201
     
+    except ConsentQueueFull:
+        logger.warning("Consent queue is full, rejecting consent")
+        return queue_full_response()
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while logging consent")
+        return db_unavailable_response()
+    
     except Exception as e:
         logger.error(f"Error logging consent: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/consent/batch', methods=['POST', 'OPTIONS'])
+def log_consent_batch():
+    """
+    Логирование нескольких согласий одним запросом
+    
+    Все корректные записи сохраняются одним INSERT в одной транзакции.
+    Некорректные записи пропускаются, ошибка возвращается для каждой из них.
+    Повторы согласий (как в /api/consent, ключ - поле idempotency_key
+    элемента) не сохраняются второй раз и возвращают прежний consent_log_id.
+    
+    Ожидаемый JSON:
+    {
+        "consents": [
+            {...как в /api/consent...},
+            ...
+        ]
+    }
+    
+    Ответ:
+    {
+        "success": true/false,
+        "results": [
+            {"index": 0, "consent_log_id": "uuid"},
+            {"index": 1, "consent_log_id": "uuid", "duplicate": true},
+            {"index": 2, "error": "Missing required fields", "missing": [...]}
+        ],
+        "timestamp": "..."
+    }
+    """
+    # OPTIONS для CORS preflight
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    try:
+        data = request.get_json(silent=True)
+        
+        request_error, results, valid_indexes, consent_logs = prepare_consent_batch(
+            data, request, get_active_document=document_cache.find if DOCUMENT_CHECK_MODE != 'off' else None
+        )
+        if request_error:
+            return jsonify(request_error), 400
+        
+        retry_after = rate_limiter.check_sessions(Counter(c['session_id'] for c in consent_logs))
+        if retry_after is not None:
+            return rate_limited_response(retry_after, 'session')
+        
+        new_indexes, new_consent_logs = skip_recent_duplicates(
+            recent_consent_ids, results, valid_indexes, consent_logs
+        )
+        record_consent_duplicates('memory', len(consent_logs) - len(new_consent_logs))
+        
+        created_ids = None
+        if new_consent_logs and consent_queue:
+            consent_queue.enqueue_many(new_consent_logs)
+        elif new_consent_logs:
+            created_ids = db.create_consent_logs(new_consent_logs)
+        
+        record_consent_duplicates(
+            'database', mark_saved_consents(results, new_indexes, new_consent_logs, created_ids)
+        )
+        recent_consent_ids.add_many([c['consent_log_id'] for c in new_consent_logs])
+        
+        logger.info(
+            f"Consent batch logged: {len(new_consent_logs)} of {len(results)} "
+            f"- session: {consent_logs[0]['session_id'] if consent_logs else None}"
+        )
+        
+        status = consent_batch_status(len(valid_indexes), len(results), queued=bool(consent_queue))
+        
         return jsonify({
-            'error': 'Internal server error',
-            'message': str(e)
-        }), 500
+            'success': len(valid_indexes) == len(results),
+            'results': results,
+            'timestamp': datetime.utcnow().isoformat()
+        }), status
+    
+    except ConsentQueueFull:
+        logger.warning("Consent queue is full, rejecting consent batch")
+        return queue_full_response()
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while logging consent batch")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error logging consent batch: {str(e)}", exc_info=True)
+        return internal_error_response(e)
 
 
 @app.route('/api/consent/verify/<session_id>', methods=['GET'])
@@ -175,34 +411,72 @@ def verify_consents(session_id):
     }
     """
     try:
-        consents = db.get_consents_by_session(session_id)
+        if not is_valid_session_id(session_id):
+            return jsonify({'error': 'Invalid session_id, UUID expected'}), 400
         
-        # Проверяем наличие всех трёх согласий
-        consent_status = {
-            'ticket_terms': False,
-            'refund_policy': False,
-            'privacy_policy': False
-        }
+        # Сводный статус сессии - один lookup по первичному ключу
+        status = db.get_session_consent_status(session_id)
         
-        for consent in consents:
-            if consent['consent_given']:
-                consent_status[consent['document_type']] = True
+        return jsonify(build_consent_status(session_id, status)), 200
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while verifying consents")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error verifying consents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/consent/verify', methods=['POST'])
+def verify_consents_bulk():
+    """
+    Проверить согласия для многих сессий одним запросом (для сверок, требует API ключ)
+    
+    Ожидаемый JSON:
+    {
+        "session_ids": ["uuid", "uuid", ...]
+    }
+    
+    Возвращает:
+    {
+        "results": {
+            "uuid": {"all_consents_given": true/false, "consents": {...}, "total_logged": 3},
+            ...
+        },
+        "invalid": ["not-a-uuid"]
+    }
+    """
+    try:
+        if not is_admin_request(request):
+            return jsonify({'error': 'Unauthorized'}), 401
+        
+        data = request.get_json(silent=True)
+        
+        request_error, session_ids, invalid = prepare_bulk_verify(data)
+        if request_error:
+            return jsonify(request_error), 400
+        
+        statuses = db.get_session_consent_statuses(session_ids) if session_ids else {}
         
-        all_given = all(consent_status.values())
+        results = {}
+        for session_id, status in statuses.items():
+            result = build_consent_status(session_id, status)
+            del result['session_id']
+            results[session_id] = result
         
         return jsonify({
-            'session_id': session_id,
-            'all_consents_given': all_given,
-            'consents': consent_status,
-            'total_logged': len(consents)
+            'results': results,
+            'invalid': invalid
         }), 200
     
+    except PoolTimeout:
+        logger.warning("DB pool timeout while verifying consents in bulk")
+        return db_unavailable_response()
+    
     except Exception as e:
-        logger.error(f"Error verifying consents: {str(e)}", exc_info=True)
-        return jsonify({
-            'error': 'Internal server error',
-            'message': str(e)
-        }), 500
+        logger.error(f"Error verifying consents in bulk: {str(e)}", exc_info=True)
+        return internal_error_response(e)
 
 
 @app.route('/api/document-snapshot', methods=['POST'])
@@ -221,48 +495,255 @@ def save_document_snapshot():
     """
     try:
         # Простая защита: требуем API ключ
-        api_key = request.headers.get('X-API-Key')
-        if api_key != os.getenv('ADMIN_API_KEY'):
+        if not is_admin_request(request):
             return jsonify({'error': 'Unauthorized'}), 401
         
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
         # Валидация
-        required_fields = ['document_type', 'version', 'full_text', 'language']
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            return jsonify({
-                'error': 'Missing required fields',
-                'missing': missing_fields
-            }), 400
+        validation_error = validate_snapshot_data(data)
+        if validation_error:
+            return jsonify(validation_error), 400
         
-        # Вычисляем хеш
-        content_hash = hashlib.sha256(data['full_text'].encode('utf-8')).hexdigest()
-        
-        # Сохраняем
-        snapshot_id = db.create_document_snapshot({
-            'document_type': data['document_type'],
-            'version': data['version'],
-            'content_hash': content_hash,
-            'full_text': data['full_text'],
-            'language': data['language'],
-            'created_by': data.get('created_by', 'api')
-        })
+        # Вычисляем хеш и сохраняем
+        snapshot = build_document_snapshot(data)
+        snapshot_id = db.create_document_snapshot(snapshot)
+        # Остальные воркеры узнают об изменении через NOTIFY
+        document_cache.invalidate()
         
         logger.info(f"Document snapshot saved: {snapshot_id}")
         
         return jsonify({
             'success': True,
             'snapshot_id': snapshot_id,
-            'content_hash': content_hash
+            'content_hash': snapshot['content_hash']
         }), 201
     
+    except PoolTimeout:
+        logger.warning("DB pool timeout while saving document snapshot")
+        return db_unavailable_response()
+    
     except Exception as e:
         logger.error(f"Error saving document snapshot: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/documents', methods=['GET'])
+def list_active_documents():
+    """
+    Активные версии всех документов (без текста)
+    
+    Возвращает:
+    {
+        "documents": [
+            {"document_type": "...", "language": "ru", "version": "...", "content_hash": "..."}
+        ]
+    }
+    """
+    try:
+        documents = sorted(
+            document_cache.all(),
+            key=lambda doc: (doc['document_type'], doc['language'])
+        )
+        
         return jsonify({
-            'error': 'Internal server error',
-            'message': str(e)
-        }), 500
+            'documents': [active_document_summary(doc) for doc in documents]
+        }), 200
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while listing documents")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error listing documents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/documents/<document_type>', methods=['GET'])
+def get_active_document(document_type):
+    """
+    Активная версия документа с полным текстом
+    
+    Параметры: ?language=ru|en|he (по умолчанию DEFAULT_DOCUMENT_LANGUAGE)
+    
+    ETag ответа - SHA-256 хеш текста: при If-None-Match с тем же
+    хешем возвращается 304 без тела.
+    """
+    try:
+        if document_type not in ALLOWED_DOCUMENT_TYPES:
+            return jsonify({
+                'error': 'Invalid document_type',
+                'allowed': ALLOWED_DOCUMENT_TYPES
+            }), 400
+        
+        language = request.args.get('language', DEFAULT_DOCUMENT_LANGUAGE)
+        document = document_cache.get(document_type, language)
+        if not document:
+            return jsonify({'error': 'Document not found'}), 404
+        
+        if request.if_none_match.contains(document['content_hash']):
+            response = make_response('', 304)
+        else:
+            # Текст загружается только здесь (и хранится в кеше, пока версия активна)
+            full_text = document_cache.get_text(document['content_hash'])
+            response = make_response(jsonify(active_document_summary(document, full_text)), 200)
+        
+        response.set_etag(document['content_hash'])
+        response.headers['Cache-Control'] = 'public, max-age=60'
+        return response
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while getting document")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error getting document: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/stats', methods=['GET'])
+def consent_stats():
+    """
+    Статистика согласий за период (для администраторов)
+    
+    Параметры запроса:
+        date_from, date_to: период consent_timestamp (ISO 8601, UTC по умолчанию),
+                            расширяется до целых часов
+        series: hour | day - добавить число согласий по часам или дням
+    
+    Считается по почасовым/подневным агрегатам (consent_stats.py),
+    уникальные сессии - приблизительно.
+    """
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        stats_error, params = parse_stats_params(request.args)
+        if stats_error:
+            return jsonify(stats_error), 400
+        
+        return jsonify(get_consent_stats(db, params)), 200
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while getting consent stats")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error getting consent stats: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/consents', methods=['GET'])
+def list_consents():
+    """
+    Поиск согласий для поддержки, от новых к старым (для администраторов)
+    
+    Параметры запроса:
+        date_from, date_to: период consent_timestamp [date_from, date_to)
+        document_type, document_version, session_id, client_ip: фильтры
+        page: URL страницы (без учёта параметров запроса)
+        limit: записей на странице (по умолчанию 50, не больше CONSENT_SEARCH_MAX_LIMIT)
+        cursor: next_cursor из ответа с прошлой страницей
+    
+    Страницы по курсору читаются из индексов (consent_search.py),
+    время ответа не зависит от номера страницы.
+    """
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        search_error, params = parse_search_params(request.args)
+        if search_error:
+            return jsonify(search_error), 400
+        
+        return jsonify(search_consents(db, params)), 200
+    
+    except PoolTimeout:
+        logger.warning("DB pool timeout while searching consents")
+        return db_unavailable_response()
+    
+    except Exception as e:
+        logger.error(f"Error searching consents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/consents/export', methods=['GET'])
+def export_consents():
+    """
+    Выгрузка согласий с текстами документов для аудита (для администраторов)
+    
+    Параметры запроса:
+        format: ndjson (по умолчанию) | csv | parquet
+        gzip: 1 - сжать ndjson/csv
+        date_from, date_to: период consent_timestamp [date_from, date_to)
+        document_type, session_id: фильтры
+        include_text: 0 - без полного текста документа
+    
+    Ответ отдаётся потоком по мере чтения из БД. Воркер gunicorn
+    занят всё время выгрузки, очень большие выгрузки удобнее делать
+    командой python consent_export.py.
+    """
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    export_error, options = parse_export_params(request.args)
+    if export_error:
+        return jsonify(export_error), 400
+    
+    logger.info(f"Consent export started: {options}")
+    
+    return Response(
+        stream_with_context(iter_consent_export(db, options)),
+        mimetype=export_content_type(options),
+        headers={'Content-Disposition': f'attachment; filename="{export_filename(options)}"'}
+    )
+
+
+@app.route('/api/admin/pool-stats', methods=['GET'])
+def pool_stats():
+    """
+    Статистика пула соединений с БД текущего воркера (для администраторов)
+    
+    Каждый воркер gunicorn держит свой пул, поэтому ответ
+    содержит pid воркера.
+    """
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'pool': db.get_pool_stats(),
+        'replicas': db.get_replica_stats(),
+        'user_agent_cache': user_agent_classifier.get_stats()
+    }), 200
+
+
+@app.route('/api/admin/queue-stats', methods=['GET'])
+def queue_stats():
+    """Метрики очереди отложенной записи текущего воркера (для администраторов)"""
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'write_mode': CONSENT_WRITE_MODE,
+        'queue': consent_queue.get_stats() if consent_queue else None
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Метрики Prometheus (см. metrics.py)
+    
+    Под gunicorn - суммарно по всем воркерам. Если задан METRICS_API_KEY,
+    нужен заголовок Authorization: Bearer <METRICS_API_KEY>.
+    """
+    if not is_metrics_request_allowed(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 
 @app.errorhandler(404)
@@ -273,9 +754,15 @@ def not_found(error):
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {error}")
+    original = getattr(error, 'original_exception', None) or error
+    record_error(route_label(request), type(original).__name__)
     return jsonify({'error': 'Internal server error'}), 500
 
 
+BOOT_SECONDS = observe_boot(BOOT_STARTED)
+logger.info(f"App loaded in {BOOT_SECONDS * 1000:.0f} ms")
+
+
 if __name__ == '__main__':
     # Для локальной разработки
     port = int(os.getenv('PORT', 5000))
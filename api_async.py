@@ -0,0 +1,589 @@
+"""
+Асинхронная (ASGI) версия API логирования согласий
+
+Те же endpoints и правила валидации, что и в api.py, но на asyncio (Quart)
+с AsyncTicketDatabase: один процесс обслуживает сотни одновременных
+запросов, пока они ждут PostgreSQL.
+
+Запуск: SERVER_MODE=async gunicorn (см. gunicorn.conf.py)
+"""
+
+import time
+
+# Начало загрузки приложения (метрика consent_api_boot_seconds, /ready)
+BOOT_STARTED = time.perf_counter()
+
+import os
+import logging
+from collections import Counter
+from datetime import datetime
+
+from quart import Quart, Request, Response, g, request, jsonify, make_response
+from quart_cors import cors
+from dotenv import load_dotenv
+from psycopg_pool import PoolTimeout
+
+from database_async import AsyncTicketDatabase
+from consent_queue import CONSENT_WRITE_MODE
+from document_cache import DocumentCache
+from json_codec import configure_json
+from consent_dedup import RecentConsentIds, skip_recent_duplicates, mark_saved_consents
+from rate_limit import create_rate_limiter, retry_after_header
+from consent_export import parse_export_params, aiter_consent_export, export_content_type, export_filename
+from consent_stats import parse_stats_params, stats_periods, stats_series_range, build_consent_stats
+from consent_search import parse_search_params, build_search_page
+from user_agents import classifier as user_agent_classifier
+from migrations import build_readiness_status
+from metrics import (
+    observe_boot, observe_request, observe_request_phase, record_error, record_consent_duplicates, route_label,
+    is_metrics_request_allowed, render_metrics
+)
+from consent_common import (
+    is_admin_request, get_trusted_client_ip, validate_consent_data, check_consent_document, build_consent_log,
+    prepare_consent_batch, consent_batch_status, build_consent_status,
+    is_valid_session_id, prepare_bulk_verify, validate_idempotency_key,
+    validate_snapshot_data, build_document_snapshot, active_document_summary,
+    ALLOWED_DOCUMENT_TYPES, DEFAULT_DOCUMENT_LANGUAGE, DOCUMENT_CHECK_MODE
+)
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class TimedRequest(Request):
+    """Запрос с замером разбора JSON тела (метрика json_parse); text/plain разбирается как JSON"""
+
+    async def get_json(self, *args, **kwargs):
+        # navigator.sendBeacon (tilda-consent-logger.js) шлёт JSON как
+        # text/plain: такой запрос обходится без CORS preflight
+        if self.mimetype == 'text/plain':
+            kwargs['force'] = True
+        started = time.perf_counter()
+        try:
+            return await super().get_json(*args, **kwargs)
+        finally:
+            observe_request_phase(route_label(self), 'json_parse', started)
+
+
+# Инициализация Quart
+app = Quart(__name__)
+app.request_class = TimedRequest
+configure_json(app)
+
+# CORS - те же правила, что и в api.py
+app = cors(
+    app,
+    allow_origin=os.getenv("ALLOWED_ORIGINS", "*").split(","),
+    allow_methods=["POST", "GET", "OPTIONS"],
+    allow_headers=["Content-Type", "Idempotency-Key"],
+)
+
+# Инициализация БД (пул открывается при первом запросе, схему
+# создаёт python migrations.py при деплое)
+db = AsyncTicketDatabase()
+
+# Кеш активных версий документов (перезагружается в refresh_document_cache)
+document_cache = DocumentCache()
+
+# Недавно сохранённые ID согласий - повторы отсекаются без запроса к БД
+recent_consent_ids = RecentConsentIds()
+
+# Лимиты запросов на IP и session_id (проверяются до работы с БД)
+rate_limiter = create_rate_limiter()
+# Публичные endpoints, которые обращаются к БД
+RATE_LIMITED_ENDPOINTS = {'log_consent', 'log_consent_batch', 'verify_consents', 'verify_consents_bulk'}
+
+# Очередь отложенной записи работает только в sync режиме (потоки api.py)
+if CONSENT_WRITE_MODE == 'write_behind':
+    raise RuntimeError("CONSENT_WRITE_MODE=write_behind is not supported with SERVER_MODE=async")
+
+
+@app.before_serving
+async def start_document_cache_listener():
+    if db.database_url:
+        document_cache.start_listener(db.database_url)
+
+
+async def refresh_document_cache(strict: bool = True):
+    """
+    Перезагрузить кеш документов, если истёк TTL или пришло уведомление
+    (strict=False - для сверки согласий: ошибка БД не прерывает запрос)
+    """
+    if not document_cache.needs_reload(strict):
+        return
+    try:
+        document_cache.replace(await db.get_active_documents())
+    except Exception as e:
+        document_cache.reload_failed(e, strict)
+
+
+async def get_document_text(content_hash: str):
+    """Текст документа: из кеша, а при первом запросе версии - из БД"""
+    full_text = document_cache.get_text(content_hash)
+    if full_text is None:
+        full_text = await db.get_document_text(content_hash)
+        document_cache.put_text(content_hash, full_text)
+    return full_text
+
+
+@app.after_serving
+async def close_database():
+    await db.close()
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+async def limit_client_ip_rate():
+    if request.method == 'OPTIONS' or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    retry_after = rate_limiter.check_ip(get_trusted_client_ip(request))
+    if retry_after is not None:
+        return rate_limited_response(retry_after, 'ip')
+    return None
+
+
+@app.after_request
+async def observe_request_duration(response):
+    # Для потоковых ответов (выгрузка) - время до начала отдачи тела
+    started = g.pop('request_started', None)
+    if started is not None:
+        observe_request(request.method, route_label(request), response.status_code, started)
+    return response
+
+
+def db_unavailable_response():
+    """Ответ, когда в пуле нет свободных соединений с БД"""
+    record_error(route_label(request), 'PoolTimeout')
+    return jsonify({
+        'error': 'Service temporarily unavailable',
+        'message': 'Database connection pool exhausted, retry later'
+    }), 503, {'Retry-After': '1'}
+
+
+def rate_limited_response(retry_after, scope):
+    """Ответ, когда исчерпан лимит запросов на IP или session_id"""
+    record_error(route_label(request), 'RateLimited')
+    return jsonify({
+        'error': 'Too many requests',
+        'message': f'Rate limit per {scope} exceeded, retry later'
+    }), 429, {'Retry-After': retry_after_header(retry_after)}
+
+
+def consent_duplicate_response(consent_log_id, source):
+    """Ответ на повтор уже сохранённого согласия (тот же consent_log_id)"""
+    record_consent_duplicates(source)
+    return jsonify({
+        'success': True,
+        'consent_log_id': consent_log_id,
+        'duplicate': True,
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+
+def internal_error_response(e):
+    record_error(route_label(request), type(e).__name__)
+    return jsonify({
+        'error': 'Internal server error',
+        'message': str(e)
+    }), 500
+
+
+@app.route('/health', methods=['GET'])
+async def health_check():
+    """Проверка здоровья сервиса"""
+    return jsonify({
+        'status': 'healthy',
+        'service': 'ticket-consent-logger',
+        'timestamp': datetime.utcnow().isoformat()
+    }), 200
+
+
+@app.route('/ready', methods=['GET'])
+async def readiness_check():
+    """Готовность воркера принимать запросы (как в api.py)"""
+    try:
+        status, status_code = build_readiness_status(await db.get_applied_migrations(), BOOT_SECONDS)
+        return jsonify(status), status_code
+
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {e}")
+        return jsonify({
+            'status': 'not_ready',
+            'error': 'Database unavailable',
+            'message': str(e)
+        }), 503
+
+
+@app.route('/api/consent', methods=['POST'])
+async def log_consent():
+    """Логирование согласия пользователя с документом (формат как в api.py)"""
+    try:
+        data = await request.get_json(silent=True)
+
+        validation_error = validate_consent_data(data)
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not validation_error and idempotency_key is not None:
+            validation_error = validate_idempotency_key(idempotency_key)
+        if validation_error:
+            return jsonify(validation_error), 400
+
+        retry_after = rate_limiter.check_sessions({data['session_id']: 1})
+        if retry_after is not None:
+            return rate_limited_response(retry_after, 'session')
+
+        if DOCUMENT_CHECK_MODE != 'off':
+            await refresh_document_cache(strict=False)
+            document_error = check_consent_document(data, document_cache.find(
+                data['document_type'], data.get('language', DEFAULT_DOCUMENT_LANGUAGE)
+            ))
+            if document_error:
+                return jsonify(document_error), 409
+
+        consent_log = build_consent_log(data, request, idempotency_key)
+        consent_log_id = consent_log['consent_log_id']
+
+        if consent_log_id in recent_consent_ids:
+            return consent_duplicate_response(consent_log_id, 'memory')
+
+        created = await db.create_consent_log(consent_log) is not None
+        recent_consent_ids.add(consent_log_id)
+        if not created:
+            return consent_duplicate_response(consent_log_id, 'database')
+
+        logger.info(f"Consent logged: {consent_log_id} - {data['document_type']} - session: {data['session_id']}")
+
+        return jsonify({
+            'success': True,
+            'consent_log_id': consent_log_id,
+            'timestamp': datetime.utcnow().isoformat()
+        }), 201
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while logging consent")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error logging consent: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/consent/batch', methods=['POST'])
+async def log_consent_batch():
+    """Логирование нескольких согласий одним запросом (формат как в api.py)"""
+    try:
+        data = await request.get_json(silent=True)
+
+        if DOCUMENT_CHECK_MODE != 'off':
+            await refresh_document_cache(strict=False)
+        request_error, results, valid_indexes, consent_logs = prepare_consent_batch(
+            data, request, get_active_document=document_cache.find if DOCUMENT_CHECK_MODE != 'off' else None
+        )
+        if request_error:
+            return jsonify(request_error), 400
+
+        retry_after = rate_limiter.check_sessions(Counter(c['session_id'] for c in consent_logs))
+        if retry_after is not None:
+            return rate_limited_response(retry_after, 'session')
+
+        new_indexes, new_consent_logs = skip_recent_duplicates(
+            recent_consent_ids, results, valid_indexes, consent_logs
+        )
+        record_consent_duplicates('memory', len(consent_logs) - len(new_consent_logs))
+
+        if new_consent_logs:
+            created_ids = await db.create_consent_logs(new_consent_logs)
+            record_consent_duplicates(
+                'database', mark_saved_consents(results, new_indexes, new_consent_logs, created_ids)
+            )
+            recent_consent_ids.add_many([c['consent_log_id'] for c in new_consent_logs])
+
+        logger.info(f"Consent batch logged: {len(new_consent_logs)} of {len(results)}")
+
+        return jsonify({
+            'success': len(valid_indexes) == len(results),
+            'results': results,
+            'timestamp': datetime.utcnow().isoformat()
+        }), consent_batch_status(len(valid_indexes), len(results))
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while logging consent batch")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error logging consent batch: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/consent/verify/<session_id>', methods=['GET'])
+async def verify_consents(session_id):
+    """Проверить, что все три согласия получены для сессии"""
+    try:
+        if not is_valid_session_id(session_id):
+            return jsonify({'error': 'Invalid session_id, UUID expected'}), 400
+
+        status = await db.get_session_consent_status(session_id)
+
+        return jsonify(build_consent_status(session_id, status)), 200
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while verifying consents")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error verifying consents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/consent/verify', methods=['POST'])
+async def verify_consents_bulk():
+    """Проверить согласия для многих сессий одним запросом (формат как в api.py)"""
+    try:
+        if not is_admin_request(request):
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        data = await request.get_json(silent=True)
+
+        request_error, session_ids, invalid = prepare_bulk_verify(data)
+        if request_error:
+            return jsonify(request_error), 400
+
+        statuses = await db.get_session_consent_statuses(session_ids) if session_ids else {}
+
+        results = {}
+        for session_id, status in statuses.items():
+            result = build_consent_status(session_id, status)
+            del result['session_id']
+            results[session_id] = result
+
+        return jsonify({
+            'results': results,
+            'invalid': invalid
+        }), 200
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while verifying consents in bulk")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error verifying consents in bulk: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/document-snapshot', methods=['POST'])
+async def save_document_snapshot():
+    """Сохранить snapshot документа (для администраторов)"""
+    try:
+        if not is_admin_request(request):
+            return jsonify({'error': 'Unauthorized'}), 401
+
+        data = await request.get_json(silent=True)
+
+        validation_error = validate_snapshot_data(data)
+        if validation_error:
+            return jsonify(validation_error), 400
+
+        snapshot = build_document_snapshot(data)
+        snapshot_id = await db.create_document_snapshot(snapshot)
+        document_cache.invalidate()
+
+        logger.info(f"Document snapshot saved: {snapshot_id}")
+
+        return jsonify({
+            'success': True,
+            'snapshot_id': snapshot_id,
+            'content_hash': snapshot['content_hash']
+        }), 201
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while saving document snapshot")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error saving document snapshot: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/documents', methods=['GET'])
+async def list_active_documents():
+    """Активные версии всех документов (без текста)"""
+    try:
+        await refresh_document_cache()
+        documents = sorted(
+            document_cache.all(),
+            key=lambda doc: (doc['document_type'], doc['language'])
+        )
+
+        return jsonify({
+            'documents': [active_document_summary(doc) for doc in documents]
+        }), 200
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while listing documents")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error listing documents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/documents/<document_type>', methods=['GET'])
+async def get_active_document(document_type):
+    """Активная версия документа с полным текстом (ETag - хеш текста)"""
+    try:
+        if document_type not in ALLOWED_DOCUMENT_TYPES:
+            return jsonify({
+                'error': 'Invalid document_type',
+                'allowed': ALLOWED_DOCUMENT_TYPES
+            }), 400
+
+        await refresh_document_cache()
+        language = request.args.get('language', DEFAULT_DOCUMENT_LANGUAGE)
+        document = document_cache.get(document_type, language)
+        if not document:
+            return jsonify({'error': 'Document not found'}), 404
+
+        if request.if_none_match.contains(document['content_hash']):
+            response = await make_response('', 304)
+        else:
+            full_text = await get_document_text(document['content_hash'])
+            response = await make_response(jsonify(active_document_summary(document, full_text)), 200)
+
+        response.set_etag(document['content_hash'])
+        response.headers['Cache-Control'] = 'public, max-age=60'
+        return response
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while getting document")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error getting document: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/stats', methods=['GET'])
+async def consent_stats():
+    """Статистика согласий за период (параметры как в api.py)"""
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        stats_error, params = parse_stats_params(request.args)
+        if stats_error:
+            return jsonify(stats_error), 400
+
+        rows, registers = await db.get_consent_rollup(stats_periods(params['date_from'], params['date_to']))
+        series = None
+        if params['series']:
+            series = await db.get_consent_rollup_series(*stats_series_range(params))
+
+        return jsonify(build_consent_stats(params, rows, registers, series)), 200
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while getting consent stats")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error getting consent stats: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/consents', methods=['GET'])
+async def list_consents():
+    """Поиск согласий для поддержки по курсору (параметры как в api.py)"""
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        search_error, params = parse_search_params(request.args)
+        if search_error:
+            return jsonify(search_error), 400
+
+        rows = await db.search_consents(params['filters'], params['limit'] + 1, params['after'])
+        return jsonify(build_search_page(rows, params['limit'])), 200
+
+    except PoolTimeout:
+        logger.warning("DB pool timeout while searching consents")
+        return db_unavailable_response()
+
+    except Exception as e:
+        logger.error(f"Error searching consents: {str(e)}", exc_info=True)
+        return internal_error_response(e)
+
+
+@app.route('/api/admin/consents/export', methods=['GET'])
+async def export_consents():
+    """Выгрузка согласий для аудита потоком (параметры как в api.py)"""
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    export_error, options = parse_export_params(request.args)
+    if export_error:
+        return jsonify(export_error), 400
+
+    logger.info(f"Consent export started: {options}")
+
+    response = await make_response(aiter_consent_export(db, options))
+    response.mimetype = export_content_type(options)
+    response.headers['Content-Disposition'] = f'attachment; filename="{export_filename(options)}"'
+    # Выгрузка может идти дольше стандартного таймаута ответа Quart
+    response.timeout = None
+    return response
+
+
+@app.route('/api/admin/pool-stats', methods=['GET'])
+async def pool_stats():
+    """Статистика пула соединений с БД текущего воркера (для администраторов)"""
+    if not is_admin_request(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'pool': db.get_pool_stats(),
+        'replicas': db.get_replica_stats(),
+        'user_agent_cache': user_agent_classifier.get_stats()
+    }), 200
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Метрики Prometheus (как в api.py)"""
+    if not is_metrics_request_allowed(request):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+@app.errorhandler(404)
+async def not_found(error):
+    return jsonify({'error': 'Endpoint not found'}), 404
+
+
+@app.errorhandler(500)
+async def internal_error(error):
+    logger.error(f"Internal server error: {error}")
+    original = getattr(error, 'original_exception', None) or error
+    record_error(route_label(request), type(original).__name__)
+    return jsonify({'error': 'Internal server error'}), 500
+
+
+BOOT_SECONDS = observe_boot(BOOT_STARTED)
+logger.info(f"App loaded in {BOOT_SECONDS * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    # Для локальной разработки
+    port = int(os.getenv('PORT', 5000))
+    app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,1005 @@
+"""
+Нагрузочное тестирование и микробенчмарки API согласий
+
+Команды:
+    python benchmark.py load [--duration 30] [--concurrency 16] [--workers 2] [--server-mode sync]
+        поднять gunicorn (gunicorn.conf.py) на свободном порту и гонять
+        сценарий покупки: 3 согласия + 1 проверка на сессию, изредка
+        новый snapshot документа; --url - нагружать уже запущенный сервер
+        (запущенный с RATE_LIMIT_IP_PER_MINUTE=0: вся нагрузка идёт с одного IP)
+    python benchmark.py db [--iterations 500]
+        микробенчмарки методов TicketDatabase (включая get_connection)
+    python benchmark.py codec [--iterations 20000]
+        микробенчмарки разбора/сериализации JSON (stdlib и orjson)
+        и проверки тела согласия; база не нужна
+    python benchmark.py plans [--consents 300000]
+        дополнить базу данными до заданного объёма, выполнить EXPLAIN для
+        запросов TicketDatabase и завершиться с кодом 1, если запрос,
+        которому положен индекс, читает таблицу через Seq Scan
+    python benchmark.py compare OLD.json NEW.json [--threshold 10]
+        сравнить два результата, код выхода 1 при регрессии
+
+Бенчмарки load, db и plans пишут тысячи фиктивных согласий, поэтому работают только с
+отдельной базой: BENCHMARK_DATABASE_URL или --database-url (не DATABASE_URL).
+
+Результаты сохраняются в JSON (по умолчанию в benchmark_results/,
+имя с датой и коммитом) для сравнения между коммитами.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import secrets
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import psycopg
+from dotenv import load_dotenv
+from prometheus_client.parser import text_string_to_metric_families
+
+load_dotenv()
+
+BENCHMARK_DATABASE_URL = os.getenv("BENCHMARK_DATABASE_URL")
+BENCHMARK_RESULTS_DIR = os.getenv("BENCHMARK_RESULTS_DIR", "benchmark_results")
+
+# Документы сценария покупки (язык по умолчанию)
+BENCHMARK_DOCUMENT_TYPES = ['ticket_terms', 'refund_policy', 'privacy_policy']
+BENCHMARK_LANGUAGE = 'ru'
+# Язык snapshot'ов, которые публикуются во время нагрузки, чтобы
+# не менять активные версии документов сценария
+BENCHMARK_SNAPSHOT_LANGUAGE = 'he'
+
+# Показатели, по которым compare ищет регрессии: (ключ, больше - лучше)
+COMPARED_METRICS = [
+    ('throughput', True),
+    ('p50_ms', False),
+    ('p95_ms', False),
+    ('p99_ms', False),
+]
+
+
+# ========================================
+# Статистика
+# ========================================
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль (nearest rank) по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(latencies: List[float], elapsed: float) -> Dict:
+    """Сводка по замерам (секунды): число, пропускная способность, перцентили в мс"""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'throughput': round(len(values) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+# ========================================
+# Окружение и результаты
+# ========================================
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def postgres_version(database_url: str) -> Optional[str]:
+    with psycopg.connect(database_url) as conn:
+        return conn.execute('SHOW server_version').fetchone()[0]
+
+
+def benchmark_environment(database_url: str) -> Dict:
+    return {
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'postgres': postgres_version(database_url) if database_url else None,
+    }
+
+
+def save_results(results: Dict, output: Optional[str]) -> str:
+    if not output:
+        os.makedirs(BENCHMARK_RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        commit = results['environment']['git_commit'] or 'nogit'
+        output = os.path.join(BENCHMARK_RESULTS_DIR, f"{results['benchmark']}-{stamp}-{commit}.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    return output
+
+
+def print_summaries(title: str, summaries: Dict[str, Dict]):
+    print(f"\n{title}")
+    print(f"{'':<34} {'count':>8} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, summary in summaries.items():
+        print(f"{name:<34} {summary['count']:>8} {summary['throughput']:>9.1f} "
+              f"{summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} {summary['p99_ms']:>9.2f}")
+
+
+# ========================================
+# Нагрузочный тест через HTTP
+# ========================================
+
+class BenchmarkClient:
+    """HTTP клиент нагрузки (новое соединение на запрос, как у sync воркеров gunicorn)"""
+
+    def __init__(self, base_url: str, admin_api_key: Optional[str] = None):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.admin_api_key = admin_api_key
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None,
+                admin: bool = False) -> Tuple[int, bytes]:
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        if admin and self.admin_api_key:
+            headers['X-API-Key'] = self.admin_api_key
+        conn = self.connection_class(self.host, self.port, timeout=30)
+        try:
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+
+class LoadRecorder:
+    """Замеры запросов по endpoint'ам (потокобезопасно)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.recording = False
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self.sessions = 0
+        self.connection_errors = 0
+
+    def record(self, endpoint: str, status: int, latency: float):
+        if not self.recording:
+            return
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            endpoint_statuses = self.statuses.setdefault(endpoint, {})
+            endpoint_statuses[str(status)] = endpoint_statuses.get(str(status), 0) + 1
+
+    def connection_error(self):
+        if self.recording:
+            with self._lock:
+                self.connection_errors += 1
+
+    def session_done(self):
+        if self.recording:
+            with self._lock:
+                self.sessions += 1
+
+
+class ConnectionSampler(threading.Thread):
+    """Периодически считает соединения к базе бенчмарка (pg_stat_activity)"""
+
+    def __init__(self, database_url: str, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.database_url = database_url
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        with psycopg.connect(self.database_url, autocommit=True) as conn:
+            while not self._stop_event.wait(self.interval):
+                # Без соединения самого сэмплера
+                self.samples.append(conn.execute(
+                    "SELECT COUNT(*) - 1 FROM pg_stat_activity WHERE datname = current_database()"
+                ).fetchone()[0])
+
+    def stop(self) -> Dict:
+        self._stop_event.set()
+        self.join()
+        if not self.samples:
+            return {'samples': 0}
+        return {
+            'samples': len(self.samples),
+            'max': max(self.samples),
+            'mean': round(sum(self.samples) / len(self.samples), 2),
+        }
+
+
+def ensure_benchmark_documents(client: BenchmarkClient) -> Dict[str, Dict]:
+    """Активные документы сценария; недостающие публикуются"""
+    status, body = client.request('GET', '/api/documents')
+    if status != 200:
+        raise RuntimeError(f"GET /api/documents: {status} {body[:200]!r}")
+    documents = {
+        doc['document_type']: doc
+        for doc in json.loads(body)['documents']
+        if doc['language'] == BENCHMARK_LANGUAGE
+    }
+
+    for document_type in BENCHMARK_DOCUMENT_TYPES:
+        if document_type in documents:
+            continue
+        status, body = client.request('POST', '/api/document-snapshot', {
+            'document_type': document_type,
+            'version': 'benchmark-v1',
+            'language': BENCHMARK_LANGUAGE,
+            'full_text': f"Тестовый текст {document_type} для нагрузочного тестирования",
+        }, admin=True)
+        if status != 201:
+            raise RuntimeError(f"POST /api/document-snapshot: {status} {body[:200]!r}")
+        documents[document_type] = {
+            'document_type': document_type,
+            'version': 'benchmark-v1',
+            'content_hash': json.loads(body)['content_hash'],
+        }
+        print(f"📄 Опубликован тестовый документ {document_type}")
+
+    return documents
+
+
+def checkout_session(client: BenchmarkClient, recorder: LoadRecorder, documents: Dict[str, Dict]):
+    """Сценарий покупки: согласия со всеми документами и проверка перед оплатой"""
+    session_id = str(uuid.uuid4())
+    for document_type in BENCHMARK_DOCUMENT_TYPES:
+        document = documents[document_type]
+        started = time.perf_counter()
+        status, _ = client.request('POST', '/api/consent', {
+            'session_id': session_id,
+            'document_type': document_type,
+            'document_version': document['version'],
+            'document_hash': document['content_hash'],
+            'language': BENCHMARK_LANGUAGE,
+            'consent_given': True,
+            'consent_timestamp': datetime.now(timezone.utc).isoformat(),
+            'user_agent': 'consent-benchmark',
+            'page_url': 'https://benchmark.invalid/checkout',
+        })
+        recorder.record('POST /api/consent', status, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    status, _ = client.request('GET', f'/api/consent/verify/{session_id}')
+    recorder.record('GET /api/consent/verify/<session_id>', status, time.perf_counter() - started)
+    recorder.session_done()
+
+
+def publish_snapshot(client: BenchmarkClient, recorder: LoadRecorder, number: int):
+    """Новая версия тестового документа (язык BENCHMARK_SNAPSHOT_LANGUAGE)"""
+    started = time.perf_counter()
+    status, _ = client.request('POST', '/api/document-snapshot', {
+        'document_type': BENCHMARK_DOCUMENT_TYPES[number % len(BENCHMARK_DOCUMENT_TYPES)],
+        'version': f"benchmark-{uuid.uuid4().hex[:12]}",
+        'language': BENCHMARK_SNAPSHOT_LANGUAGE,
+        'full_text': f"Тестовая версия {number} " + "текст документа " * 200,
+    }, admin=True)
+    recorder.record('POST /api/document-snapshot', status, time.perf_counter() - started)
+
+
+def scrape_db_phases(client: BenchmarkClient) -> Dict[str, Tuple[float, float]]:
+    """{'operation/phase': (sum, count)} из /metrics сервера (пусто, если недоступно)"""
+    try:
+        status, body = client.request('GET', '/metrics')
+    except OSError:
+        return {}
+    if status != 200:
+        return {}
+
+    phases = {}
+    for family in text_string_to_metric_families(body.decode('utf-8')):
+        if family.name != 'consent_api_db_phase_duration_seconds':
+            continue
+        for sample in family.samples:
+            key = f"{sample.labels['operation']}/{sample.labels['phase']}"
+            total, count = phases.get(key, (0.0, 0.0))
+            if sample.name.endswith('_sum'):
+                phases[key] = (total + sample.value, count)
+            elif sample.name.endswith('_count'):
+                phases[key] = (total, count + sample.value)
+    return phases
+
+
+def db_phase_means(before: Dict, after: Dict) -> Dict[str, Dict]:
+    """Среднее время фаз работы с БД за время замера, мс"""
+    means = {}
+    for key, (total, count) in sorted(after.items()):
+        previous_total, previous_count = before.get(key, (0.0, 0.0))
+        calls = count - previous_count
+        if calls > 0:
+            means[key] = {
+                'calls': int(calls),
+                'mean_ms': round((total - previous_total) / calls * 1000, 3),
+            }
+    return means
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database_url: str, args, admin_api_key: str) -> Tuple[subprocess.Popen, str]:
+    """Запустить gunicorn с gunicorn.conf.py на свободном порту"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        ADMIN_API_KEY=admin_api_key,
+        PORT=str(port),
+        SERVER_MODE=args.server_mode,
+        WEB_CONCURRENCY=str(args.workers),
+        PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(prefix='consent-benchmark-metrics-'),
+        # Вся нагрузка идёт с одного IP
+        RATE_LIMIT_IP_PER_MINUTE='0',
+    )
+    env.pop('METRICS_API_KEY', None)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL if not args.server_log else None,
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+def wait_for_server(client: BenchmarkClient, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if client.request('GET', '/health')[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become healthy in time")
+
+
+def open_benchmark_database(database_url: str):
+    """TicketDatabase базы бенчмарка с применёнными миграциями"""
+    # TicketDatabase берёт DATABASE_URL при импорте
+    os.environ['DATABASE_URL'] = database_url
+    from database_tickets import TicketDatabase
+
+    db = TicketDatabase()
+    db.migrate()
+    return db
+
+
+def run_load(database_url: str, args) -> Dict:
+    admin_api_key = os.getenv('ADMIN_API_KEY') if args.url else secrets.token_hex(16)
+    server = None
+    base_url = args.url
+    if not base_url:
+        open_benchmark_database(database_url).close()
+        server, base_url = start_server(database_url, args, admin_api_key)
+        print(f"🚀 gunicorn ({args.server_mode}, воркеров: {args.workers}) на {base_url}")
+
+    client = BenchmarkClient(base_url, admin_api_key)
+    try:
+        wait_for_server(client)
+        documents = ensure_benchmark_documents(client)
+
+        recorder = LoadRecorder()
+        stop_at = time.monotonic() + args.warmup + args.duration
+        session_counter = iter(range(1, 1 << 62))
+        counter_lock = threading.Lock()
+
+        def user_loop():
+            while time.monotonic() < stop_at:
+                with counter_lock:
+                    number = next(session_counter)
+                try:
+                    checkout_session(client, recorder, documents)
+                    if args.snapshot_every and number % args.snapshot_every == 0:
+                        publish_snapshot(client, recorder, number)
+                except OSError as e:
+                    recorder.connection_error()
+                    print(f"⚠️ {e}")
+
+        users = [threading.Thread(target=user_loop, daemon=True) for _ in range(args.concurrency)]
+        for user in users:
+            user.start()
+
+        print(f"🔥 Прогрев {args.warmup} с, замер {args.duration} с, {args.concurrency} одновременных покупателей")
+        time.sleep(args.warmup)
+        phases_before = scrape_db_phases(client)
+        sampler = ConnectionSampler(database_url)
+        sampler.start()
+        recorder.recording = True
+        measure_started = time.perf_counter()
+
+        time.sleep(max(0.0, stop_at - time.monotonic()))
+        recorder.recording = False
+        elapsed = time.perf_counter() - measure_started
+        connections = sampler.stop()
+        for user in users:
+            user.join()
+        phases_after = scrape_db_phases(client)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    endpoints = {
+        endpoint: dict(latency_summary(latencies, elapsed), statuses=recorder.statuses[endpoint])
+        for endpoint, latencies in sorted(recorder.latencies.items())
+    }
+    return {
+        'benchmark': 'load',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {
+            'url': args.url, 'server_mode': args.server_mode, 'workers': args.workers,
+            'concurrency': args.concurrency, 'duration': args.duration,
+            'warmup': args.warmup, 'snapshot_every': args.snapshot_every,
+        },
+        'sessions': recorder.sessions,
+        'connection_errors': recorder.connection_errors,
+        'sessions_per_second': round(recorder.sessions / elapsed, 2),
+        'consents_per_second': round(endpoints.get('POST /api/consent', {}).get('count', 0) / elapsed, 2),
+        'results': endpoints,
+        'db_connections': connections,
+        'db_phases': db_phase_means(phases_before, phases_after),
+    }
+
+
+# ========================================
+# Микробенчмарки TicketDatabase
+# ========================================
+
+def benchmark_consent_log(session_id: str, document_type: str) -> Dict:
+    return {
+        'session_id': session_id,
+        'document_type': document_type,
+        'document_version': 'benchmark-v1',
+        'document_hash': 'benchmark',
+        'document_language': BENCHMARK_LANGUAGE,
+        'consent_given': True,
+        'consent_timestamp': datetime.now(timezone.utc),
+        'consent_text': f"Я согласен с {document_type}",
+        'user_agent': 'consent-benchmark',
+    }
+
+
+def time_calls(operation: Callable, iterations: int, warmup: int) -> Tuple[List[float], float]:
+    for _ in range(warmup):
+        operation()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - call_started)
+    return latencies, time.perf_counter() - started
+
+
+def run_db(database_url: str, args) -> Dict:
+    db = open_benchmark_database(database_url)
+    from consent_stats import stats_periods
+
+    try:
+        session_ids = [str(uuid.uuid4()) for _ in range(100)]
+        db.create_consent_logs([
+            benchmark_consent_log(session_id, document_type)
+            for session_id in session_ids for document_type in BENCHMARK_DOCUMENT_TYPES
+        ])
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        week = stats_periods(now - timedelta(days=7), now + timedelta(hours=1))
+
+        def get_connection():
+            with db.get_connection('benchmark'):
+                pass
+
+        def create_consent_log():
+            db.create_consent_log(benchmark_consent_log(str(uuid.uuid4()), 'ticket_terms'))
+
+        def create_consent_logs():
+            session_id = str(uuid.uuid4())
+            db.create_consent_logs([
+                benchmark_consent_log(session_id, document_type) for document_type in BENCHMARK_DOCUMENT_TYPES
+            ])
+
+        operations = {
+            'get_connection': get_connection,
+            'create_consent_log': create_consent_log,
+            'create_consent_logs (3)': create_consent_logs,
+            'get_session_consent_status': lambda: db.get_session_consent_status(session_ids[0]),
+            'get_session_consent_statuses (100)': lambda: db.get_session_consent_statuses(session_ids),
+            'get_active_documents': db.get_active_documents,
+            'get_consent_rollup (7 days)': lambda: db.get_consent_rollup(week),
+        }
+
+        results = {}
+        for name, operation in operations.items():
+            latencies, elapsed = time_calls(operation, args.iterations, args.warmup_iterations)
+            results[name] = latency_summary(latencies, elapsed)
+    finally:
+        db.close()
+
+    return {
+        'benchmark': 'db',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {'iterations': args.iterations, 'warmup_iterations': args.warmup_iterations},
+        'results': results,
+    }
+
+
+# ========================================
+# Микробенчмарки JSON и валидации
+# ========================================
+
+def benchmark_consent_body(document_type: str) -> Dict:
+    """Тело /api/consent, как его отправляет tilda-consent-logger.js"""
+    return {
+        'session_id': str(uuid.uuid4()),
+        'document_type': document_type,
+        'document_version': 'v2025-10-28',
+        'document_hash': secrets.token_hex(32),
+        'consent_given': True,
+        'consent_timestamp': datetime.now(timezone.utc).isoformat(),
+        'consent_text': f"Я согласен с {document_type}",
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                      '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'referrer': 'https://example.tilda.ws/',
+        'page_url': 'https://example.tilda.ws/tickets',
+        'language': BENCHMARK_LANGUAGE,
+    }
+
+
+def run_codec(args) -> Dict:
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+    from json_codec import OrjsonProvider, ORJSON_AVAILABLE
+    from consent_common import validate_consent_data, CONSENT_BATCH_MAX_SIZE
+
+    app = Flask('benchmark')
+    providers = {'stdlib': DefaultJSONProvider(app)}
+    if ORJSON_AVAILABLE:
+        providers['orjson'] = OrjsonProvider(app)
+
+    consent = benchmark_consent_body('ticket_terms')
+    batch = {'consents': [
+        benchmark_consent_body(BENCHMARK_DOCUMENT_TYPES[i % len(BENCHMARK_DOCUMENT_TYPES)])
+        for i in range(CONSENT_BATCH_MAX_SIZE)
+    ]}
+    consent_body = json.dumps(consent).encode()
+    batch_body = json.dumps(batch).encode()
+    consent_response = {'success': True, 'consent_log_id': str(uuid.uuid4()),
+                        'timestamp': datetime.utcnow().isoformat()}
+    batch_response = {'success': True, 'timestamp': datetime.utcnow().isoformat(), 'results': [
+        {'index': index, 'consent_log_id': str(uuid.uuid4())} for index in range(CONSENT_BATCH_MAX_SIZE)
+    ]}
+
+    operations = {}
+    for codec, provider in providers.items():
+        operations[f'loads consent ({codec})'] = lambda p=provider: p.loads(consent_body)
+        operations[f'loads batch {CONSENT_BATCH_MAX_SIZE} ({codec})'] = lambda p=provider: p.loads(batch_body)
+        operations[f'response consent ({codec})'] = lambda p=provider: p.response(consent_response)
+        operations[f'response batch {CONSENT_BATCH_MAX_SIZE} ({codec})'] = lambda p=provider: p.response(batch_response)
+    operations['validate_consent_data'] = lambda: validate_consent_data(consent)
+    operations[f'validate_consent_data x{CONSENT_BATCH_MAX_SIZE}'] = lambda: [
+        validate_consent_data(item) for item in batch['consents']
+    ]
+
+    results = {}
+    for name, operation in operations.items():
+        latencies, elapsed = time_calls(operation, args.iterations, args.warmup_iterations)
+        results[name] = latency_summary(latencies, elapsed)
+
+    return {
+        'benchmark': 'codec',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {'iterations': args.iterations, 'warmup_iterations': args.warmup_iterations},
+        'results': results,
+    }
+
+
+# ========================================
+# Планы запросов TicketDatabase
+# ========================================
+
+# Объём данных для проверки планов: на маленьких таблицах PostgreSQL
+# честно выбирает Seq Scan, и проверка ничего бы не показала.
+# Согласия - сессии по 3 документа, раз в PLAN_SEED_STEP от текущего
+# момента назад; документы - неактивные версии (активные не меняются)
+PLAN_SEED_STEP = timedelta(seconds=20)
+PLAN_SEED_LANGUAGES = ['ru', 'en', 'he']
+
+PLAN_SEED_CONSENTS_SQL = """
+    INSERT INTO consent_logs (
+        session_id, document_type, document_version, document_hash, document_language,
+        consent_given, consent_text, consent_timestamp,
+        client_ip, user_agent, ip_country, page_url, created_at
+    )
+    SELECT
+        s.session_id, d.document_type, 'benchmark-v1', 'benchmark', %(language)s,
+        TRUE, 'Я согласен с ' || d.document_type, s.consent_timestamp,
+        '10.0.' || (s.n %% 256) || '.' || (s.n / 256 %% 256), 'consent-benchmark',
+        CASE WHEN s.n %% 10 <> 0 THEN 'IL' END,
+        'https://tickets.example/event-' || (s.n %% 100) || '?utm_source=benchmark', s.consent_timestamp
+    FROM (
+        SELECT n, gen_random_uuid() AS session_id, %(until)s - (%(sessions)s - n) * %(step)s AS consent_timestamp
+        FROM generate_series(1, %(sessions)s) AS n
+    ) s
+    CROSS JOIN unnest(%(document_types)s::text[]) AS d(document_type)
+"""
+
+PLAN_SEED_DOCUMENTS_SQL = [
+    """
+    CREATE TEMP TABLE plan_seed_documents AS
+    SELECT
+        t.document_type, l.language, 'benchmark-plan-' || lpad(v::text, 4, '0') AS version,
+        convert_to(t.document_type || ' ' || l.language || ' ' || v, 'UTF8') AS data
+    FROM unnest(%(document_types)s::text[]) AS t(document_type),
+         unnest(%(languages)s::text[]) AS l(language),
+         generate_series(1, %(versions)s) AS v
+    """,
+    """
+    INSERT INTO document_blobs (content_hash, encoding, original_size, data)
+    SELECT encode(sha256(data), 'hex'), 'none', octet_length(data), data
+    FROM plan_seed_documents
+    ON CONFLICT (content_hash) DO NOTHING
+    """,
+    """
+    INSERT INTO document_snapshots (document_type, version, content_hash, language, is_active, created_by)
+    SELECT document_type, version, encode(sha256(data), 'hex'), language, FALSE, 'benchmark'
+    FROM plan_seed_documents
+    ON CONFLICT (document_type, language, version) DO NOTHING
+    """,
+]
+
+# Блоки журнала целостности за период согласий (хеши фиктивные:
+# база бенчмарка, consent_ledger.py verify на ней не нужен)
+PLAN_SEED_LEDGER_SQL = """
+    INSERT INTO consent_ledger_blocks (block_start, block_end, row_count, merkle_root, prev_hash, block_hash)
+    SELECT h, h + interval '1 hour', 0, md5(h::text), md5((h - interval '1 hour')::text), md5(h::text)
+    FROM generate_series(date_trunc('hour', %s::timestamptz), %s::timestamptz - interval '1 hour', interval '1 hour') AS h
+    ON CONFLICT DO NOTHING
+"""
+
+# Таблицы (и их партиции): размер и родительская таблица
+PLAN_RELATIONS_SQL = """
+    SELECT c.relname, c.relpages, COALESCE(p.relname, c.relname) AS table_name
+    FROM pg_class c
+    LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+    LEFT JOIN pg_class p ON p.oid = i.inhparent
+    WHERE c.relkind IN ('r', 'p')
+"""
+
+
+def seed_plan_database(database_url: str, consents: int, document_versions: int) -> Dict:
+    """Дополнить базу бенчмарка данными до нужного объёма; примеры параметров запросов"""
+    until = datetime.now(timezone.utc).replace(microsecond=0)
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM consent_logs").fetchone()[0]
+        sessions = (consents - existing) // len(BENCHMARK_DOCUMENT_TYPES)
+        if sessions > 0:
+            print(f"🌱 Добавление {sessions * len(BENCHMARK_DOCUMENT_TYPES)} согласий...")
+            conn.execute(PLAN_SEED_CONSENTS_SQL, {
+                'language': BENCHMARK_LANGUAGE, 'until': until, 'sessions': sessions,
+                'step': PLAN_SEED_STEP, 'document_types': BENCHMARK_DOCUMENT_TYPES,
+            })
+
+        with conn.transaction():
+            for statement in PLAN_SEED_DOCUMENTS_SQL:
+                conn.execute(statement, {
+                    'document_types': BENCHMARK_DOCUMENT_TYPES, 'languages': PLAN_SEED_LANGUAGES,
+                    'versions': document_versions,
+                })
+            conn.execute("DROP TABLE plan_seed_documents")
+
+        first, last = conn.execute("SELECT min(created_at), max(created_at) FROM consent_logs").fetchone()
+        conn.execute(PLAN_SEED_LEDGER_SQL, (first, last))
+        # VACUUM - чтобы карта видимости позволяла Index Only Scan, как в рабочей базе
+        conn.execute("VACUUM ANALYZE")
+
+        sample = conn.execute("""
+            SELECT consent_log_id, consent_timestamp, session_id, client_ip
+            FROM consent_logs ORDER BY consent_timestamp DESC LIMIT 1
+        """).fetchone()
+        return {
+            'consent_log_id': sample[0],
+            'consent_timestamp': sample[1],
+            'session_id': sample[2],
+            'client_ip': sample[3],
+            'session_ids': [row[0] for row in conn.execute(
+                "SELECT session_id FROM consent_session_status LIMIT 100"
+            )],
+            'content_hash': conn.execute("SELECT content_hash FROM document_blobs LIMIT 1").fetchone()[0],
+            'first_created_at': first,
+            'last_created_at': last,
+        }
+
+
+def query_plan_checks(sample: Dict) -> List[Tuple[str, str, object, List[str]]]:
+    """
+    Запросы TicketDatabase для проверки планов
+
+    Returns:
+        [(название, запрос, параметры, таблицы, которые нельзя читать Seq Scan)];
+        пустой список таблиц - запрос читает таблицу целиком по замыслу
+        (статистика, обслуживание), его план только показывается
+    """
+    import database_tickets as sql
+    from consent_stats import stats_periods
+
+    hour = sample['last_created_at'].replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    week = stats_periods(hour - timedelta(days=7), hour + timedelta(hours=1))
+    after = {'after_timestamp': sample['first_created_at'], 'after_id': sample['consent_log_id'], 'limit': 5000}
+    block = (hour, hour + timedelta(hours=1), 0, '0', '0', '0', '0', '0')
+    # Вторая страница поиска: после самой новой записи
+    cursor = (sample['consent_timestamp'], sample['consent_log_id'])
+
+    return [
+        ('get_consents_by_session', sql.SELECT_CONSENTS_BY_SESSION_SQL,
+         (sample['session_id'],), ['consent_logs']),
+        ('get_session_consent_status', sql.SELECT_SESSION_STATUS_SQL,
+         (sample['session_id'],), ['consent_session_status']),
+        ('get_session_consent_statuses (100)', sql.SELECT_SESSION_STATUSES_SQL,
+         (sample['session_ids'],), ['consent_session_status']),
+        ('create_consent_log: existing ids', sql.SELECT_EXISTING_CONSENT_IDS_SQL,
+         ([sample['consent_log_id']], [sample['consent_timestamp']],
+          sql.CONSENT_DEDUP_WINDOW, sql.CONSENT_DEDUP_WINDOW), ['consent_logs']),
+        ('get_active_document', sql.SELECT_ACTIVE_DOCUMENT_SQL,
+         ('ticket_terms', BENCHMARK_LANGUAGE), ['document_snapshots']),
+        ('get_active_documents', sql.SELECT_ACTIVE_DOCUMENTS_SQL, None, ['document_snapshots']),
+        ('create_document_snapshot: deactivate', sql.DEACTIVATE_DOCUMENT_SNAPSHOTS_SQL,
+         ('ticket_terms', BENCHMARK_LANGUAGE), ['document_snapshots']),
+        ('create_document_snapshot: blob exists', sql.DOCUMENT_BLOB_EXISTS_SQL,
+         (sample['content_hash'],), ['document_blobs']),
+        ('get_document_text', sql.SELECT_DOCUMENT_BLOB_CHAIN_SQL,
+         (sample['content_hash'],), ['document_blobs']),
+        ('get_consent_rollup (7 days)', *sql.consent_rollup_query(sql.SELECT_CONSENT_ROLLUP_SQL, week),
+         ['consent_stats_rollup']),
+        ('get_consent_rollup: hll (7 days)', *sql.consent_rollup_query(sql.SELECT_CONSENT_HLL_SQL, week),
+         ['consent_sessions_hll']),
+        ('get_consent_rollup_series (day)', sql.SELECT_CONSENT_ROLLUP_SERIES_SQL,
+         ('hour', day, day + timedelta(days=1)), ['consent_stats_rollup']),
+        ('export: session', *sql.consent_export_query(
+            BENCHMARK_LANGUAGE, session_id=str(sample['session_id']), include_text=False
+        ), ['consent_logs', 'document_snapshots']),
+        ('export: day', *sql.consent_export_query(
+            BENCHMARK_LANGUAGE, date_from=day, date_to=day + timedelta(days=1), include_text=False
+        ), ['consent_logs']),
+        ('search_consents', *sql.consent_search_query({}, 51, cursor), ['consent_logs']),
+        ('search_consents: day', *sql.consent_search_query(
+            {'date_from': day, 'date_to': day + timedelta(days=1)}, 51, cursor
+        ), ['consent_logs']),
+        ('search_consents: client_ip', *sql.consent_search_query(
+            {'client_ip': sample['client_ip']}, 51, cursor
+        ), ['consent_logs']),
+        ('search_consents: session', *sql.consent_search_query(
+            {'session_id': sample['session_id']}, 51, cursor
+        ), ['consent_logs']),
+        ('search_consents: version', *sql.consent_search_query(
+            {'document_type': 'ticket_terms', 'document_version': 'benchmark-v1'}, 51, cursor
+        ), ['consent_logs']),
+        ('search_consents: page', *sql.consent_search_query(
+            {'page': 'https://tickets.example/event-0'}, 51, cursor
+        ), ['consent_logs']),
+        ('get_consents_without_country', sql.SELECT_CONSENTS_WITHOUT_COUNTRY_SQL, after, ['consent_logs']),
+        ('set_consent_countries', sql.UPDATE_CONSENT_COUNTRIES_SQL,
+         [[sample['consent_log_id']], [sample['consent_timestamp']], ['IL']],
+         ['consent_logs', 'consent_stats_rollup']),
+        ('get_consents_with_user_agent', sql.SELECT_CONSENTS_WITH_USER_AGENT_SQL, after, ['consent_logs']),
+        ('set_consent_user_agents', sql.UPDATE_CONSENT_USER_AGENTS_SQL,
+         [[sample['consent_log_id']], [sample['consent_timestamp']], [0]], ['consent_logs']),
+        ('get_consent_record_hashes: fill', sql.FILL_CONSENT_RECORD_HASHES_SQL,
+         (hour, hour + timedelta(hours=1)), ['consent_logs']),
+        ('get_consent_record_hashes', sql.SELECT_CONSENT_RECORD_HASHES_SQL,
+         (hour, hour + timedelta(hours=1)), ['consent_logs']),
+        ('stream_consent_ledger_rows (day)', sql.SELECT_CONSENT_LEDGER_ROWS_SQL,
+         (day, day + timedelta(days=1)), ['consent_logs']),
+        ('stream_consent_analytics_rows (hour)', sql.SELECT_CONSENT_ANALYTICS_ROWS_SQL,
+         (hour, hour + timedelta(hours=1)), ['consent_logs']),
+        ('count_consents_created_before', sql.COUNT_CONSENTS_CREATED_BEFORE_SQL,
+         (sample['first_created_at'] + timedelta(hours=1),), ['consent_logs']),
+        ('get_last_consent_ledger_block', sql.SELECT_LAST_CONSENT_LEDGER_BLOCK_SQL,
+         None, ['consent_ledger_blocks']),
+        ('add_consent_ledger_block', sql.INSERT_CONSENT_LEDGER_BLOCK_SQL, block, ['consent_ledger_blocks']),
+        ('get_consent_stats', *sql.consent_stats_query(), []),
+        ('get_first_consent_created_at', sql.SELECT_FIRST_CONSENT_CREATED_AT_SQL, None, []),
+        ('get_consent_ledger_blocks', sql.SELECT_CONSENT_LEDGER_BLOCKS_SQL, None, []),
+        ('compact_document_blobs: snapshots', sql.SELECT_DOCUMENT_SNAPSHOT_HASHES_SQL, None, []),
+        ('compact_document_blobs: blobs', sql.SELECT_DOCUMENT_BLOBS_SQL, None, []),
+        ('get_document_blob_stats', sql.DOCUMENT_BLOB_STATS_SQL, None, []),
+    ]
+
+
+def plan_scans(plan: Dict) -> Iterator[Dict]:
+    """Узлы плана, читающие таблицы (Seq Scan, Index Scan, ...)"""
+    if 'Relation Name' in plan:
+        yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_scans(child)
+
+
+def run_plans(database_url: str, args) -> Dict:
+    open_benchmark_database(database_url).close()
+    sample = seed_plan_database(database_url, args.consents, args.document_versions)
+
+    results = {}
+    regressions = []
+    with psycopg.connect(database_url) as conn:
+        relations = {row[0]: (row[1], row[2]) for row in conn.execute(PLAN_RELATIONS_SQL)}
+        for name, query, params, indexed_tables in query_plan_checks(sample):
+            plan = conn.execute(f"EXPLAIN (FORMAT JSON) {query}", params).fetchone()[0][0]['Plan']
+            scans = {}
+            failed = []
+            for node in plan_scans(plan):
+                relpages, table = relations.get(node['Relation Name'], (0, node['Relation Name']))
+                # Пустые партиции (будущих месяцев) читаются Seq Scan бесплатно
+                if relpages == 0 and table != node['Relation Name']:
+                    continue
+                scan = f"{node['Node Type']} {table}"
+                scans[scan] = scans.get(scan, 0) + 1
+                if node['Node Type'] == 'Seq Scan' and table in indexed_tables:
+                    failed.append(f"{name}: Seq Scan {node['Relation Name']}")
+            conn.rollback()
+            regressions.extend(failed)
+
+            results[name] = {
+                'total_cost': plan['Total Cost'],
+                'scans': scans,
+                'checked': indexed_tables,
+            }
+            mark = '❌' if failed else ('✅' if indexed_tables else '  ')
+            summary = ", ".join(f"{scan} x{count}" if count > 1 else scan for scan, count in scans.items())
+            print(f"{mark} {name:<40} {plan['Total Cost']:>12.2f}  {summary}")
+
+    return {
+        'benchmark': 'plans',
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {'consents': args.consents, 'document_versions': args.document_versions},
+        'results': results,
+        'regressions': regressions,
+    }
+
+
+# ========================================
+# Сравнение результатов
+# ========================================
+
+def compare_results(old: Dict, new: Dict, threshold: float) -> List[str]:
+    """Вывести таблицу изменений, вернуть список регрессий"""
+    regressions = []
+    print(f"{'':<38} {'метрика':<11} {'было':>10} {'стало':>10} {'изменение':>10}")
+    for name, new_summary in new['results'].items():
+        old_summary = old['results'].get(name)
+        if not old_summary:
+            continue
+        for key, higher_is_better in COMPARED_METRICS:
+            before, after = old_summary.get(key), new_summary.get(key)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = -change if higher_is_better else change
+            mark = ''
+            if worse > threshold:
+                mark = ' ❌'
+                regressions.append(f"{name} {key}: {before} -> {after}")
+            print(f"{name:<38} {key:<11} {before:>10} {after:>10} {change:>+9.1f}%{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование API согласий")
+    parser.add_argument('--database-url', default=BENCHMARK_DATABASE_URL,
+                        help="отдельная база для бенчмарка (по умолчанию BENCHMARK_DATABASE_URL)")
+    parser.add_argument('-o', '--output', help="файл результата (по умолчанию в benchmark_results/)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help="нагрузка на HTTP API сценарием покупки")
+    load.add_argument('--url', help="нагружать уже запущенный сервер (ADMIN_API_KEY из окружения)")
+    load.add_argument('--server-mode', default='sync', choices=['sync', 'async'])
+    load.add_argument('--workers', type=int, default=2)
+    load.add_argument('--concurrency', type=int, default=16, help="одновременных покупателей")
+    load.add_argument('--duration', type=float, default=30, help="секунд замера")
+    load.add_argument('--warmup', type=float, default=3, help="секунд прогрева без замера")
+    load.add_argument('--snapshot-every', type=int, default=100,
+                      help="публиковать snapshot документа каждые N сессий (0 - не публиковать)")
+    load.add_argument('--server-log', action='store_true', help="показывать лог gunicorn")
+
+    db_parser = commands.add_parser('db', help="микробенчмарки методов TicketDatabase")
+    db_parser.add_argument('--iterations', type=int, default=500)
+    db_parser.add_argument('--warmup-iterations', type=int, default=20)
+
+    codec = commands.add_parser('codec', help="микробенчмарки JSON кодеков и валидации")
+    codec.add_argument('--iterations', type=int, default=20000)
+    codec.add_argument('--warmup-iterations', type=int, default=500)
+
+    plans = commands.add_parser('plans', help="проверить планы запросов TicketDatabase (EXPLAIN)")
+    plans.add_argument('--consents', type=int, default=300000,
+                       help="сколько согласий должно быть в базе (недостающие добавляются)")
+    plans.add_argument('--document-versions', type=int, default=200,
+                       help="неактивных версий каждого документа на каждом языке")
+
+    compare = commands.add_parser('compare', help="сравнить два результата")
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help="допустимое ухудшение, %% (по умолчанию 10)")
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare_results(old, new, args.threshold)
+        if regressions:
+            print(f"\n❌ Регрессии (хуже более чем на {args.threshold}%):")
+            for regression in regressions:
+                print(f"   {regression}")
+            exit(1)
+        print("\n✅ Регрессий нет")
+        return
+
+    if args.command == 'codec':
+        results = run_codec(args)
+        print_summaries("JSON и валидация (на вызов)", results['results'])
+        results['environment'] = benchmark_environment(None)
+        print(f"\n💾 Результаты: {save_results(results, args.output)}")
+        return
+
+    if not args.database_url:
+        print("❌ Ошибка: укажите отдельную базу через BENCHMARK_DATABASE_URL или --database-url")
+        exit(1)
+    database_url = args.database_url.replace("postgres://", "postgresql://", 1)
+
+    if args.command == 'plans':
+        results = run_plans(database_url, args)
+        results['environment'] = benchmark_environment(database_url)
+        print(f"\n💾 Результаты: {save_results(results, args.output)}")
+        if results['regressions']:
+            print("\n❌ Seq Scan по таблицам, которые должны читаться по индексу:")
+            for regression in results['regressions']:
+                print(f"   {regression}")
+            exit(1)
+        print("\n✅ Все проверенные запросы читают таблицы по индексам")
+        return
+
+    if args.command == 'load':
+        results = run_load(database_url, args)
+        print_summaries(f"Сессий в секунду: {results['sessions_per_second']}, "
+                        f"согласий в секунду: {results['consents_per_second']}", results['results'])
+        print(f"\nСоединений с БД: {results['db_connections']}")
+        for key, phase in results['db_phases'].items():
+            print(f"   {key:<45} {phase['calls']:>8} вызовов {phase['mean_ms']:>8.3f} мс")
+    else:
+        results = run_db(database_url, args)
+        print_summaries("Методы TicketDatabase", results['results'])
+
+    results['environment'] = benchmark_environment(database_url)
+    print(f"\n💾 Результаты: {save_results(results, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+"""
+Аналитическое хранилище согласий (Parquet)
+
+Отчёты маркетинга и юристов (какой документ пропускают, с каких
+referrer, страниц и браузеров приходят) по живой таблице consent_logs
+нагружают общую с ботом БД. Поэтому согласия регулярно выгружаются в
+локальные Parquet файлы, а отчёты считаются по ним (pyarrow, по
+колонкам), без запросов к PostgreSQL:
+- extract читает записи с created_at от водяного знака (_watermark.json)
+  до now() - CONSENT_ANALYTICS_SETTLE_DELAY (чтобы успели завершиться
+  транзакции с таким created_at, как в consent_ledger.py) и дописывает
+  их новыми файлами;
+- файлы разложены по месяцам согласия (consent_month=2025-11/part-...),
+  отчёт за период читает только свои месяцы;
+- повторяющиеся строки (document_type, referrer_url, page_url,
+  user_agent, ...) хранятся со словарным кодированием: в колонке номера
+  строк словаря, а не сами строки;
+- семейства браузера, ОС и устройства (browser, os, device) берутся из
+  справочника user_agents (записям до него их считает user_agents.py);
+- IP адреса, хеши и тексты документов не выгружаются.
+
+Файл запуска называется part-<от>-<до>.parquet (водяные знаки в
+микросекундах). Водяной знак сохраняется после записи файлов, поэтому
+файлы прерванного запуска (от водяного знака и позже) не читаются и
+удаляются следующим extract; файлы, вошедшие в объединённый compact
+файл, тоже - записи не дублируются.
+
+Команды:
+    python consent_analytics.py extract
+        выгрузить новые согласия (по расписанию, например раз в час)
+    python consent_analytics.py compact
+        объединить файлы каждого месяца в один (после многих extract)
+    python consent_analytics.py funnel [--by referrer_host] [--date-from 2025-11-01] [--date-to 2025-12-01]
+        воронка: доля сессий, подтвердивших каждый документ и все сразу
+    python consent_analytics.py top --by page_path [--limit 20]
+        число согласий и сессий по значениям колонки
+    python consent_analytics.py sql "SELECT document_type, count(*) FROM consents GROUP BY 1"
+        произвольный запрос (нужен pip install duckdb)
+    python consent_analytics.py status
+        водяной знак, файлы и размер хранилища
+
+Нужен pyarrow (pip install pyarrow), как и для выгрузки в Parquet.
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import importlib.util
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from consent_common import ALLOWED_DOCUMENT_TYPES
+from database_tickets import TicketDatabase
+from user_agents import classify_user_agent
+
+# Каталог хранилища
+CONSENT_ANALYTICS_DIR = os.getenv("CONSENT_ANALYTICS_DIR", "consent_analytics")
+# Записи новее (секунд) выгружаются следующим запуском
+CONSENT_ANALYTICS_SETTLE_DELAY = int(os.getenv("CONSENT_ANALYTICS_SETTLE_DELAY", "300"))
+# Строк в группе строк Parquet (единица чтения и сжатия)
+CONSENT_ANALYTICS_ROW_GROUP_SIZE = int(os.getenv("CONSENT_ANALYTICS_ROW_GROUP_SIZE", "100000"))
+
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+DUCKDB_AVAILABLE = importlib.util.find_spec('duckdb') is not None
+
+if PYARROW_AVAILABLE:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+
+WATERMARK_FILE = '_watermark.json'
+MONTH_DIR_PREFIX = 'consent_month='
+PART_FILE_RE = re.compile(r'^part-(\d+)-(\d+)\.parquet$')
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+# Колонки хранилища: string, dictionary (словарное кодирование), bool, timestamp
+ANALYTICS_COLUMNS = [
+    ('consent_log_id', 'string'),
+    ('session_id', 'string'),
+    ('document_type', 'dictionary'),
+    ('document_version', 'dictionary'),
+    ('document_language', 'dictionary'),
+    ('consent_given', 'bool'),
+    ('consent_timestamp', 'timestamp'),
+    ('created_at', 'timestamp'),
+    ('ip_country', 'dictionary'),
+    ('referrer_url', 'dictionary'),
+    ('referrer_host', 'dictionary'),
+    ('page_url', 'dictionary'),
+    ('page_path', 'dictionary'),
+    ('user_agent', 'dictionary'),
+    ('browser', 'dictionary'),
+    ('os', 'dictionary'),
+    ('device', 'dictionary'),
+]
+# Колонки для --by в funnel и top
+REPORT_DIMENSIONS = [
+    'referrer_host', 'referrer_url', 'page_path', 'page_url', 'browser', 'os', 'device', 'user_agent',
+    'ip_country', 'document_language', 'document_version', 'document_type', 'consent_month',
+]
+
+
+def analytics_schema():
+    types = {
+        'string': pyarrow.string(),
+        'dictionary': pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        'bool': pyarrow.bool_(),
+        'timestamp': pyarrow.timestamp('us', tz='UTC'),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in ANALYTICS_COLUMNS])
+
+
+def epoch_microseconds(value: datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def url_host(url: Optional[str]) -> Optional[str]:
+    """Хост referrer (или значение как есть: 'direct' из tilda-consent-logger.js)"""
+    if not url:
+        return url
+    return urlsplit(url).hostname or url
+
+
+def url_path(url: Optional[str]) -> Optional[str]:
+    """Страница без параметров запроса (utm_* и т.п.): host/path"""
+    if not url:
+        return url
+    parts = urlsplit(url)
+    return f"{parts.hostname or ''}{parts.path or '/'}" if parts.hostname else url
+
+
+def consent_month(row: Dict) -> str:
+    return row['consent_timestamp'].astimezone(timezone.utc).strftime('%Y-%m')
+
+
+def rows_to_table(rows: List[Dict]):
+    """Записи consent_logs -> таблица Arrow со схемой хранилища"""
+    columns = {
+        'consent_log_id': [str(row['consent_log_id']) for row in rows],
+        'session_id': [str(row['session_id']) for row in rows],
+        'referrer_host': [url_host(row['referrer_url']) for row in rows],
+        'page_path': [url_path(row['page_url']) for row in rows],
+    }
+    # Записи, сохранённые до справочника user_agents, классифицируются здесь
+    families = [
+        row if row['browser'] or not row['user_agent'] else classify_user_agent(row['user_agent'])
+        for row in rows
+    ]
+    for name in ('browser', 'os', 'device'):
+        columns[name] = [family[name] for family in families]
+    for name, _ in ANALYTICS_COLUMNS:
+        if name not in columns:
+            columns[name] = [row[name] for row in rows]
+    return pyarrow.table(columns, schema=analytics_schema())
+
+
+def conform_table(table):
+    """Таблица из файла прошлой версии схемы -> схема хранилища (новые колонки пустые)"""
+    schema = analytics_schema()
+    return pyarrow.table({
+        field.name: table[field.name] if field.name in table.column_names
+        else pyarrow.nulls(table.num_rows, field.type)
+        for field in schema
+    }, schema=schema)
+
+
+# ========================================
+# Файлы хранилища
+# ========================================
+
+def read_watermark(root: str) -> Dict:
+    """Состояние хранилища: created_to (водяной знак), rows, updated_at"""
+    try:
+        with open(os.path.join(root, WATERMARK_FILE), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {'created_to': None, 'rows': 0, 'updated_at': None}
+    state['created_to'] = datetime.fromisoformat(state['created_to']) if state['created_to'] else None
+    return state
+
+
+def write_watermark(root: str, created_to: datetime, rows: int):
+    """Сохранить водяной знак атомарно (через временный файл)"""
+    path = os.path.join(root, WATERMARK_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({
+            'created_to': created_to.isoformat(),
+            'rows': rows,
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def scan_parts(root: str) -> List[Tuple[str, int, int]]:
+    """Все файлы хранилища: (путь, от, до)"""
+    parts = []
+    if not os.path.isdir(root):
+        return parts
+    for month_dir in sorted(os.listdir(root)):
+        if not month_dir.startswith(MONTH_DIR_PREFIX):
+            continue
+        directory = os.path.join(root, month_dir)
+        for name in sorted(os.listdir(directory)):
+            match = PART_FILE_RE.match(name)
+            if match:
+                parts.append((os.path.join(directory, name), int(match.group(1)), int(match.group(2))))
+    return parts
+
+
+def split_parts(root: str, watermark: Optional[datetime]) -> Tuple[List[str], List[str]]:
+    """
+    Файлы хранилища: (действующие, лишние)
+
+    Лишние - файлы прерванного extract (от водяного знака и позже) и
+    файлы, чей диапазон целиком вошёл в объединённый файл того же месяца
+    (compact прервался до их удаления).
+    """
+    watermark_us = epoch_microseconds(watermark) if watermark else 0
+    parts = scan_parts(root)
+    valid, stale = [], []
+    for path, part_from, part_to in parts:
+        covered = any(
+            os.path.dirname(other) == os.path.dirname(path) and other != path
+            and other_from <= part_from and part_to <= other_to
+            and (other_from, other_to) != (part_from, part_to)
+            for other, other_from, other_to in parts
+        )
+        if part_from >= watermark_us or covered:
+            stale.append(path)
+        else:
+            valid.append(path)
+    return valid, stale
+
+
+def remove_stale_parts(root: str, watermark: Optional[datetime]) -> int:
+    """Удалить лишние и временные файлы (см. split_parts)"""
+    _, stale = split_parts(root, watermark)
+    for month_dir in os.listdir(root) if os.path.isdir(root) else []:
+        directory = os.path.join(root, month_dir)
+        if month_dir.startswith(MONTH_DIR_PREFIX):
+            stale.extend(os.path.join(directory, name) for name in os.listdir(directory) if name.startswith('.'))
+    for path in stale:
+        os.remove(path)
+    return len(stale)
+
+
+class MonthPartWriter:
+    """
+    Файлы одного запуска: по файлу на месяц согласия
+
+    Записи копятся по месяцам и пишутся группами строк по
+    CONSENT_ANALYTICS_ROW_GROUP_SIZE; всего в памяти не больше одной
+    группы. Файлы пишутся под временным именем (с точкой - их не видят
+    отчёты) и переименовываются в close().
+    """
+
+    def __init__(self, root: str, name: str, row_group_size: int = CONSENT_ANALYTICS_ROW_GROUP_SIZE):
+        self.root = root
+        self.name = name
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._pending: Dict[str, List] = {}
+        self._pending_rows = 0
+        self._writers: Dict[str, Tuple[str, object]] = {}
+
+    def write_rows(self, rows: List[Dict]):
+        for row in rows:
+            self._pending.setdefault(consent_month(row), []).append(row)
+        self._pending_rows += len(rows)
+        while self._pending_rows >= self.row_group_size:
+            self._flush(max(self._pending, key=lambda month: len(self._pending[month])))
+
+    def write_table(self, month: str, table):
+        """Готовая таблица (compact)"""
+        self._writer(month).write_table(table, row_group_size=self.row_group_size)
+        self.rows += table.num_rows
+
+    def _flush(self, month: str):
+        rows = self._pending.pop(month)
+        self._pending_rows -= len(rows)
+        self.write_table(month, rows_to_table(rows))
+
+    def _writer(self, month: str):
+        if month not in self._writers:
+            directory = os.path.join(self.root, MONTH_DIR_PREFIX + month)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, self.name)
+            writer = pyarrow.parquet.ParquetWriter(
+                os.path.join(directory, '.' + self.name), analytics_schema(), compression='zstd',
+                # Уникальным id словарь не поможет
+                use_dictionary=[name for name, kind in ANALYTICS_COLUMNS if kind == 'dictionary'],
+            )
+            self._writers[month] = (path, writer)
+        return self._writers[month][1]
+
+    def close(self) -> List[str]:
+        """Дописать остаток и переименовать файлы; пути готовых файлов"""
+        for month in list(self._pending):
+            self._flush(month)
+        paths = []
+        for path, writer in self._writers.values():
+            writer.close()
+            os.replace(os.path.join(os.path.dirname(path), '.' + self.name), path)
+            paths.append(path)
+        return paths
+
+    def abort(self):
+        for path, writer in self._writers.values():
+            writer.close()
+            os.remove(os.path.join(os.path.dirname(path), '.' + self.name))
+
+
+# ========================================
+# extract и compact
+# ========================================
+
+def extract(db: TicketDatabase, root: str = CONSENT_ANALYTICS_DIR,
+            settle_delay: int = CONSENT_ANALYTICS_SETTLE_DELAY) -> int:
+    """Выгрузить записи от водяного знака до now() - settle_delay; число записей"""
+    started = time.perf_counter()
+    os.makedirs(root, exist_ok=True)
+    state = read_watermark(root)
+    removed = remove_stale_parts(root, state['created_to'])
+    if removed:
+        print(f"🧹 Удалено файлов прерванного запуска: {removed}")
+
+    created_from = state['created_to'] or db.get_first_consent_created_at()
+    created_to = datetime.now(timezone.utc) - timedelta(seconds=settle_delay)
+    if created_from is None or created_from >= created_to:
+        print("✅ Новых записей нет")
+        return 0
+
+    writer = MonthPartWriter(
+        root, f"part-{epoch_microseconds(created_from)}-{epoch_microseconds(created_to)}.parquet"
+    )
+    try:
+        for rows in db.stream_consent_analytics_rows(created_from, created_to):
+            writer.write_rows(rows)
+        paths = writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    write_watermark(root, created_to, state['rows'] + writer.rows)
+    print(
+        f"✅ Выгружено записей: {writer.rows} в {len(paths)} файл(ов) за "
+        f"{time.perf_counter() - started:.1f} с, водяной знак {created_to:%Y-%m-%d %H:%M:%S} UTC"
+    )
+    return writer.rows
+
+
+def compact(root: str = CONSENT_ANALYTICS_DIR) -> int:
+    """Объединить файлы каждого месяца в один; число объединённых месяцев"""
+    state = read_watermark(root)
+    remove_stale_parts(root, state['created_to'])
+    valid, _ = split_parts(root, state['created_to'])
+
+    by_month: Dict[str, List[str]] = {}
+    for path in valid:
+        by_month.setdefault(os.path.basename(os.path.dirname(path))[len(MONTH_DIR_PREFIX):], []).append(path)
+
+    compacted = 0
+    for month, paths in sorted(by_month.items()):
+        if len(paths) < 2:
+            continue
+        ranges = [PART_FILE_RE.match(os.path.basename(path)) for path in paths]
+        name = f"part-{min(int(r.group(1)) for r in ranges)}-{max(int(r.group(2)) for r in ranges)}.parquet"
+        writer = MonthPartWriter(root, name)
+        try:
+            batches, batch_rows = [], 0
+            for path in paths:
+                for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=writer.row_group_size):
+                    batches.append(conform_table(pyarrow.Table.from_batches([batch])))
+                    batch_rows += batch.num_rows
+                    if batch_rows >= writer.row_group_size:
+                        writer.write_table(month, pyarrow.concat_tables(batches))
+                        batches, batch_rows = [], 0
+            if batches:
+                writer.write_table(month, pyarrow.concat_tables(batches))
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        # Новый файл уже покрывает старые: если удаление прервётся,
+        # они останутся лишними (split_parts) и удалятся следующим запуском
+        for path in paths:
+            os.remove(path)
+        compacted += 1
+        print(f"📦 {month}: {len(paths)} файлов -> 1 ({writer.rows} записей)")
+
+    if not compacted:
+        print("✅ Объединять нечего")
+    return compacted
+
+
+# ========================================
+# Отчёты
+# ========================================
+
+def parse_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def load_consents(root: str, columns: List[str], date_from: Optional[datetime] = None,
+                  date_to: Optional[datetime] = None):
+    """
+    Согласия из хранилища за период [date_from, date_to) по consent_timestamp
+
+    Месяцы вне периода не читаются (фильтр по consent_month), из файлов
+    читаются только нужные колонки.
+    """
+    valid, _ = split_parts(root, read_watermark(root)['created_to'])
+    if not valid:
+        return None
+    # Схема задана явно: в файлах прошлых версий нет новых колонок (читаются пустыми)
+    dataset = pyarrow.dataset.dataset(
+        valid, format='parquet', partitioning='hive', partition_base_dir=root,
+        schema=analytics_schema().append(pyarrow.field('consent_month', pyarrow.string())),
+    )
+    field = pyarrow.dataset.field
+    conditions = []
+    if date_from:
+        conditions.append(field('consent_month') >= date_from.astimezone(timezone.utc).strftime('%Y-%m'))
+        conditions.append(field('consent_timestamp') >= pyarrow.scalar(date_from, pyarrow.timestamp('us', tz='UTC')))
+    if date_to:
+        conditions.append(field('consent_month') <= date_to.astimezone(timezone.utc).strftime('%Y-%m'))
+        conditions.append(field('consent_timestamp') < pyarrow.scalar(date_to, pyarrow.timestamp('us', tz='UTC')))
+    condition = None
+    for part in conditions:
+        condition = part if condition is None else condition & part
+    # У каждой группы строк свой словарь; группировке нужен общий
+    return dataset.to_table(columns=columns, filter=condition).unify_dictionaries()
+
+
+def _group_counts(table, keys: List[str], column: str, aggregation: str) -> Dict:
+    """{значения ключей: агрегат} (group_by без ключей - одна строка)"""
+    result = table.group_by(keys).aggregate([(column, aggregation)]).to_pydict()
+    values = result[f"{column}_{aggregation}"]
+    key_values = list(zip(*(result[key] for key in keys))) if keys else [()] * len(values)
+    return dict(zip(key_values, values))
+
+
+def funnel_report(table, by: Optional[str] = None) -> List[Dict]:
+    """
+    Воронка по сессиям: сколько сессий начали (любое согласие), какая доля
+    подтвердила каждый документ и все документы
+
+    Returns:
+        Строки отчёта (по значению by), по убыванию числа сессий
+    """
+    keys = [by] if by else []
+    given = table.filter(table['consent_given'])
+    sessions = _group_counts(table, keys, 'session_id', 'count_distinct')
+    by_document = _group_counts(given, keys + ['document_type'], 'session_id', 'count_distinct')
+    per_session = given.group_by(keys + ['session_id']).aggregate([('document_type', 'count_distinct')])
+    complete = per_session.filter(pyarrow.compute.greater_equal(
+        per_session['document_type_count_distinct'], len(ALLOWED_DOCUMENT_TYPES)
+    ))
+    completed = _group_counts(complete, keys, 'session_id', 'count')
+
+    report = []
+    for key, total in sessions.items():
+        report.append({
+            'value': key[0] if key else 'всего',
+            'sessions': total,
+            'completed': completed.get(key, 0),
+            'documents': {
+                document_type: by_document.get(key + (document_type,), 0)
+                for document_type in ALLOWED_DOCUMENT_TYPES
+            },
+        })
+    return sorted(report, key=lambda row: -row['sessions'])
+
+
+def top_report(table, by: str, limit: int) -> List[Dict]:
+    """Число согласий и сессий по значениям колонки by"""
+    result = table.group_by([by]).aggregate([
+        ('consent_log_id', 'count'), ('session_id', 'count_distinct'),
+    ]).sort_by([('consent_log_id_count', 'descending')]).slice(0, limit).to_pylist()
+    return [
+        {'value': row[by], 'consents': row['consent_log_id_count'], 'sessions': row['session_id_count_distinct']}
+        for row in result
+    ]
+
+
+def display_value(value, width: int = 60) -> str:
+    value = '-' if value is None else str(value)
+    return value if len(value) <= width else value[:width - 1] + '…'
+
+
+def print_funnel(report: List[Dict], by: Optional[str], limit: int):
+    header = f"{by or '':<60} {'сессий':>9} {'все':>7} " + ' '.join(f"{t:>15}" for t in ALLOWED_DOCUMENT_TYPES)
+    print(header)
+    print('-' * len(header))
+    for row in report[:limit]:
+        shares = [row['completed']] + [row['documents'][t] for t in ALLOWED_DOCUMENT_TYPES]
+        shares = [f"{count / row['sessions'] * 100:.1f}%" for count in shares]
+        print(
+            f"{display_value(row['value']):<60} {row['sessions']:>9} {shares[0]:>7} "
+            + ' '.join(f"{share:>15}" for share in shares[1:])
+        )
+    if len(report) > limit:
+        print(f"... ещё {len(report) - limit} значений (--limit)")
+
+
+def print_top(report: List[Dict], by: str):
+    print(f"{by:<60} {'согласий':>10} {'сессий':>9}")
+    print('-' * 81)
+    for row in report:
+        print(f"{display_value(row['value']):<60} {row['consents']:>10} {row['sessions']:>9}")
+
+
+def run_sql(root: str, query: str):
+    """Запрос DuckDB к хранилищу: таблица consents"""
+    import duckdb
+
+    valid, _ = split_parts(root, read_watermark(root)['created_to'])
+    if not valid:
+        print("❌ Хранилище пусто, сначала выполните extract")
+        exit(1)
+    connection = duckdb.connect()
+    # union_by_name: в файлах прошлых версий схемы нет новых колонок
+    connection.read_parquet(valid, hive_partitioning=True, union_by_name=True).create_view('consents')
+    connection.sql(query).show(max_rows=100, max_width=200)
+
+
+def show_status(root: str):
+    state = read_watermark(root)
+    valid, stale = split_parts(root, state['created_to'])
+    if not state['created_to']:
+        print("📭 Хранилище пусто, выполните extract")
+        return
+
+    print(f"🕒 Водяной знак: {state['created_to']:%Y-%m-%d %H:%M:%S} UTC (обновлён {state['updated_at'][:19]})")
+    months: Dict[str, List[int]] = {}
+    for path in valid:
+        metadata = pyarrow.parquet.read_metadata(path)
+        month = months.setdefault(os.path.basename(os.path.dirname(path))[len(MONTH_DIR_PREFIX):], [0, 0, 0])
+        month[0] += 1
+        month[1] += metadata.num_rows
+        month[2] += os.path.getsize(path)
+    for month, (files, rows, size) in sorted(months.items()):
+        print(f"   {month}: {rows:>10} записей, {files:>4} файл(ов), {size / 1024 / 1024:8.1f} MB")
+    total_rows = sum(m[1] for m in months.values())
+    total_size = sum(m[2] for m in months.values())
+    print(f"📊 Всего: {total_rows} записей, {len(valid)} файл(ов), {total_size / 1024 / 1024:.1f} MB")
+    if stale:
+        print(f"⚠️ Лишних файлов (прерванный запуск): {len(stale)}, удалит следующий extract")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитическое хранилище согласий (Parquet)")
+    parser.add_argument('--dir', default=CONSENT_ANALYTICS_DIR, help="каталог хранилища")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('extract', help="выгрузить новые согласия")
+    commands.add_parser('compact', help="объединить файлы каждого месяца")
+
+    for name, help_text in (('funnel', "воронка по сессиям"), ('top', "согласия по значениям колонки")):
+        report_parser = commands.add_parser(name, help=help_text)
+        report_parser.add_argument('--by', choices=REPORT_DIMENSIONS, required=name == 'top')
+        report_parser.add_argument('--date-from', type=parse_datetime, help="начало периода (ISO 8601)")
+        report_parser.add_argument('--date-to', type=parse_datetime, help="конец периода (ISO 8601, не включительно)")
+        report_parser.add_argument('--limit', type=int, default=30)
+
+    sql_parser = commands.add_parser('sql', help="запрос DuckDB к таблице consents")
+    sql_parser.add_argument('query')
+
+    commands.add_parser('status', help="водяной знак и файлы хранилища")
+
+    args = parser.parse_args()
+
+    if not PYARROW_AVAILABLE:
+        print("❌ Ошибка: нужен pyarrow (pip install pyarrow)")
+        exit(1)
+
+    if args.command == 'extract':
+        db = TicketDatabase()
+        try:
+            extract(db, args.dir)
+        finally:
+            db.close()
+    elif args.command == 'compact':
+        compact(args.dir)
+    elif args.command in ('funnel', 'top'):
+        started = time.perf_counter()
+        columns = ['consent_log_id', 'session_id', 'document_type', 'consent_given']
+        if args.by and args.by not in columns:
+            columns.append(args.by)
+        table = load_consents(args.dir, columns, args.date_from, args.date_to)
+        if table is None:
+            print("❌ Хранилище пусто, сначала выполните extract")
+            exit(1)
+        if args.command == 'funnel':
+            print_funnel(funnel_report(table, args.by), args.by, args.limit)
+        else:
+            print_top(top_report(table, args.by, args.limit), args.by)
+        print(f"\n⏱️ {table.num_rows} записей за {time.perf_counter() - started:.2f} с")
+    elif args.command == 'sql':
+        if not DUCKDB_AVAILABLE:
+            print("❌ Ошибка: для sql нужен duckdb (pip install duckdb)")
+            exit(1)
+        run_sql(args.dir, args.query)
+    else:
+        show_status(args.dir)
+
+
+if __name__ == "__main__":
+    main()
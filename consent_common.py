@@ -0,0 +1,469 @@
+"""
+Общая логика API логирования согласий
+
+Используется и синхронным Flask приложением (api.py),
+и асинхронным (api_async.py), чтобы правила валидации
+и формат записей не расходились между режимами.
+"""
+
+import os
+import re
+import uuid
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from geoip import get_ip_country
+from document_store import content_hash_for
+
+logger = logging.getLogger(__name__)
+
+# Константы
+ALLOWED_DOCUMENT_TYPES = ['ticket_terms', 'refund_policy', 'privacy_policy']
+DOCUMENT_VERSION = os.getenv("DOCUMENT_VERSION", "v2025-10-28")
+CONSENT_REQUIRED_FIELDS = [
+    'session_id', 'document_type', 'document_version',
+    'document_hash', 'consent_given', 'consent_timestamp'
+]
+SNAPSHOT_REQUIRED_FIELDS = ['document_type', 'version', 'full_text', 'language']
+ALLOWED_LANGUAGES = ['ru', 'en', 'he']
+# Язык документа, если клиент его не передал
+DEFAULT_DOCUMENT_LANGUAGE = os.getenv("DEFAULT_DOCUMENT_LANGUAGE", "ru")
+# Сверка document_version/document_hash с активной версией документа:
+# off - не сверять, warn - только писать в лог, enforce - отклонять (409)
+DOCUMENT_CHECK_MODE = os.getenv("DOCUMENT_CHECK_MODE", "warn")
+# Максимум согласий в одном batch-запросе
+CONSENT_BATCH_MAX_SIZE = int(os.getenv("CONSENT_BATCH_MAX_SIZE", "20"))
+# Максимум сессий в одном запросе массовой проверки
+VERIFY_BULK_MAX_SIZE = int(os.getenv("VERIFY_BULK_MAX_SIZE", "1000"))
+# Ключ идемпотентности клиента: поле idempotency_key или заголовок Idempotency-Key
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+# Сколько прокси перед приложением дописывают адрес в X-Forwarded-For
+# (на Render - один); 0 - заголовок не учитывается (лимиты по remote_addr)
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "1"))
+# Пространство имён UUIDv5 для consent_log_id (см. consent_log_id_for)
+CONSENT_LOG_ID_NAMESPACE = uuid.UUID('5b0c8f2e-6f1d-4c51-9a37-3d2e8b7c4a10')
+
+NoneType = type(None)
+MISSING = object()
+# Типы полей тела /api/consent (необязательные текстовые поля могут быть null)
+CONSENT_FIELD_TYPES = {
+    'session_id': str,
+    'document_type': str,
+    'document_version': str,
+    'document_hash': str,
+    'consent_given': bool,
+    'consent_timestamp': str,
+    'language': str,
+    'consent_text': (str, NoneType),
+    'user_agent': (str, NoneType),
+    'referrer': (str, NoneType),
+    'page_url': (str, NoneType),
+}
+# Типы полей тела /api/document-snapshot
+SNAPSHOT_FIELD_TYPES = {
+    'document_type': str,
+    'version': str,
+    'full_text': str,
+    'language': str,
+    'created_by': (str, NoneType),
+}
+# Канонический вид UUID (быстрая проверка session_id; другие записи
+# UUID проверяет is_valid_session_id)
+UUID_RE = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+# Названия типов JSON для сообщений об ошибках
+JSON_TYPE_NAMES = {str: 'string', bool: 'boolean', int: 'integer', float: 'number', NoneType: 'null'}
+
+
+def get_client_ip(request_obj):
+    """Получить реальный IP клиента (с учётом прокси)"""
+    # Render передаёт реальный IP в X-Forwarded-For
+    forwarded_for = request_obj.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        # Берём первый IP из цепочки (клиентский)
+        return forwarded_for.split(',')[0].strip()
+    return request_obj.remote_addr
+
+
+def get_trusted_client_ip(request_obj):
+    """
+    IP клиента для лимитов запросов: адрес, который дописал в X-Forwarded-For
+    ближайший к клиенту доверенный прокси (TRUSTED_PROXY_COUNT-й с конца).
+    Начало цепочки присылает сам клиент, поэтому новый подставной адрес
+    на каждый запрос не даёт новую корзину лимита
+    """
+    forwarded_for = request_obj.headers.get('X-Forwarded-For')
+    if TRUSTED_PROXY_COUNT <= 0 or not forwarded_for:
+        return request_obj.remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(',')]
+    # Цепочка короче ожидаемой - адрес дописал самый дальний прокси
+    return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
+
+
+def is_admin_request(request_obj):
+    """Проверить API ключ администратора"""
+    api_key = request_obj.headers.get('X-API-Key')
+    return bool(api_key) and api_key == os.getenv('ADMIN_API_KEY')
+
+
+def json_type_names(types) -> str:
+    """Тип или кортеж типов Python в виде 'string | null'"""
+    types = types if isinstance(types, tuple) else (types,)
+    return ' | '.join(JSON_TYPE_NAMES.get(t, t.__name__) for t in types)
+
+
+def compile_validator(required_fields: List[str], field_types: Dict,
+                      allowed_values: Optional[Dict[str, List]] = None) -> Callable[[object], Optional[Dict]]:
+    """
+    Собрать проверку тела запроса по схеме
+
+    Схема разбирается один раз при импорте: для корректного тела
+    это одна проверка подмножества ключей и по одному поиску типа
+    (и значения, если список допустимых задан) во frozenset на поле
+    схемы. Список недостающих полей строится только при ошибке.
+    Типы сверяются точно (type(), без подклассов): json.loads
+    возвращает только базовые типы, а bool не сойдёт за int.
+
+    Args:
+        required_fields: обязательные поля (в порядке для сообщения об ошибке)
+        field_types: поле -> тип или кортеж типов
+        allowed_values: поле -> список допустимых значений
+
+    Returns:
+        validate(data) - словарь с описанием ошибки или None
+    """
+    required = list(required_fields)
+    required_set = frozenset(required)
+    allowed_values = allowed_values or {}
+    checks = tuple(
+        (
+            field,
+            frozenset(types if isinstance(types, tuple) else (types,)),
+            json_type_names(types),
+            frozenset(allowed_values[field]) if field in allowed_values else None,
+            allowed_values.get(field),
+        )
+        for field, types in field_types.items()
+    )
+
+    def validate(data) -> Optional[Dict]:
+        if type(data) is not dict:
+            return {'error': 'Invalid JSON body, object expected'}
+
+        if not data.keys() >= required_set:
+            return {
+                'error': 'Missing required fields',
+                'missing': [field for field in required if field not in data]
+            }
+
+        get = data.get
+        for field, types, expected, allowed_set, allowed in checks:
+            value = get(field, MISSING)
+            if value is MISSING:
+                continue
+            if type(value) not in types:
+                return {
+                    'error': 'Invalid field type',
+                    'field': field,
+                    'expected': expected
+                }
+            if allowed_set is not None and value not in allowed_set:
+                return {
+                    'error': f'Invalid {field}',
+                    'allowed': allowed
+                }
+
+        return None
+
+    return validate
+
+
+# Обязательные поля, типы, тип документа и язык согласия
+validate_consent_fields = compile_validator(
+    CONSENT_REQUIRED_FIELDS, CONSENT_FIELD_TYPES,
+    {'document_type': ALLOWED_DOCUMENT_TYPES, 'language': ALLOWED_LANGUAGES}
+)
+# Обязательные поля, типы, тип и язык снимка документа (до CHECK в БД)
+validate_snapshot_fields = compile_validator(
+    SNAPSHOT_REQUIRED_FIELDS, SNAPSHOT_FIELD_TYPES,
+    {'document_type': ALLOWED_DOCUMENT_TYPES, 'language': ALLOWED_LANGUAGES}
+)
+
+
+def validate_consent_data(data) -> Optional[Dict]:
+    """
+    Проверить данные согласия
+
+    Returns:
+        Словарь с описанием ошибки или None, если данные корректны
+    """
+    validation_error = validate_consent_fields(data)
+    if validation_error:
+        return validation_error
+
+    # session_id хранится в колонке UUID - иначе запрос упадёт уже в БД
+    session_id = data['session_id']
+    if not UUID_RE.fullmatch(session_id) and not is_valid_session_id(session_id):
+        return {'error': 'Invalid session_id', 'expected': 'uuid'}
+
+    # Тип проверен схемой, формат - здесь: иначе строку отклонит уже БД
+    # (500), а в режиме write_behind - фоновая запись (dead letter)
+    if parse_consent_timestamp(data['consent_timestamp']) is None:
+        return {'error': 'Invalid consent_timestamp', 'expected': 'ISO 8601 datetime'}
+
+    if 'idempotency_key' in data:
+        return validate_idempotency_key(data['idempotency_key'])
+
+    return None
+
+
+def parse_consent_timestamp(value: str) -> Optional[datetime]:
+    """consent_timestamp клиента (ISO 8601) или None, если строка не разбирается"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+def validate_idempotency_key(idempotency_key) -> Optional[Dict]:
+    if not isinstance(idempotency_key, str) or not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return {
+            'error': 'Invalid idempotency_key',
+            'max_length': IDEMPOTENCY_KEY_MAX_LENGTH
+        }
+    return None
+
+
+def consent_log_id_for(data: Dict, idempotency_key: Optional[str] = None) -> str:
+    """
+    Детерминированный consent_log_id согласия (UUIDv5)
+
+    Повтор того же согласия получает тот же ID и отбрасывается
+    (см. consent_dedup.py). Ключ - idempotency_key клиента (в пределах
+    сессии) или session_id + document_type + document_hash + consent_timestamp.
+    """
+    idempotency_key = data.get('idempotency_key') or idempotency_key
+    if idempotency_key:
+        name = f"key:{data['session_id']}:{idempotency_key}"
+    else:
+        name = (f"consent:{data['session_id']}:{data['document_type']}:"
+                f"{data['document_hash']}:{data['consent_timestamp']}")
+    return str(uuid.uuid5(CONSENT_LOG_ID_NAMESPACE, name))
+
+
+def check_consent_document(data: Dict, active_document: Optional[Dict]) -> Optional[Dict]:
+    """
+    Сверить версию и хеш документа из согласия с активной версией
+
+    Args:
+        data: корректные (см. validate_consent_data) данные согласия
+        active_document: активная версия из DocumentCache или None
+
+    Returns:
+        Словарь с описанием расхождения, если согласие нужно отклонить
+        (только в режиме DOCUMENT_CHECK_MODE=enforce), иначе None
+    """
+    if DOCUMENT_CHECK_MODE == 'off' or active_document is None:
+        return None
+
+    mismatch = []
+    if data['document_version'] != active_document['version']:
+        mismatch.append('document_version')
+    if data['document_hash'] != active_document['content_hash']:
+        mismatch.append('document_hash')
+    if not mismatch:
+        return None
+
+    error = {
+        'error': 'Document does not match active version',
+        'mismatch': mismatch,
+        'active_version': active_document['version'],
+        'active_hash': active_document['content_hash']
+    }
+    if DOCUMENT_CHECK_MODE == 'enforce':
+        return error
+
+    logger.warning(
+        f"Consent document mismatch ({', '.join(mismatch)}): "
+        f"{data['document_type']} - session: {data['session_id']}"
+    )
+    return None
+
+
+def build_consent_log(data: Dict, request_obj, idempotency_key: Optional[str] = None) -> Dict:
+    """
+    Собрать запись consent_logs из данных клиента и технических данных запроса
+
+    idempotency_key - ключ из заголовка Idempotency-Key (поле
+    idempotency_key в данных важнее).
+    """
+    # Получаем технические данные
+    client_ip = get_client_ip(request_obj)
+    client_ip_forwarded = request_obj.headers.get('X-Forwarded-For')
+    ip_country = get_ip_country(client_ip)
+
+    return {
+        'consent_log_id': consent_log_id_for(data, idempotency_key),
+        'session_id': data['session_id'],
+        'document_type': data['document_type'],
+        'document_version': data['document_version'],
+        'document_hash': data['document_hash'],
+        'document_language': data.get('language', DEFAULT_DOCUMENT_LANGUAGE),
+        'consent_given': data['consent_given'],
+        # В БД - в каноническом виде: формы ISO 8601, которые понимает Python,
+        # PostgreSQL принимает не все (consent_log_id - от исходной строки)
+        'consent_timestamp': parse_consent_timestamp(data['consent_timestamp']).isoformat(),
+        'consent_text': data.get('consent_text', f"Я согласен с {data['document_type']}"),
+        'client_ip': client_ip,
+        'client_ip_forwarded': client_ip_forwarded,
+        'user_agent': data.get('user_agent', request_obj.headers.get('User-Agent')),
+        'ip_country': ip_country,
+        'referrer_url': data.get('referrer'),
+        'page_url': data.get('page_url')
+    }
+
+
+def prepare_consent_batch(data, request_obj,
+                          get_active_document: Optional[Callable] = None
+                          ) -> Tuple[Optional[Dict], List, List[int], List[Dict]]:
+    """
+    Разобрать тело batch-запроса
+
+    get_active_document(document_type, language) - источник активных
+    версий для check_consent_document (например, DocumentCache.get).
+
+    Returns:
+        (ошибка запроса целиком или None,
+         список результатов по элементам (None для корректных),
+         индексы корректных элементов,
+         записи consent_logs для корректных элементов)
+    """
+    consents = data.get('consents') if isinstance(data, dict) else None
+    if not isinstance(consents, list) or not consents:
+        return {
+            'error': 'Invalid JSON body, non-empty "consents" array expected'
+        }, [], [], []
+
+    if len(consents) > CONSENT_BATCH_MAX_SIZE:
+        return {
+            'error': 'Batch too large',
+            'max_size': CONSENT_BATCH_MAX_SIZE
+        }, [], [], []
+
+    results = [None] * len(consents)
+    valid_indexes = []
+    consent_logs = []
+
+    for index, item in enumerate(consents):
+        validation_error = validate_consent_data(item)
+        if not validation_error and get_active_document:
+            validation_error = check_consent_document(item, get_active_document(
+                item['document_type'], item.get('language', DEFAULT_DOCUMENT_LANGUAGE)
+            ))
+        if validation_error:
+            results[index] = {'index': index, **validation_error}
+        else:
+            valid_indexes.append(index)
+            consent_logs.append(build_consent_log(item, request_obj))
+
+    return None, results, valid_indexes, consent_logs
+
+
+def consent_batch_status(saved: int, total: int, queued: bool = False) -> int:
+    """HTTP статус ответа batch-запроса"""
+    if not saved:
+        return 400
+    if saved < total:
+        return 207
+    return 202 if queued else 201
+
+
+def build_consent_status(session_id: str, status: Dict) -> Dict:
+    """
+    Ответ /api/consent/verify по сводному статусу сессии
+
+    Args:
+        status: результат TicketDatabase.get_session_consent_status
+    """
+    return {
+        'session_id': session_id,
+        'all_consents_given': all(status['consents'].values()),
+        'consents': status['consents'],
+        'total_logged': status['total_logged']
+    }
+
+
+def is_valid_session_id(session_id) -> bool:
+    """session_id должен быть UUID (как в consent_logs)"""
+    try:
+        uuid.UUID(str(session_id))
+        return True
+    except ValueError:
+        return False
+
+
+def prepare_bulk_verify(data) -> Tuple[Optional[Dict], List[str], List]:
+    """
+    Разобрать тело запроса массовой проверки согласий
+
+    Returns:
+        (ошибка запроса целиком или None,
+         корректные session_id (без повторов, в исходном порядке),
+         некорректные session_id)
+    """
+    session_ids = data.get('session_ids') if isinstance(data, dict) else None
+    if not isinstance(session_ids, list) or not session_ids:
+        return {
+            'error': 'Invalid JSON body, non-empty "session_ids" array expected'
+        }, [], []
+
+    if len(session_ids) > VERIFY_BULK_MAX_SIZE:
+        return {
+            'error': 'Too many session_ids',
+            'max_size': VERIFY_BULK_MAX_SIZE
+        }, [], []
+
+    valid = []
+    invalid = []
+    for session_id in session_ids:
+        if is_valid_session_id(session_id):
+            valid.append(str(uuid.UUID(str(session_id))))
+        else:
+            invalid.append(session_id)
+
+    return None, list(dict.fromkeys(valid)), invalid
+
+
+def active_document_summary(document: Dict, full_text: Optional[str] = None) -> Dict:
+    """Описание активной версии документа для ответа API (с текстом, если передан)"""
+    summary = {
+        'document_type': document['document_type'],
+        'language': document['language'],
+        'version': document['version'],
+        'content_hash': document['content_hash']
+    }
+    if full_text is not None:
+        summary['full_text'] = full_text
+    return summary
+
+
+def validate_snapshot_data(data) -> Optional[Dict]:
+    """
+    Проверить данные snapshot документа
+
+    Returns:
+        Словарь с описанием ошибки или None, если данные корректны
+    """
+    return validate_snapshot_fields(data)
+
+
+def build_document_snapshot(data: Dict) -> Dict:
+    """Собрать запись document_snapshots (с SHA-256 хешем текста - его адресом в document_blobs)"""
+    return {
+        'document_type': data['document_type'],
+        'version': data['version'],
+        'content_hash': content_hash_for(data['full_text']),
+        'full_text': data['full_text'],
+        'language': data['language'],
+        'created_by': data.get('created_by', 'api')
+    }
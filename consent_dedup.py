@@ -0,0 +1,107 @@
+"""
+Отсев повторных согласий
+
+JS логгер повторяет запрос при сетевых ошибках, пользователи кликают
+дважды. Каждое согласие получает детерминированный consent_log_id
+(consent_common.consent_log_id_for): по ключу идемпотентности клиента
+или по session_id + document_type + document_hash + consent_timestamp.
+Повтор отбрасывается:
+- в памяти воркера - по недавно сохранённым ID (RecentConsentIds),
+  без обращения к БД;
+- в БД - перед вставкой, по первичному ключу consent_logs: запись с тем
+  же consent_log_id и временем в пределах CONSENT_DEDUP_WINDOW (ретрай
+  с другим временем клиента попадает в ту же или соседнюю партицию);
+  вставки одного ID идут по очереди под advisory lock.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Сколько недавних ID согласий помнит каждый воркер
+CONSENT_DEDUP_CACHE_SIZE = int(os.getenv("CONSENT_DEDUP_CACHE_SIZE", "20000"))
+# Сколько секунд ID считается недавним (повторы обычно приходят в течение минут)
+CONSENT_DEDUP_TTL = float(os.getenv("CONSENT_DEDUP_TTL", "900"))
+
+
+class RecentConsentIds:
+    """Ограниченный LRU недавно сохранённых consent_log_id (потокобезопасный)"""
+
+    def __init__(self, max_size: int = CONSENT_DEDUP_CACHE_SIZE, ttl: float = CONSENT_DEDUP_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expires_at: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, consent_log_id: str) -> bool:
+        with self._lock:
+            expires_at = self._expires_at.get(consent_log_id)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                del self._expires_at[consent_log_id]
+                return False
+            return True
+
+    def add_many(self, consent_log_ids: List[str]):
+        """Запомнить ID после успешной записи (в БД или в spool очереди)"""
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for consent_log_id in consent_log_ids:
+                self._expires_at[consent_log_id] = expires_at
+                self._expires_at.move_to_end(consent_log_id)
+            while len(self._expires_at) > self.max_size:
+                self._expires_at.popitem(last=False)
+
+    def add(self, consent_log_id: str):
+        self.add_many([consent_log_id])
+
+
+def skip_recent_duplicates(recent: RecentConsentIds, results: List, valid_indexes: List[int],
+                           consent_logs: List[Dict]) -> Tuple[List[int], List[Dict]]:
+    """
+    Отметить в results batch-запроса недавние повторы
+
+    Returns:
+        (индексы, записи consent_logs) - только то, что нужно сохранить
+    """
+    new_indexes = []
+    new_consent_logs = []
+    for index, consent_log in zip(valid_indexes, consent_logs):
+        if consent_log['consent_log_id'] in recent:
+            results[index] = {'index': index, 'consent_log_id': consent_log['consent_log_id'], 'duplicate': True}
+        else:
+            new_indexes.append(index)
+            new_consent_logs.append(consent_log)
+    return new_indexes, new_consent_logs
+
+
+def mark_saved_consents(results: List, indexes: List[int], consent_logs: List[Dict],
+                        created_ids: Optional[List[str]] = None) -> int:
+    """
+    Записать в results batch-запроса сохранённые согласия
+
+    created_ids - ID, которые действительно вставила БД (create_consent_logs);
+    остальные записи - повторы уже сохранённых согласий. None - записи
+    поставлены в очередь, повторы отсеет фоновая запись.
+
+    Returns:
+        число повторов, найденных в БД
+    """
+    created = set(created_ids) if created_ids is not None else None
+    duplicates = 0
+    for index, consent_log in zip(indexes, consent_logs):
+        results[index] = {'index': index, 'consent_log_id': consent_log['consent_log_id']}
+        if created is None:
+            continue
+        if consent_log['consent_log_id'] in created:
+            # Повтор внутри той же пачки сохранён один раз - первым элементом
+            created.discard(consent_log['consent_log_id'])
+        else:
+            results[index]['duplicate'] = True
+            duplicates += 1
+    return duplicates
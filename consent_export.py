@@ -0,0 +1,295 @@
+"""
+Выгрузка согласий для аудита
+
+Согласия выгружаются вместе с версией документа, с которой согласился
+пользователь (document_snapshots), в форматах:
+- ndjson  - одна JSON запись на строку;
+- csv     - через COPY TO STDOUT (быстрее всего);
+- parquet - нужен pyarrow (pip install pyarrow).
+
+Строки читаются из PostgreSQL пачками (server-side курсор / COPY) и сразу
+отдаются дальше, поэтому память не зависит от размера выгрузки.
+
+Используется endpoint /api/admin/consents/export (api.py, api_async.py)
+и командой:
+    python consent_export.py --format csv --gzip --date-from 2025-01-01 --date-to 2025-02-01 -o consents.csv.gz
+"""
+
+import io
+import json
+import zlib
+import argparse
+import importlib.util
+from datetime import date, datetime
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from consent_common import ALLOWED_DOCUMENT_TYPES, DEFAULT_DOCUMENT_LANGUAGE, is_valid_session_id
+from database_tickets import TicketDatabase, consent_export_query
+
+# Формат -> (Content-Type, расширение файла)
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+# Колонки выгрузки (порядок EXPORT_CONSENTS_SQL, snapshot_text - последняя)
+EXPORT_COLUMNS = [
+    'consent_log_id', 'session_id', 'purchase_id',
+    'document_type', 'document_version', 'document_hash', 'document_language',
+    'consent_given', 'consent_text', 'consent_timestamp',
+    'client_ip', 'client_ip_forwarded', 'user_agent', 'ip_country',
+    'referrer_url', 'page_url', 'created_at',
+    'snapshot_id', 'snapshot_hash', 'snapshot_hash_matches', 'snapshot_text',
+]
+# Остальные колонки в Parquet - строки
+EXPORT_BOOL_COLUMNS = ['consent_given', 'snapshot_hash_matches']
+EXPORT_TIME_COLUMNS = ['consent_timestamp', 'created_at']
+
+TRUE_VALUES = ('1', 'true', 'yes')
+
+# pyarrow импортируется долго (десятки мс на воркер), поэтому
+# загружается только при первой выгрузке в Parquet
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+
+def parse_export_params(args) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Разобрать параметры выгрузки (request.args или словарь)
+
+    Returns:
+        (ошибка или None, параметры выгрузки для iter_consent_export)
+    """
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return {'error': 'Invalid format', 'allowed': list(EXPORT_FORMATS)}, None
+    if export_format == 'parquet' and not PYARROW_AVAILABLE:
+        return {'error': 'Parquet export requires pyarrow'}, None
+
+    filters = {}
+    for field in ('date_from', 'date_to'):
+        value = args.get(field)
+        if value:
+            try:
+                datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                return {'error': f'Invalid {field}, ISO 8601 date expected'}, None
+            filters[field] = value
+
+    document_type = args.get('document_type')
+    if document_type:
+        if document_type not in ALLOWED_DOCUMENT_TYPES:
+            return {'error': 'Invalid document_type', 'allowed': ALLOWED_DOCUMENT_TYPES}, None
+        filters['document_type'] = document_type
+
+    session_id = args.get('session_id')
+    if session_id:
+        if not is_valid_session_id(session_id):
+            return {'error': 'Invalid session_id, UUID expected'}, None
+        filters['session_id'] = session_id
+
+    return None, {
+        'format': export_format,
+        # Parquet сжимается сам (по колонкам), gzip поверх не нужен
+        'gzip': export_format != 'parquet' and str(args.get('gzip', '')).lower() in TRUE_VALUES,
+        'include_text': str(args.get('include_text', 'true')).lower() in TRUE_VALUES,
+        'filters': filters,
+    }
+
+
+def export_content_type(options: Dict) -> str:
+    return 'application/gzip' if options['gzip'] else EXPORT_FORMATS[options['format']][0]
+
+
+def export_filename(options: Dict) -> str:
+    """Имя файла выгрузки, например consents_2025-01-01_2025-02-01.csv.gz"""
+    filters = options['filters']
+    parts = ['consents']
+    if filters.get('date_from') or filters.get('date_to'):
+        parts.append(filters.get('date_from', '')[:10] or 'start')
+        parts.append(filters.get('date_to', '')[:10] or 'now')
+    name = '_'.join(parts) + '.' + EXPORT_FORMATS[options['format']][1]
+    return name + '.gz' if options['gzip'] else name
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файл, накапливающий записанные байты до следующего drain()"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ConsentExportEncoder:
+    """
+    Кодирует строки выгрузки в байты выбранного формата (с gzip по желанию)
+
+    encode_rows - для пачек строк из stream_consent_export,
+    encode_raw - для готового CSV из stream_consent_export_csv,
+    finish - хвост файла (футер Parquet, конец gzip потока).
+    """
+
+    def __init__(self, export_format: str, compress: bool = False, include_text: bool = True):
+        self.format = export_format
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self._parquet_sink = None
+        self._parquet_writer = None
+        if export_format == 'parquet':
+            import pyarrow.parquet
+            self._parquet_sink = _ChunkSink()
+            self._parquet_schema = parquet_schema(include_text)
+            self._parquet_writer = pyarrow.parquet.ParquetWriter(
+                pyarrow.PythonFile(self._parquet_sink, mode='w'),
+                self._parquet_schema,
+                compression='zstd'
+            )
+
+    def encode_rows(self, rows: List[Dict]) -> bytes:
+        if self.format == 'parquet':
+            import pyarrow
+            columns = {
+                name: [row[name] for row in rows]
+                if name in EXPORT_BOOL_COLUMNS or name in EXPORT_TIME_COLUMNS
+                else [None if row[name] is None else str(row[name]) for row in rows]
+                for name in self._parquet_schema.names
+            }
+            self._parquet_writer.write_table(pyarrow.table(columns, schema=self._parquet_schema))
+            return self._parquet_sink.drain()
+
+        lines = [json.dumps(row, ensure_ascii=False, default=json_default) for row in rows]
+        return self._compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def encode_raw(self, chunk: bytes) -> bytes:
+        return self._compress(chunk)
+
+    def finish(self) -> bytes:
+        if self._parquet_writer:
+            self._parquet_writer.close()
+            return self._parquet_sink.drain()
+        if self._compressor:
+            return self._compressor.flush()
+        return b''
+
+    def _compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) if self._compressor else data
+
+
+def parquet_schema(include_text: bool):
+    """Схема Parquet для колонок EXPORT_COLUMNS"""
+    import pyarrow
+    columns = EXPORT_COLUMNS if include_text else EXPORT_COLUMNS[:-1]
+    fields = []
+    for name in columns:
+        if name in EXPORT_BOOL_COLUMNS:
+            fields.append((name, pyarrow.bool_()))
+        elif name in EXPORT_TIME_COLUMNS:
+            fields.append((name, pyarrow.timestamp('us', tz='UTC')))
+        else:
+            fields.append((name, pyarrow.string()))
+    return pyarrow.schema(fields)
+
+
+def _export_query(options: Dict) -> Tuple[str, List]:
+    return consent_export_query(
+        DEFAULT_DOCUMENT_LANGUAGE,
+        include_text=options['include_text'],
+        **options['filters']
+    )
+
+
+def iter_consent_export(db, options: Dict) -> Iterator[bytes]:
+    """Поток байтов выгрузки (TicketDatabase)"""
+    query, params = _export_query(options)
+    encoder = ConsentExportEncoder(options['format'], options['gzip'], options['include_text'])
+
+    if options['format'] == 'csv':
+        for chunk in db.stream_consent_export_csv(query, params, with_texts=options['include_text']):
+            yield encoder.encode_raw(chunk)
+    else:
+        for rows in db.stream_consent_export(query, params, with_texts=options['include_text']):
+            yield encoder.encode_rows(rows)
+
+    yield encoder.finish()
+
+
+async def aiter_consent_export(db, options: Dict) -> AsyncIterator[bytes]:
+    """Поток байтов выгрузки (AsyncTicketDatabase)"""
+    query, params = _export_query(options)
+    encoder = ConsentExportEncoder(options['format'], options['gzip'], options['include_text'])
+
+    if options['format'] == 'csv':
+        async for chunk in db.stream_consent_export_csv(query, params, with_texts=options['include_text']):
+            yield encoder.encode_raw(chunk)
+    else:
+        async for rows in db.stream_consent_export(query, params, with_texts=options['include_text']):
+            yield encoder.encode_rows(rows)
+
+    yield encoder.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка согласий для аудита")
+    parser.add_argument('--format', default='ndjson', choices=list(EXPORT_FORMATS))
+    parser.add_argument('--gzip', action='store_true', help="сжать ndjson/csv")
+    parser.add_argument('--date-from', help="начало периода (ISO 8601, включительно)")
+    parser.add_argument('--date-to', help="конец периода (ISO 8601, не включительно)")
+    parser.add_argument('--document-type', choices=ALLOWED_DOCUMENT_TYPES)
+    parser.add_argument('--session-id')
+    parser.add_argument('--no-text', action='store_true', help="без полного текста документа")
+    parser.add_argument('-o', '--output', help="файл (по умолчанию имя по периоду)")
+    args = parser.parse_args()
+
+    export_error, options = parse_export_params({
+        'format': args.format,
+        'gzip': str(args.gzip),
+        'include_text': str(not args.no_text),
+        'date_from': args.date_from,
+        'date_to': args.date_to,
+        'document_type': args.document_type,
+        'session_id': args.session_id,
+    })
+    if export_error:
+        print(f"❌ Ошибка: {export_error['error']}")
+        exit(1)
+
+    output = args.output or export_filename(options)
+    db = TicketDatabase()
+    try:
+        size = 0
+        with open(output, 'wb') as f:
+            for chunk in iter_consent_export(db, options):
+                f.write(chunk)
+                size += len(chunk)
+        print(f"✅ Выгрузка сохранена: {output} ({size / 1024 / 1024:.1f} MB)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Журнал целостности согласий (tamper-evident)
+
+Согласия - юридические доказательства, поэтому их незаметное изменение
+должно обнаруживаться:
+- хеш записи (consent_logs.record_hash) - SHA-256 её полей
+  (CONSENT_LEDGER_FIELDS), считается триггером при INSERT; записи
+  хешируются независимо друг от друга, поэтому параллельные вставки
+  не ждут друг друга (нет общего "предыдущего хеша");
+- блок - записи с created_at в [block_start, block_end) (по умолчанию
+  час); его корень дерева Меркла по хешам записей и хеш предыдущего
+  блока образуют block_hash, так что блоки - одна цепочка;
+- seal запечатывает закрытые блоки (старше CONSENT_LEDGER_SEAL_DELAY,
+  чтобы успели завершиться все транзакции с таким created_at) и
+  печатает последний block_hash - контрольную точку: сохраните её вне
+  БД, и подмену всей цепочки тоже будет видно;
+- verify пересчитывает хеши всех записей по их текущим полям, корни
+  блоков и цепочку; записи читаются потоком, по диапазонам из
+  нескольких блоков в отдельных процессах.
+
+Текст записи для хеша: поля подряд, каждое как '<длина>:<значение>'
+(NULL - '-'), время - микросекунды от 1970-01-01 UTC, bool - '1'/'0'.
+Дерево Меркла: лист sha256(0x00 || record_hash), узел
+sha256(0x01 || левый || правый), непарный узел поднимается как есть.
+block_hash = sha256("prev_hash:block_start_us:block_end_us:row_count:merkle_root").
+
+Команды:
+    python consent_ledger.py seal
+        запечатать закрытые блоки (по расписанию, например Render Cron Job
+        раз в час); при первом запуске проставляет хеши старым записям
+    python consent_ledger.py verify [--date-from 2025-01-01] [--date-to 2026-01-01] [--processes 4]
+        проверить записи, блоки и цепочку (код выхода 1, если есть нарушения)
+    python consent_ledger.py status
+        последний блок и контрольная точка
+
+Архивированные партиции (consent_partitions.py archive) из БД удалены -
+проверяйте период после них (--date-from); в архивах record_hash сохранён.
+"""
+
+import os
+import time
+import hashlib
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database_tickets import TicketDatabase, CONSENT_LEDGER_FIELDS
+
+# Длина блока журнала (минуты); хранится в каждом блоке, менять можно в любой момент
+CONSENT_LEDGER_BLOCK_MINUTES = int(os.getenv("CONSENT_LEDGER_BLOCK_MINUTES", "60"))
+# Блок запечатывается не раньше, чем через столько секунд после его конца
+CONSENT_LEDGER_SEAL_DELAY = int(os.getenv("CONSENT_LEDGER_SEAL_DELAY", "900"))
+# Сколько блоков проверяет один процесс verify за раз
+CONSENT_LEDGER_VERIFY_SPAN = int(os.getenv("CONSENT_LEDGER_VERIFY_SPAN", "24"))
+# Сколько нарушений показывать подробно
+CONSENT_LEDGER_MAX_REPORTED = 50
+
+GENESIS_HASH = '0' * 64
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+EMPTY_MERKLE_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def epoch_microseconds(value: datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def ledger_field(value, kind: str) -> str:
+    """Поле в тексте записи (как consent_ledger_field в SQL)"""
+    if value is None:
+        return '-'
+    if kind == 'timestamp':
+        value = str(epoch_microseconds(value))
+    elif kind == 'bool':
+        value = '1' if value else '0'
+    else:
+        value = str(value)
+    return f"{len(value)}:{value}"
+
+
+def record_hash(row: Dict) -> bytes:
+    """SHA-256 записи consent_logs по её полям (как consent_record_hash в SQL)"""
+    text = ''.join(ledger_field(row[column], kind) for column, kind in CONSENT_LEDGER_FIELDS)
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def merkle_root(record_hashes: List[bytes]) -> str:
+    """Корень дерева Меркла по хешам записей блока (hex)"""
+    if not record_hashes:
+        return EMPTY_MERKLE_ROOT
+    sha256 = hashlib.sha256
+    level = [sha256(b'\x00' + leaf).digest() for leaf in record_hashes]
+    while len(level) > 1:
+        parents = [sha256(b'\x01' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0].hex()
+
+
+def ledger_block_hash(prev_hash: str, block_start: datetime, block_end: datetime,
+                      row_count: int, root: str) -> str:
+    text = f"{prev_hash}:{epoch_microseconds(block_start)}:{epoch_microseconds(block_end)}:{row_count}:{root}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def build_ledger_block(prev_hash: str, block_start: datetime, block_end: datetime,
+                       record_hashes: List[bytes]) -> Dict:
+    root = merkle_root(record_hashes)
+    return {
+        'block_start': block_start,
+        'block_end': block_end,
+        'row_count': len(record_hashes),
+        'merkle_root': root,
+        'prev_hash': prev_hash,
+        'block_hash': ledger_block_hash(prev_hash, block_start, block_end, len(record_hashes), root),
+    }
+
+
+def block_floor(value: datetime, minutes: int) -> datetime:
+    """Начало блока длиной minutes, в который попадает value"""
+    size = minutes * 60 * 1_000_000
+    return EPOCH + MICROSECOND * (epoch_microseconds(value) // size * size)
+
+
+# ========================================
+# seal
+# ========================================
+
+def seal(db: TicketDatabase, block_minutes: int = CONSENT_LEDGER_BLOCK_MINUTES,
+         seal_delay: int = CONSENT_LEDGER_SEAL_DELAY) -> Optional[Dict]:
+    """
+    Запечатать все закрытые блоки
+
+    Returns:
+        Последний блок журнала (None, если записей ещё нет)
+    """
+    started = time.perf_counter()
+    sealed = rows = 0
+    seal_until = datetime.now(timezone.utc) - timedelta(seconds=seal_delay)
+    block_size = timedelta(minutes=block_minutes)
+
+    last = db.get_last_consent_ledger_block()
+    while True:
+        if last:
+            block_start, prev_hash = last['block_end'], last['block_hash']
+        else:
+            first_created_at = db.get_first_consent_created_at()
+            if first_created_at is None:
+                print("✅ Записей согласий нет, запечатывать нечего")
+                return None
+            block_start, prev_hash = block_floor(first_created_at, block_minutes), GENESIS_HASH
+
+        block_end = block_start + block_size
+        if block_end > seal_until:
+            break
+
+        block = build_ledger_block(prev_hash, block_start, block_end,
+                                   db.get_consent_record_hashes(block_start, block_end))
+        if db.add_consent_ledger_block(block, GENESIS_HASH):
+            last = block
+            sealed += 1
+            rows += block['row_count']
+        else:
+            # Блок добавил параллельный seal - продолжаем от нового конца цепочки
+            last = db.get_last_consent_ledger_block()
+
+    if sealed:
+        print(f"✅ Запечатано блоков: {sealed} ({rows} записей) за {time.perf_counter() - started:.1f} с")
+    else:
+        print("✅ Новых закрытых блоков нет")
+    print_checkpoint(last)
+    return last
+
+
+def print_checkpoint(block: Optional[Dict]):
+    if block:
+        print(f"🔏 Контрольная точка: {block['block_end']:%Y-%m-%d %H:%M} UTC  {block['block_hash']}")
+
+
+# ========================================
+# verify
+# ========================================
+
+_worker_db: Optional[TicketDatabase] = None
+
+
+def _init_verify_worker():
+    global _worker_db
+    _worker_db = TicketDatabase()
+
+
+def verify_span(blocks: List[Tuple[datetime, datetime]]) -> List[Dict]:
+    """
+    Пересчитать хеши записей и корни для подряд идущих блоков
+
+    Выполняется в процессе verify: читает записи одним запросом
+    на весь диапазон.
+
+    Returns:
+        [{'block_start', 'row_count', 'merkle_root', 'bad_records': [(consent_log_id, причина)]}]
+    """
+    results = [
+        {'block_start': block_start, 'block_end': block_end, 'hashes': [], 'bad_records': []}
+        for block_start, block_end in blocks
+    ]
+    index = 0
+    for rows in _worker_db.stream_consent_ledger_rows(blocks[0][0], blocks[-1][1]):
+        for row in rows:
+            while row['created_at'] >= results[index]['block_end']:
+                index += 1
+            result = results[index]
+            computed = record_hash(row)
+            stored = row['record_hash']
+            if stored is None:
+                result['bad_records'].append((str(row['consent_log_id']), 'нет record_hash'))
+            elif bytes(stored) != computed:
+                result['bad_records'].append((str(row['consent_log_id']), 'поля изменены'))
+            result['hashes'].append(computed)
+
+    return [
+        {
+            'block_start': result['block_start'],
+            'row_count': len(result['hashes']),
+            'merkle_root': merkle_root(result['hashes']),
+            'bad_records': result['bad_records'],
+        }
+        for result in results
+    ]
+
+
+def verify_chain(blocks: List[Dict]) -> List[str]:
+    """Нарушения цепочки блоков (пусто, если цепочка цела)"""
+    problems = []
+    prev_hash, prev_end = GENESIS_HASH, None
+    for block in blocks:
+        name = f"блок {block['block_start']:%Y-%m-%d %H:%M}"
+        if block['prev_hash'] != prev_hash:
+            problems.append(f"{name}: prev_hash не совпадает с хешем предыдущего блока")
+        if prev_end is not None and block['block_start'] != prev_end:
+            problems.append(f"{name}: разрыв цепочки после {prev_end:%Y-%m-%d %H:%M}")
+        expected = ledger_block_hash(block['prev_hash'], block['block_start'], block['block_end'],
+                                     block['row_count'], block['merkle_root'])
+        if block['block_hash'] != expected:
+            problems.append(f"{name}: block_hash не соответствует содержимому блока")
+        prev_hash, prev_end = block['block_hash'], block['block_end']
+    return problems
+
+
+def verify_spans(blocks: List[Dict], span: int) -> Iterator[List[Tuple[datetime, datetime]]]:
+    for i in range(0, len(blocks), span):
+        yield [(block['block_start'], block['block_end']) for block in blocks[i:i + span]]
+
+
+def verify(db: TicketDatabase, date_from: Optional[datetime], date_to: Optional[datetime],
+           processes: int, checkpoint: Optional[str] = None) -> bool:
+    """Проверить журнал; True, если нарушений нет"""
+    started = time.perf_counter()
+    blocks = db.get_consent_ledger_blocks()
+    if not blocks:
+        print("⚠️ Журнал пуст: сначала python consent_ledger.py seal")
+        return False
+
+    problems = verify_chain(blocks)
+    if checkpoint and checkpoint not in {block['block_hash'] for block in blocks}:
+        problems.append(f"контрольная точка {checkpoint} не найдена в цепочке")
+    if date_from is None:
+        # Запись "задним числом" раньше первого блока не попала бы ни в один блок
+        outside = db.count_consents_created_before(blocks[0]['block_start'])
+        if outside:
+            problems.append(f"{outside} записей созданы раньше первого блока журнала")
+
+    selected = [
+        block for block in blocks
+        if (date_from is None or block['block_end'] > date_from)
+        and (date_to is None or block['block_start'] < date_to)
+    ]
+    by_start = {block['block_start']: block for block in selected}
+    rows = 0
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer=_init_verify_worker) as pool:
+        for results in pool.imap_unordered(verify_span, verify_spans(selected, CONSENT_LEDGER_VERIFY_SPAN)):
+            for result in results:
+                block = by_start[result['block_start']]
+                name = f"блок {block['block_start']:%Y-%m-%d %H:%M}"
+                rows += result['row_count']
+                if result['row_count'] != block['row_count']:
+                    problems.append(f"{name}: записей {result['row_count']}, при запечатывании было {block['row_count']}")
+                if result['merkle_root'] != block['merkle_root']:
+                    problems.append(f"{name}: корень дерева Меркла не совпадает")
+                for consent_log_id, reason in result['bad_records']:
+                    problems.append(f"{name}: запись {consent_log_id} - {reason}")
+
+    elapsed = time.perf_counter() - started
+    print(f"📊 Проверено блоков: {len(selected)} из {len(blocks)}, записей: {rows} "
+          f"за {elapsed:.1f} с ({rows / elapsed:,.0f} записей/с, процессов: {processes})")
+    print_checkpoint(blocks[-1])
+
+    if problems:
+        print(f"❌ Нарушений: {len(problems)}")
+        for problem in problems[:CONSENT_LEDGER_MAX_REPORTED]:
+            print(f"   {problem}")
+        if len(problems) > CONSENT_LEDGER_MAX_REPORTED:
+            print(f"   ... и ещё {len(problems) - CONSENT_LEDGER_MAX_REPORTED}")
+        return False
+
+    print("✅ Записи, блоки и цепочка целы")
+    return True
+
+
+def show_status(db: TicketDatabase):
+    last = db.get_last_consent_ledger_block()
+    if not last:
+        print("⚠️ Журнал пуст: python consent_ledger.py seal")
+        return
+    lag = datetime.now(timezone.utc) - last['block_end']
+    print(f"📒 Запечатано до {last['block_end']:%Y-%m-%d %H:%M} UTC "
+          f"({lag.total_seconds() / 3600:.1f} ч назад), последний блок: {last['row_count']} записей, "
+          f"запечатан {last['sealed_at']:%Y-%m-%d %H:%M}")
+    print_checkpoint(last)
+
+
+def parse_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Журнал целостности согласий")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('seal', help="запечатать закрытые блоки")
+
+    verify_parser = commands.add_parser('verify', help="проверить записи, блоки и цепочку")
+    verify_parser.add_argument('--date-from', type=parse_datetime, help="начало периода (ISO 8601)")
+    verify_parser.add_argument('--date-to', type=parse_datetime, help="конец периода (ISO 8601, не включительно)")
+    verify_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    verify_parser.add_argument('--checkpoint', help="сохранённый ранее block_hash, который должен быть в цепочке")
+
+    commands.add_parser('status', help="последний блок и контрольная точка")
+
+    args = parser.parse_args()
+    db = TicketDatabase()
+
+    try:
+        if args.command == 'seal':
+            seal(db)
+        elif args.command == 'verify':
+            if not verify(db, args.date_from, args.date_to, max(1, args.processes), args.checkpoint):
+                exit(1)
+        else:
+            show_status(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
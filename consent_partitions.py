@@ -0,0 +1,236 @@
+"""
+Обслуживание партиций consent_logs
+
+consent_logs разбита на помесячные партиции по consent_timestamp
+(consent_logs_YYYY_MM), записи до перехода на партиционирование лежат
+в consent_logs_legacy, записи вне созданных месяцев - в consent_logs_default.
+
+Команды:
+    python consent_partitions.py ensure [--months-ahead 3]
+        создать партиции на ближайшие месяцы (запускать по расписанию,
+        например Render Cron Job раз в неделю)
+    python consent_partitions.py list
+        показать партиции, их границы и размер
+    python consent_partitions.py archive [--older-than-months 36] [--dir consent_archive] [--drop]
+        отсоединить партиции старше срока хранения в БД и выгрузить
+        каждую в <dir>/<партиция>.csv.gz (+ .sha256); с --drop после
+        успешной выгрузки таблица удаляется; отсоединённые ранее таблицы
+        берутся, только если их граница (COMMENT, оставленный archive,
+        или имя consent_logs_YYYY_MM) раньше срока хранения
+
+Архивы - юридические доказательства согласий: храните их вне Render
+(S3 и т.п.). Сводка consent_session_status при архивации не меняется.
+"""
+
+import os
+import re
+import gzip
+import hashlib
+import argparse
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database_tickets import TicketDatabase, CONSENT_PARTITIONS_AHEAD
+
+# Сколько месяцев записи хранятся в БД до архивации
+CONSENT_RETENTION_MONTHS = int(os.getenv("CONSENT_RETENTION_MONTHS", "36"))
+# Куда складывать архивы отсоединённых партиций
+CONSENT_ARCHIVE_DIR = os.getenv("CONSENT_ARCHIVE_DIR", "consent_archive")
+
+PARTITION_UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+# Имя помесячной партиции (ensure_consent_partitions)
+MONTHLY_PARTITION_RE = re.compile(r"^consent_logs_(\d{4})_(\d{2})$")
+# COMMENT отсоединённой таблицы: граница, с которой archive её отсоединил
+DETACHED_COMMENT_PREFIX = "detached from consent_logs: "
+
+SELECT_TABLE_COLUMNS_SQL = """
+    SELECT attname AS column_name
+    FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    ORDER BY attnum
+"""
+
+
+def partition_upper_bound(bound: Optional[str]) -> Optional[datetime]:
+    """Верхняя граница партиции из pg_get_expr(relpartbound) (None для DEFAULT и отсоединённых)"""
+    match = PARTITION_UPPER_BOUND_RE.search(bound or '')
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+def detached_upper_bound(partition: Dict) -> Optional[datetime]:
+    """
+    Верхняя граница отсоединённой таблицы: из COMMENT, оставленного
+    archive при отсоединении, иначе из имени помесячной партиции
+    (None - таблица не похожа на отсоединённую партицию)
+    """
+    description = partition['description'] or ''
+    if description.startswith(DETACHED_COMMENT_PREFIX):
+        return partition_upper_bound(description)
+
+    match = MONTHLY_PARTITION_RE.match(partition['partition_name'])
+    if not match:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    if not 1 <= month <= 12:
+        return None
+    return datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def retention_cutoff(older_than_months: int) -> datetime:
+    """Начало месяца (UTC), раньше которого партиции подлежат архивации"""
+    now = datetime.now(timezone.utc)
+    months = now.year * 12 + now.month - 1 - older_than_months
+    return datetime(months // 12, months % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def archive_source_sql(partition_name: str, columns) -> str:
+    """
+    Что выгружать в архив: таблицу как есть или (после справочника
+    user_agents) с подставленной строкой user agent - архив не должен
+    зависеть от справочника в БД
+    """
+    if 'user_agent_id' not in columns:
+        return f'"{partition_name}"'
+    select = ", ".join(
+        "COALESCE(p.user_agent, ua.user_agent) AS user_agent" if column == 'user_agent' else f'p."{column}"'
+        for column in columns
+    )
+    return (
+        f'(SELECT {select} FROM "{partition_name}" p '
+        f'LEFT JOIN user_agents ua ON ua.user_agent_id = p.user_agent_id)'
+    )
+
+
+def export_partition(db: TicketDatabase, partition_name: str, archive_dir: str) -> Dict:
+    """
+    Выгрузить таблицу в gzip CSV (COPY, с заголовком)
+
+    Файл пишется во временный и переименовывается только после
+    сверки числа строк, рядом кладётся SHA-256 архива.
+    """
+    path = os.path.join(archive_dir, f"{partition_name}.csv.gz")
+    tmp_path = path + ".tmp"
+    digest = hashlib.sha256()
+
+    with db.get_connection('export_partition') as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT COUNT(*) AS rows FROM "{partition_name}"')
+        expected_rows = cursor.fetchone()['rows']
+        cursor.execute(SELECT_TABLE_COLUMNS_SQL, (f'"{partition_name}"',))
+        source = archive_source_sql(partition_name, [row['column_name'] for row in cursor.fetchall()])
+
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(filename=os.path.basename(path[:-3]), mode='wb', fileobj=raw) as archive:
+                with cursor.copy(f'COPY {source} TO STDOUT (FORMAT csv, HEADER)') as copy:
+                    for chunk in copy:
+                        archive.write(chunk)
+            raw.flush()
+            os.fsync(raw.fileno())
+        exported_rows = cursor.rowcount
+        conn.rollback()
+
+    if exported_rows != expected_rows:
+        os.remove(tmp_path)
+        raise RuntimeError(f"{partition_name}: exported {exported_rows} rows, expected {expected_rows}")
+
+    with open(tmp_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    os.replace(tmp_path, path)
+    with open(path + ".sha256", 'w') as f:
+        f.write(f"{digest.hexdigest()}  {os.path.basename(path)}\n")
+
+    return {'path': path, 'rows': exported_rows, 'sha256': digest.hexdigest()}
+
+
+def archive_partitions(db: TicketDatabase, older_than_months: int, archive_dir: str, drop: bool):
+    """Отсоединить и выгрузить партиции, целиком лежащие раньше срока хранения"""
+    cutoff = retention_cutoff(older_than_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    print(f"📦 Архивация партиций до {cutoff.date()} в {archive_dir}")
+
+    for partition in db.get_consent_partitions():
+        name = partition['partition_name']
+
+        if partition['attached']:
+            upper_bound = partition_upper_bound(partition['bound'])
+            if upper_bound is None or upper_bound > cutoff:
+                continue
+            # После отсоединения записи этого диапазона недоступны запросам к consent_logs;
+            # граница остаётся в COMMENT, чтобы следующий запуск узнал таблицу
+            with db.get_connection('detach_partition') as conn:
+                conn.execute(f'ALTER TABLE consent_logs DETACH PARTITION "{name}"')
+                comment = (DETACHED_COMMENT_PREFIX + partition['bound']).replace("'", "''")
+                conn.execute(f'COMMENT ON TABLE "{name}" IS \'{comment}\'')
+                conn.commit()
+            print(f"🔌 {name}: отсоединена")
+        else:
+            # Отсоединённые таблицы (оставшиеся с прошлого запуска без --drop):
+            # только отсоединённые этим инструментом или помесячные, и только старше срока
+            upper_bound = detached_upper_bound(partition)
+            if upper_bound is None:
+                print(f"⚠️ {name}: не партиция consent_logs с известной границей, пропущена")
+                continue
+            if upper_bound > cutoff:
+                print(f"⚠️ {name}: отсоединена, но моложе срока хранения ({upper_bound.date()}), пропущена")
+                continue
+
+        archive_path = os.path.join(archive_dir, f"{name}.csv.gz")
+        if os.path.exists(archive_path):
+            print(f"⏭️ {name}: архив уже есть ({archive_path})")
+        else:
+            result = export_partition(db, name, archive_dir)
+            print(f"✅ {name}: {result['rows']} записей -> {result['path']}")
+            print(f"   SHA-256: {result['sha256']}")
+
+        if drop:
+            with db.get_connection('drop_partition') as conn:
+                conn.execute(f'DROP TABLE "{name}"')
+                conn.commit()
+            print(f"🗑️ {name}: удалена из БД")
+
+
+def list_partitions(db: TicketDatabase):
+    for partition in db.get_consent_partitions():
+        state = partition['bound'] if partition['attached'] else 'ОТСОЕДИНЕНА (ждёт архивации)'
+        size_mb = partition['total_bytes'] / 1024 / 1024
+        rows = max(partition['estimated_rows'], 0)
+        print(f"{partition['partition_name']:<24} ~{rows:>10} записей {size_mb:>9.1f} MB  {state}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание партиций consent_logs")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ensure = commands.add_parser('ensure', help="создать партиции на ближайшие месяцы")
+    ensure.add_argument('--months-ahead', type=int, default=CONSENT_PARTITIONS_AHEAD)
+
+    commands.add_parser('list', help="показать партиции")
+
+    archive = commands.add_parser('archive', help="отсоединить и выгрузить старые партиции")
+    archive.add_argument('--older-than-months', type=int, default=CONSENT_RETENTION_MONTHS)
+    archive.add_argument('--dir', default=CONSENT_ARCHIVE_DIR)
+    archive.add_argument('--drop', action='store_true',
+                         help="удалить таблицу из БД после успешной выгрузки")
+
+    args = parser.parse_args()
+    db = TicketDatabase()
+
+    try:
+        if args.command == 'ensure':
+            created = db.ensure_consent_partitions(args.months_ahead)
+            print(f"✅ Создано партиций: {created}")
+        elif args.command == 'list':
+            list_partitions(db)
+        elif args.command == 'archive':
+            archive_partitions(db, args.older_than_months, args.dir, args.drop)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
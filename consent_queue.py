@@ -0,0 +1,409 @@
+"""
+Очередь отложенной записи согласий (write-behind)
+
+Запрос к /api/consent только дописывает запись в локальный spool-файл
+(append-only, с fsync) и сразу получает ответ 202. Фоновый поток
+собирает накопленные записи в пачки и сохраняет их в consent_logs
+одним INSERT на пачку (group commit).
+
+Устойчивость к падениям:
+- каждый процесс пишет в свои сегменты spool-файлов и держит flock
+  на своём lock-файле, пока жив;
+- при старте процесс захватывает lock-файлы умерших процессов и забирает
+  их сегменты себе (rename в свои имена) до чтения: два одновременно
+  стартующих воркера не дозаписывают один сегмент дважды, а если упадёт
+  и этот процесс, сегменты восстановит следующий;
+- уже сохранённые записи при вставке отсеиваются по consent_log_id
+  (см. consent_dedup.py), поэтому повторный replay не создаёт дубликатов.
+"""
+
+import os
+import glob
+import json
+import time
+import fcntl
+import threading
+import logging
+from collections import deque
+from typing import Dict, List
+
+import psycopg
+
+from metrics import set_consent_queue_depth, observe_consent_queue_flush
+
+logger = logging.getLogger(__name__)
+
+# Режим записи согласий: sync (сразу в БД) или write_behind (через очередь)
+CONSENT_WRITE_MODE = os.getenv("CONSENT_WRITE_MODE", "sync")
+CONSENT_SPOOL_DIR = os.getenv("CONSENT_SPOOL_DIR", "consent_spool")
+# Максимум записей, ожидающих сохранения в БД (дальше - 503)
+CONSENT_QUEUE_MAX_SIZE = int(os.getenv("CONSENT_QUEUE_MAX_SIZE", "10000"))
+# Максимум записей в одном INSERT
+CONSENT_FLUSH_BATCH_SIZE = int(os.getenv("CONSENT_FLUSH_BATCH_SIZE", "200"))
+# Как часто (в секундах) сохранять неполную пачку
+CONSENT_FLUSH_INTERVAL = float(os.getenv("CONSENT_FLUSH_INTERVAL", "0.5"))
+# Сколько записей в одном сегменте spool-файла
+CONSENT_SPOOL_SEGMENT_SIZE = int(os.getenv("CONSENT_SPOOL_SEGMENT_SIZE", "5000"))
+# fsync после каждой записи (отключать только если потеря записей при сбое ОС допустима)
+CONSENT_SPOOL_FSYNC = os.getenv("CONSENT_SPOOL_FSYNC", "true").lower() == "true"
+
+# Пауза между повторами при недоступности БД (секунды)
+FLUSH_RETRY_MIN_DELAY = 0.5
+FLUSH_RETRY_MAX_DELAY = 30.0
+
+
+class ConsentQueueFull(Exception):
+    """Очередь переполнена, запись не принята"""
+
+
+class _Segment:
+    """Сегмент spool-файла и количество ещё не сохранённых в БД записей"""
+
+    def __init__(self, path: str, closed: bool = False):
+        self.path = path
+        self.pending = 0
+        self.closed = closed
+
+
+class ConsentWriteQueue:
+    """Очередь отложенной записи согласий с групповым сохранением в БД"""
+
+    def __init__(self, db, spool_dir: str = CONSENT_SPOOL_DIR,
+                 max_size: int = CONSENT_QUEUE_MAX_SIZE,
+                 batch_size: int = CONSENT_FLUSH_BATCH_SIZE,
+                 flush_interval: float = CONSENT_FLUSH_INTERVAL,
+                 segment_size: int = CONSENT_SPOOL_SEGMENT_SIZE,
+                 fsync: bool = CONSENT_SPOOL_FSYNC):
+        self.db = db
+        self.spool_dir = spool_dir
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.fsync = fsync
+
+        self._pending = deque()  # элементы: (segment, consent_log)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._pid = None
+        self._lock_file = None
+        self._segment = None
+        self._segment_file = None
+        self._segment_seq = 0
+        self._segment_records = 0
+
+        self._stats = {
+            'enqueued_total': 0,
+            'rejected_total': 0,
+            'recovered_total': 0,
+            'flushed_total': 0,
+            'flush_batches_total': 0,
+            'flush_errors_total': 0,
+            'dead_letter_total': 0,
+            'last_flush_batch_size': 0,
+            'last_flush_latency_ms': 0.0,
+            'max_flush_latency_ms': 0.0,
+            'total_flush_latency_ms': 0.0,
+        }
+
+    # ========================================
+    # Запуск и остановка
+    # ========================================
+
+    def start(self):
+        """Захватить свой spool, восстановить записи умерших процессов и запустить поток"""
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._pid = os.getpid()
+
+        # Свой lock - до восстановления: забранные сегменты сразу под ним
+        self._lock_file = open(self._lock_path(self._pid), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+        # PID мог достаться от умершего процесса - его сегменты тоже дозаписываем
+        existing = self._segment_paths(self._pid)
+        if existing:
+            self._segment_seq = _segment_seq(existing[-1])
+        for path in existing:
+            self._load_segment(path)
+        self._recover_orphans()
+        self._open_segment()
+        set_consent_queue_depth(len(self._pending))
+
+        self._thread = threading.Thread(
+            target=self._run, name='consent-write-behind', daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            f"Consent write-behind queue started: spool={self.spool_dir}, "
+            f"recovered={self._stats['recovered_total']}"
+        )
+
+    def stop(self, timeout: float = 10.0):
+        """Сохранить оставшиеся записи и остановить поток"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._segment_file:
+            self._segment_file.close()
+        if not self._pending:
+            # Всё сохранено - spool этого процесса больше не нужен
+            for path in self._segment_paths(self._pid):
+                os.remove(path)
+            if self._lock_file:
+                os.remove(self._lock_path(self._pid))
+        if self._lock_file:
+            self._lock_file.close()
+
+    # ========================================
+    # Приём записей
+    # ========================================
+
+    def enqueue(self, consent_log: Dict):
+        """
+        Надёжно поставить запись в очередь
+
+        Запись должна содержать consent_log_id (генерируется приложением).
+
+        Raises:
+            ConsentQueueFull: очередь переполнена
+        """
+        self.enqueue_many([consent_log])
+
+    def enqueue_many(self, consent_logs: List[Dict]):
+        """
+        Надёжно поставить несколько записей в очередь (все или ни одной)
+
+        Raises:
+            ConsentQueueFull: очередь переполнена
+        """
+        with self._cond:
+            if len(self._pending) + len(consent_logs) > self.max_size:
+                self._stats['rejected_total'] += len(consent_logs)
+                raise ConsentQueueFull(
+                    f"Consent queue is full ({len(self._pending)} pending)"
+                )
+
+            if self._segment_records >= self.segment_size:
+                self._rotate_segment()
+
+            self._segment_file.write(
+                ''.join(json.dumps(c, ensure_ascii=False) + '\n' for c in consent_logs)
+            )
+            self._segment_file.flush()
+            if self.fsync:
+                os.fsync(self._segment_file.fileno())
+
+            segment = self._segment
+            for consent_log in consent_logs:
+                self._pending.append((segment, consent_log))
+            segment.pending += len(consent_logs)
+            self._segment_records += len(consent_logs)
+            self._stats['enqueued_total'] += len(consent_logs)
+            set_consent_queue_depth(len(self._pending))
+
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def get_stats(self) -> Dict:
+        """Метрики очереди: глубина, счётчики и задержки сохранения"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+        stats['max_size'] = self.max_size
+        stats['batch_size'] = self.batch_size
+        batches = stats['flush_batches_total']
+        stats['avg_flush_latency_ms'] = (
+            round(stats.pop('total_flush_latency_ms') / batches, 3) if batches else 0.0
+        )
+        return stats
+
+    # ========================================
+    # Фоновое сохранение
+    # ========================================
+
+    def _run(self):
+        retry_delay = FLUSH_RETRY_MIN_DELAY
+
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size and not self._stopping:
+                    self._cond.wait(self.flush_interval)
+                if not self._pending:
+                    if self._stopping:
+                        return
+                    continue
+                batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+
+            try:
+                self._flush(batch)
+                retry_delay = FLUSH_RETRY_MIN_DELAY
+            except Exception as e:
+                with self._cond:
+                    self._stats['flush_errors_total'] += 1
+                logger.error(f"Error flushing consent queue, retry in {retry_delay}s: {e}")
+                if self._stopping:
+                    return
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, FLUSH_RETRY_MAX_DELAY)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        consent_logs = [consent_log for _, consent_log in batch]
+
+        try:
+            self.db.create_consent_logs(consent_logs)
+        except Exception as e:
+            if not _is_data_error(e):
+                raise
+            # В пачке есть запись, которую БД никогда не примет -
+            # сохраняем по одной, чтобы не блокировать остальные
+            logger.warning(f"Consent batch rejected, falling back to per-record insert: {e}")
+            for consent_log in consent_logs:
+                try:
+                    self.db.create_consent_logs([consent_log])
+                except Exception as record_error:
+                    if not _is_data_error(record_error):
+                        raise
+                    self._dead_letter(consent_log, record_error)
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        observe_consent_queue_flush(latency_ms / 1000)
+
+        with self._cond:
+            for _ in batch:
+                segment, _ = self._pending.popleft()
+                segment.pending -= 1
+                if segment.closed and segment.pending == 0:
+                    self._remove_segment(segment)
+            set_consent_queue_depth(len(self._pending))
+
+            self._stats['flushed_total'] += len(batch)
+            self._stats['flush_batches_total'] += 1
+            self._stats['last_flush_batch_size'] = len(batch)
+            self._stats['last_flush_latency_ms'] = round(latency_ms, 3)
+            self._stats['max_flush_latency_ms'] = max(
+                self._stats['max_flush_latency_ms'], round(latency_ms, 3)
+            )
+            self._stats['total_flush_latency_ms'] += latency_ms
+
+    def _dead_letter(self, consent_log: Dict, error: Exception):
+        """Отложить запись, которую невозможно сохранить, для ручного разбора"""
+        with self._cond:
+            self._stats['dead_letter_total'] += 1
+        logger.error(f"Consent log moved to dead letter: {consent_log.get('consent_log_id')}: {error}")
+        path = os.path.join(self.spool_dir, 'consent-dead-letter.jsonl')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'error': str(error), 'consent_log': consent_log}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    # ========================================
+    # Spool-файлы
+    # ========================================
+
+    def _lock_path(self, pid) -> str:
+        return os.path.join(self.spool_dir, f"consent-spool-{pid}.lock")
+
+    def _segment_paths(self, pid) -> List[str]:
+        pattern = os.path.join(self.spool_dir, f"consent-spool-{pid}-*.jsonl")
+        return sorted(glob.glob(pattern), key=_segment_seq)
+
+    def _open_segment(self):
+        self._segment_seq += 1
+        path = os.path.join(
+            self.spool_dir, f"consent-spool-{self._pid}-{self._segment_seq}.jsonl"
+        )
+        self._segment = _Segment(path)
+        self._segment_file = open(path, 'a', encoding='utf-8')
+        self._segment_records = 0
+
+    def _rotate_segment(self):
+        self._segment_file.close()
+        self._segment.closed = True
+        if self._segment.pending == 0:
+            self._remove_segment(self._segment)
+        self._open_segment()
+
+    def _remove_segment(self, segment: _Segment):
+        try:
+            os.remove(segment.path)
+        except FileNotFoundError:
+            pass
+
+    def _recover_orphans(self):
+        """Забрать и поставить в очередь сегменты процессов, которые завершились аварийно"""
+        for lock_path in glob.glob(os.path.join(self.spool_dir, 'consent-spool-*.lock')):
+            pid = os.path.basename(lock_path)[len('consent-spool-'):-len('.lock')]
+            if pid == str(self._pid):
+                continue
+
+            # Без O_CREAT: lock-файл, уже убранный другим воркером, не воскрешаем
+            try:
+                lock_fd = os.open(lock_path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Процесс жив (или spool уже забирает другой воркер)
+                    continue
+                try:
+                    if os.stat(lock_path).st_ino != os.fstat(lock_fd).st_ino:
+                        continue
+                except FileNotFoundError:
+                    # Пока ждали, spool забрал и убрал другой воркер
+                    continue
+
+                for path in self._segment_paths(pid):
+                    claimed_path = self._claim_segment(path)
+                    if claimed_path:
+                        self._load_segment(claimed_path)
+                os.remove(lock_path)
+            finally:
+                os.close(lock_fd)
+
+    def _claim_segment(self, path: str):
+        """Переименовать чужой сегмент в свой (атомарно); None - его уже забрали"""
+        self._segment_seq += 1
+        claimed_path = os.path.join(
+            self.spool_dir, f"consent-spool-{self._pid}-{self._segment_seq}.jsonl"
+        )
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            return None
+        return claimed_path
+
+    def _load_segment(self, path: str):
+        """Поставить в очередь записи закрытого сегмента (восстановление при старте)"""
+        segment = _Segment(path, closed=True)
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    consent_log = json.loads(line)
+                except ValueError:
+                    # Недописанная последняя строка при сбое
+                    logger.warning(f"Skipping corrupted spool line in {path}")
+                    continue
+                self._pending.append((segment, consent_log))
+                segment.pending += 1
+                self._stats['recovered_total'] += 1
+        if segment.pending == 0:
+            self._remove_segment(segment)
+
+
+def _segment_seq(path: str) -> int:
+    return int(path.rsplit('-', 1)[1].split('.', 1)[0])
+
+
+def _is_data_error(error: Exception) -> bool:
+    """Ошибка в самих данных записи (повтор не поможет)"""
+    return isinstance(error, (psycopg.DataError, psycopg.IntegrityError))
@@ -0,0 +1,200 @@
+"""
+Поиск согласий для поддержки (споры о покупке)
+
+Согласия фильтруются по периоду, документу и версии, сессии, IP и
+странице и отдаются страницами от новых к старым. Страницы идут по
+курсору (consent_timestamp, consent_log_id) последней записи, а не по
+OFFSET: каждую страницу PostgreSQL читает из индекса (фильтр +
+consent_timestamp, consent_log_id, миграция 6) только её строки, поэтому
+сотая страница стоит столько же, сколько первая. Размер страницы
+ограничен CONSENT_SEARCH_MAX_LIMIT, тексты согласий и user agent не
+читаются (полная запись - выгрузка с session_id).
+
+Страница (page) сравнивается без параметров запроса и якоря: согласия
+с https://site/event?utm_source=x находятся по https://site/event.
+
+Используется endpoint /api/admin/consents (api.py, api_async.py) и командой:
+    python consent_search.py --client-ip 203.0.113.7 --date-from 2025-11-01
+    python consent_search.py --page https://site/event --cursor <next_cursor>
+"""
+
+import os
+import uuid
+import base64
+import argparse
+import ipaddress
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from consent_common import ALLOWED_DOCUMENT_TYPES, is_valid_session_id
+from database_tickets import TicketDatabase, CONSENT_PAGE_MAX_LENGTH
+
+# Записей на странице по умолчанию и максимум (параметр limit)
+CONSENT_SEARCH_DEFAULT_LIMIT = int(os.getenv("CONSENT_SEARCH_DEFAULT_LIMIT", "50"))
+CONSENT_SEARCH_MAX_LIMIT = int(os.getenv("CONSENT_SEARCH_MAX_LIMIT", "500"))
+
+# Максимальная длина текстовых фильтров (document_version, page)
+MAX_FILTER_LENGTH = 2048
+
+
+def page_key(page_url: str) -> str:
+    """Страница без параметров запроса и якоря (как CONSENT_PAGE_SQL)"""
+    return page_url.split('#', 1)[0].split('?', 1)[0][:CONSENT_PAGE_MAX_LENGTH]
+
+
+def encode_cursor(row: Dict) -> str:
+    """Курсор следующей страницы по последней записи"""
+    value = f"{row['consent_timestamp'].isoformat()}|{row['consent_log_id']}"
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """(consent_timestamp, consent_log_id) из курсора; ValueError для чужой строки"""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, consent_log_id = value.split('|')
+        parsed = datetime.fromisoformat(timestamp)
+        consent_log_id = uuid.UUID(consent_log_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+    if parsed.tzinfo is None:
+        raise ValueError("invalid cursor")
+    return parsed, consent_log_id
+
+
+def parse_search_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_search_params(args) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Разобрать параметры поиска (request.args или словарь)
+
+    Returns:
+        (ошибка или None, {'filters', 'limit', 'after'})
+    """
+    filters = {}
+    for field in ('date_from', 'date_to'):
+        value = args.get(field)
+        if value:
+            try:
+                filters[field] = parse_search_datetime(value)
+            except ValueError:
+                return {'error': f'Invalid {field}, ISO 8601 date expected'}, None
+    if filters.get('date_from') and filters.get('date_to') and filters['date_from'] >= filters['date_to']:
+        return {'error': 'date_from must be earlier than date_to'}, None
+
+    document_type = args.get('document_type')
+    if document_type:
+        if document_type not in ALLOWED_DOCUMENT_TYPES:
+            return {'error': 'Invalid document_type', 'allowed': ALLOWED_DOCUMENT_TYPES}, None
+        filters['document_type'] = document_type
+
+    session_id = args.get('session_id')
+    if session_id:
+        if not is_valid_session_id(session_id):
+            return {'error': 'Invalid session_id, UUID expected'}, None
+        filters['session_id'] = session_id
+
+    client_ip = args.get('client_ip')
+    if client_ip:
+        try:
+            ipaddress.ip_address(client_ip)
+        except ValueError:
+            return {'error': 'Invalid client_ip, IP address expected'}, None
+        filters['client_ip'] = client_ip
+
+    for field in ('document_version', 'page'):
+        value = args.get(field)
+        if value:
+            if len(value) > MAX_FILTER_LENGTH:
+                return {'error': f'{field} is too long', 'max_length': MAX_FILTER_LENGTH}, None
+            filters[field] = page_key(value) if field == 'page' else value
+
+    limit = args.get('limit') or CONSENT_SEARCH_DEFAULT_LIMIT
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if not 1 <= limit <= CONSENT_SEARCH_MAX_LIMIT:
+        return {'error': 'Invalid limit', 'min': 1, 'max': CONSENT_SEARCH_MAX_LIMIT}, None
+
+    after = None
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError:
+            return {'error': 'Invalid cursor'}, None
+
+    return None, {'filters': filters, 'limit': limit, 'after': after}
+
+
+def build_search_page(rows: List[Dict], limit: int) -> Dict:
+    """
+    Ответ поиска по limit + 1 прочитанным записям
+
+    Лишняя запись только показывает, что есть следующая страница.
+    """
+    consents = rows[:limit]
+    return {
+        'consents': [
+            {**row, 'consent_timestamp': row['consent_timestamp'].isoformat()} for row in consents
+        ],
+        'count': len(consents),
+        'limit': limit,
+        'next_cursor': encode_cursor(consents[-1]) if len(rows) > limit else None,
+    }
+
+
+def search_consents(db: TicketDatabase, params: Dict) -> Dict:
+    """Страница поиска согласий (TicketDatabase)"""
+    rows = db.search_consents(params['filters'], params['limit'] + 1, params['after'])
+    return build_search_page(rows, params['limit'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поиск согласий (от новых к старым)")
+    parser.add_argument('--date-from', help="начало периода consent_timestamp (ISO 8601)")
+    parser.add_argument('--date-to', help="конец периода (ISO 8601, не включительно)")
+    parser.add_argument('--document-type', choices=ALLOWED_DOCUMENT_TYPES)
+    parser.add_argument('--document-version')
+    parser.add_argument('--session-id')
+    parser.add_argument('--client-ip')
+    parser.add_argument('--page', help="URL страницы (без учёта параметров запроса)")
+    parser.add_argument('--limit', type=int, default=CONSENT_SEARCH_DEFAULT_LIMIT)
+    parser.add_argument('--cursor', help="next_cursor прошлой страницы")
+    args = parser.parse_args()
+
+    search_error, params = parse_search_params(vars(args))
+    if search_error:
+        print(f"❌ Ошибка: {search_error['error']}")
+        exit(1)
+
+    db = TicketDatabase()
+    try:
+        page = search_consents(db, params)
+    finally:
+        db.close()
+
+    for row in page['consents']:
+        print(
+            f"{row['consent_timestamp'][:19].replace('T', ' ')}  {row['session_id']}  "
+            f"{row['document_type']:<15} {row['document_version']:<14} "
+            f"{'✅' if row['consent_given'] else '❌'}  {row['client_ip'] or '-':<16} "
+            f"{row['ip_country'] or '-':<3} {row['page_url'] or '-'}"
+        )
+    print(f"📄 Записей: {page['count']}")
+    if page['next_cursor']:
+        print(f"➡️ Следующая страница: --cursor {page['next_cursor']}")
+
+
+if __name__ == "__main__":
+    main()
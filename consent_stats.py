@@ -0,0 +1,211 @@
+"""
+Статистика согласий по заранее посчитанным агрегатам
+
+Триггер на consent_logs на каждый INSERT обновляет:
+- consent_stats_rollup - число согласий по часам и дням в разрезе
+  document_type, document_version, ip_country, consent_given;
+- consent_sessions_hll - HyperLogLog регистры уникальных сессий
+  по часам и дням.
+
+Запрошенный период раскладывается на целые дни и часы по краям, поэтому
+запрос читает сотни строк агрегатов, а не consent_logs. Уникальные
+сессии считаются приблизительно (ошибка около 1.6%).
+
+Используется endpoint /api/admin/stats (api.py, api_async.py) и командой:
+    python consent_stats.py show --date-from 2025-10-01 --date-to 2025-11-01
+    python consent_stats.py rebuild   # пересчитать агрегаты по consent_logs
+"""
+
+import math
+import json
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database_tickets import TicketDatabase, CONSENT_HLL_PRECISION
+
+STATS_SERIES_GRANULARITIES = ['hour', 'day']
+
+# Границы периода, если дата не задана (агрегаты по дням)
+STATS_MIN_DATE = datetime(1970, 1, 1, tzinfo=timezone.utc)
+STATS_MAX_DATE = datetime(9999, 1, 1, tzinfo=timezone.utc)
+
+
+def hll_estimate(registers: Dict[int, int], precision: int = CONSENT_HLL_PRECISION) -> int:
+    """Оценка числа уникальных значений по регистрам HyperLogLog {register: rank}"""
+    m = 1 << precision
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    estimate = alpha * m * m / (zeros + sum(2.0 ** -rank for rank in registers.values()))
+    # Для малых значений точнее linear counting
+    if estimate <= 2.5 * m and zeros:
+        return round(m * math.log(m / zeros))
+    return round(estimate)
+
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(value: datetime) -> datetime:
+    floored = floor_hour(value)
+    return floored if floored == value else floored + timedelta(hours=1)
+
+
+def ceil_day(value: datetime) -> datetime:
+    floored = value.replace(hour=0)
+    return floored if floored == value else floored + timedelta(days=1)
+
+
+def stats_periods(date_from: datetime, date_to: datetime) -> List[Tuple[str, datetime, datetime]]:
+    """
+    Разложить [date_from, date_to) (границы по целым часам) на периоды агрегатов
+
+    Returns:
+        [(granularity, bucket_from, bucket_to), ...] - целые дни в середине
+        и часы по краям
+    """
+    day_from = ceil_day(date_from)
+    day_to = date_to.replace(hour=0)
+    if day_from >= day_to:
+        return [('hour', date_from, date_to)]
+
+    periods = [('day', day_from, day_to)]
+    if date_from < day_from:
+        periods.insert(0, ('hour', date_from, day_from))
+    if day_to < date_to:
+        periods.append(('hour', day_to, date_to))
+    return periods
+
+
+def stats_series_range(params: Dict) -> Tuple[str, datetime, datetime]:
+    """Период для ряда по часам/дням (для дней - расширенный до целых дней)"""
+    if params['series'] == 'day':
+        return 'day', params['date_from'].replace(hour=0), ceil_day(params['date_to'])
+    return 'hour', params['date_from'], params['date_to']
+
+
+def parse_stats_datetime(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def parse_stats_params(args) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """
+    Разобрать параметры запроса статистики (request.args или словарь)
+
+    Период расширяется до целых часов (UTC).
+
+    Returns:
+        (ошибка или None, {'date_from', 'date_to', 'series'})
+    """
+    params = {'date_from': STATS_MIN_DATE, 'date_to': STATS_MAX_DATE, 'series': None}
+
+    for field in ('date_from', 'date_to'):
+        value = args.get(field)
+        if value:
+            try:
+                params[field] = parse_stats_datetime(value)
+            except ValueError:
+                return {'error': f'Invalid {field}, ISO 8601 date expected'}, None
+
+    params['date_from'] = floor_hour(params['date_from'])
+    params['date_to'] = ceil_hour(params['date_to'])
+    if params['date_from'] >= params['date_to']:
+        return {'error': 'date_from must be earlier than date_to'}, None
+
+    series = args.get('series')
+    if series:
+        if series not in STATS_SERIES_GRANULARITIES:
+            return {'error': 'Invalid series', 'allowed': STATS_SERIES_GRANULARITIES}, None
+        params['series'] = series
+
+    return None, params
+
+
+def build_consent_stats(params: Dict, rows: List[Dict], registers: Dict[int, int],
+                        series: Optional[List[Dict]] = None) -> Dict:
+    """Ответ /api/admin/stats по агрегатам (см. TicketDatabase.get_consent_rollup)"""
+    stats = {
+        'date_from': params['date_from'].isoformat() if params['date_from'] != STATS_MIN_DATE else None,
+        'date_to': params['date_to'].isoformat() if params['date_to'] != STATS_MAX_DATE else None,
+        'total_consents': 0,
+        'consents_given': 0,
+        'consents_declined': 0,
+        'unique_sessions_estimate': hll_estimate(registers),
+        'by_document_type': {},
+        'by_document_version': {},
+        'by_country': {},
+    }
+
+    for row in rows:
+        count = row['consent_count']
+        stats['total_consents'] += count
+        stats['consents_given' if row['consent_given'] else 'consents_declined'] += count
+
+        document_type = row['document_type']
+        stats['by_document_type'][document_type] = stats['by_document_type'].get(document_type, 0) + count
+
+        versions = stats['by_document_version'].setdefault(document_type, {})
+        versions[row['document_version']] = versions.get(row['document_version'], 0) + count
+
+        country = row['ip_country'] or 'unknown'
+        stats['by_country'][country] = stats['by_country'].get(country, 0) + count
+
+    if series is not None:
+        stats['series'] = [
+            {'bucket': item['bucket'].isoformat(), 'consents': item['consent_count']}
+            for item in series
+        ]
+
+    return stats
+
+
+def get_consent_stats(db: TicketDatabase, params: Dict) -> Dict:
+    """Статистика согласий за период (TicketDatabase)"""
+    rows, registers = db.get_consent_rollup(stats_periods(params['date_from'], params['date_to']))
+    series = None
+    if params['series']:
+        series = db.get_consent_rollup_series(*stats_series_range(params))
+    return build_consent_stats(params, rows, registers, series)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Статистика согласий")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    show = commands.add_parser('show', help="показать статистику за период")
+    show.add_argument('--date-from', help="начало периода (ISO 8601)")
+    show.add_argument('--date-to', help="конец периода (ISO 8601, не включительно)")
+    show.add_argument('--series', choices=STATS_SERIES_GRANULARITIES)
+
+    commands.add_parser('rebuild', help="пересчитать агрегаты по consent_logs "
+                                        "(архивированные партиции в статистику не попадут)")
+
+    args = parser.parse_args()
+    db = TicketDatabase()
+
+    try:
+        if args.command == 'show':
+            stats_error, params = parse_stats_params({
+                'date_from': args.date_from, 'date_to': args.date_to, 'series': args.series
+            })
+            if stats_error:
+                print(f"❌ Ошибка: {stats_error['error']}")
+                exit(1)
+            print(json.dumps(get_consent_stats(db, params), ensure_ascii=False, indent=2))
+        elif args.command == 'rebuild':
+            db.rebuild_consent_stats()
+            print("✅ Агрегаты статистики пересчитаны")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+Асинхронный доступ к базе данных для api_async.py
+Те же запросы, что и в TicketDatabase, но через AsyncConnectionPool
+"""
+
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import Optional, Dict, List, Tuple, AsyncIterator
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+from metrics import (
+    TimedAsyncConnection, observe_db_phase, DB_CONNECTIONS_IN_USE, DB_POOL_MAX_CONNECTIONS
+)
+
+from database_tickets import (
+    DATABASE_URL, DB_POOL_MIN_SIZE, ASYNC_DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT,
+    DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME,
+    DB_AUTO_MIGRATE, SCHEMA_MIGRATIONS, SCHEMA_LOCK_SQL, CREATE_SCHEMA_MIGRATIONS_SQL,
+    SCHEMA_MIGRATIONS_EXISTS_SQL, SELECT_SCHEMA_MIGRATIONS_SQL, INSERT_SCHEMA_MIGRATION_SQL,
+    LOCK_CONSENT_IDS_SQL, SELECT_EXISTING_CONSENT_IDS_SQL,
+    INSERT_CONSENT_LOG_SQL, SELECT_CONSENTS_BY_SESSION_SQL,
+    DEACTIVATE_DOCUMENT_SNAPSHOTS_SQL, INSERT_DOCUMENT_SNAPSHOT_SQL,
+    SELECT_ACTIVE_DOCUMENT_SQL, SELECT_ACTIVE_DOCUMENTS_SQL,
+    NOTIFY_DOCUMENT_SNAPSHOTS_SQL, DOCUMENT_SNAPSHOTS_CHANNEL,
+    SELECT_SESSION_STATUS_SQL, SELECT_SESSION_STATUSES_SQL, decode_session_status,
+    consent_log_params, existing_consent_ids_params, new_consent_log_rows, build_consent_logs_insert,
+    document_snapshot_params,
+    DOCUMENT_BLOB_EXISTS_SQL, INSERT_DOCUMENT_BLOB_SQL, SELECT_DOCUMENT_BLOB_CHAIN_SQL,
+    SELECT_DOCUMENT_BLOBS_SQL,
+    build_document_blob, document_blob_params, document_text_from_chain, decode_document_blobs,
+    consent_stats_query, CONSENT_EXPORT_FETCH_SIZE,
+    SELECT_CONSENT_ROLLUP_SQL, SELECT_CONSENT_HLL_SQL, SELECT_CONSENT_ROLLUP_SERIES_SQL,
+    consent_rollup_query,
+    INSERT_USER_AGENTS_SQL, user_agent_rows, remember_user_agents, consent_search_query,
+)
+from db_replicas import (
+    ReplicaRouter, REPLICA_LAG_SQL, DB_REPLICA_TIMEOUT, DB_REPLICA_POOL_MAX_SIZE,
+    PRIMARY, session_status_complete,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTicketDatabase:
+    """Асинхронный вариант TicketDatabase"""
+
+    def __init__(self):
+        self.database_url = DATABASE_URL
+        # Пул открывается в open() при первом обращении к БД
+        self.pool = AsyncConnectionPool(
+            self.database_url,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=ASYNC_DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            max_idle=DB_POOL_MAX_IDLE,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            kwargs={'row_factory': dict_row},
+            connection_class=TimedAsyncConnection,
+            reset=TimedAsyncConnection.reset_operation,
+            check=AsyncConnectionPool.check_connection,
+            name='ticket-consent-async',
+            open=False,
+        )
+        # Реплики для чтений (см. db_replicas.py), свой пул на каждую
+        self.replicas = ReplicaRouter()
+        self.replica_pools = {
+            target.name: AsyncConnectionPool(
+                target.url,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_REPLICA_POOL_MAX_SIZE,
+                timeout=DB_REPLICA_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                kwargs={'row_factory': dict_row},
+                connection_class=TimedAsyncConnection,
+                reset=TimedAsyncConnection.reset_operation,
+                check=AsyncConnectionPool.check_connection,
+                name=f'ticket-consent-async-{target.name}',
+                open=False,
+            )
+            for target in self.replicas.replicas
+        }
+        # ID строк user agent, уже сохранённых в справочнике (user_agents.py)
+        self.stored_user_agents = set()
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+        DB_POOL_MAX_CONNECTIONS.inc(ASYNC_DB_POOL_MAX_SIZE)
+
+    @asynccontextmanager
+    async def connection(self, operation: str = 'other'):
+        """Соединение из пула с метриками (см. TicketDatabase.get_connection)"""
+        if not self._opened:
+            await self.open()
+
+        started = time.perf_counter()
+        async with self.pool.connection() as conn:
+            observe_db_phase(operation, 'acquire', started)
+            conn.operation = operation
+            DB_CONNECTIONS_IN_USE.inc()
+            try:
+                yield conn
+            finally:
+                DB_CONNECTIONS_IN_USE.dec()
+
+    async def open(self):
+        """Открыть пул, не дожидаясь соединения с БД (см. TicketDatabase.open)"""
+        async with self._open_lock:
+            if self._opened:
+                return
+            if not self.database_url:
+                raise ValueError("DATABASE_URL environment variable is required")
+            await self.pool.open(wait=False)
+            for pool in self.replica_pools.values():
+                await pool.open(wait=False)
+            self._opened = True
+
+        if DB_AUTO_MIGRATE:
+            try:
+                await self.migrate()
+            except Exception as e:
+                logger.error(f"Auto migration failed: {e}")
+
+    async def close(self):
+        """Закрыть пулы соединений"""
+        await self.pool.close()
+        for pool in self.replica_pools.values():
+            await pool.close()
+
+    @asynccontextmanager
+    async def read_connection(self, operation: str = 'other'):
+        """Соединение для чтения: с реплики или из основного пула (см. TicketDatabase.get_read_connection)"""
+        if not self._opened:
+            await self.open()
+
+        async for target in self._usable_replicas():
+            async with AsyncExitStack() as stack:
+                started = time.perf_counter()
+                try:
+                    conn = await stack.enter_async_context(self.replica_pools[target.name].connection())
+                except (PoolTimeout, psycopg.OperationalError) as e:
+                    self.replicas.mark_failed(target, e)
+                    continue
+                observe_db_phase(operation, 'acquire', started)
+                conn.operation = operation
+                conn.read_target = target.name
+                with self.replicas.track(target):
+                    yield conn
+                return
+
+        async with self.connection(operation) as conn:
+            with self.replicas.track(self.replicas.primary):
+                conn.read_target = PRIMARY
+                yield conn
+
+    async def get_read_url(self) -> str:
+        """URL для выгрузок на отдельном соединении: реплика или основная БД"""
+        if not self._opened:
+            await self.open()
+        async for target in self._usable_replicas():
+            return target.url
+        return self.database_url
+
+    async def _usable_replicas(self):
+        """Реплики по кругу, прошедшие проверку; если ни одной - отметка no_replica"""
+        for target in self.replicas.candidates():
+            if self.replicas.claim_check(target):
+                await self._check_replica(target)
+            if target.usable(self.replicas.max_lag):
+                yield target
+        if self.replicas.enabled:
+            self.replicas.record_fallback('no_replica')
+
+    async def _check_replica(self, target):
+        """Проверить доступность и отставание реплики"""
+        try:
+            async with self.replica_pools[target.name].connection() as conn:
+                conn.operation = 'replica_check'
+                cursor = await conn.execute(REPLICA_LAG_SQL)
+                row = await cursor.fetchone()
+        except (PoolTimeout, psycopg.Error) as e:
+            logger.warning(f"Replica {target.name} is unavailable: {e}")
+            self.replicas.mark_failed(target, e)
+            return
+        if not row['in_recovery']:
+            logger.warning(f"Replica {target.name} is not in recovery (not a standby?)")
+        self.replicas.record_check(target, row['lag_seconds'])
+
+    def get_pool_stats(self) -> Dict:
+        """Статистика пула соединений (для мониторинга)"""
+        stats = self.pool.get_stats()
+        stats.update({
+            'min_size': self.pool.min_size,
+            'max_size': self.pool.max_size,
+            'timeout': self.pool.timeout,
+        })
+        return stats
+
+    def get_replica_stats(self) -> Dict:
+        """Состояние реплик, время чтений по целям и пулы реплик (для мониторинга)"""
+        stats = self.replicas.get_stats()
+        for name, pool in self.replica_pools.items():
+            stats['targets'][name]['pool'] = pool.get_stats()
+        return stats
+
+    async def migrate(self) -> List[int]:
+        """Применить новые миграции схемы (см. TicketDatabase.migrate)"""
+        async with self.connection('migrate') as conn:
+            try:
+                await conn.execute(SCHEMA_LOCK_SQL)
+                await conn.execute(CREATE_SCHEMA_MIGRATIONS_SQL)
+                cursor = await conn.execute(SELECT_SCHEMA_MIGRATIONS_SQL)
+                applied_versions = {row['version'] for row in await cursor.fetchall()}
+
+                applied = []
+                for version, name, statements in SCHEMA_MIGRATIONS:
+                    if version in applied_versions:
+                        continue
+                    started = time.perf_counter()
+                    for statement in statements:
+                        await conn.execute(statement)
+                    duration_ms = int((time.perf_counter() - started) * 1000)
+                    await conn.execute(INSERT_SCHEMA_MIGRATION_SQL, (version, name, duration_ms))
+                    logger.info(f"Migration {version} ({name}) applied in {duration_ms} ms")
+                    applied.append(version)
+
+                await conn.commit()
+                return applied
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error applying migrations: {e}")
+                raise
+
+    async def get_applied_migrations(self) -> List[Dict]:
+        """Применённые миграции схемы (пусто, если миграций ещё не было)"""
+        async with self.connection('get_applied_migrations') as conn:
+            cursor = await conn.execute(SCHEMA_MIGRATIONS_EXISTS_SQL)
+            if not (await cursor.fetchone())['table_exists']:
+                return []
+            cursor = await conn.execute(SELECT_SCHEMA_MIGRATIONS_SQL)
+            return await cursor.fetchall()
+
+    async def create_consent_log(self, consent_data: Dict) -> Optional[str]:
+        """Создать запись о согласии, вернуть её UUID (None для повтора)"""
+        row = consent_log_params(consent_data)
+        user_agents = user_agent_rows([consent_data], self.stored_user_agents)
+
+        async with self.connection('create_consent_log') as conn:
+            try:
+                await conn.execute(LOCK_CONSENT_IDS_SQL, ([row[0]],))
+                cursor = await conn.execute(SELECT_EXISTING_CONSENT_IDS_SQL, existing_consent_ids_params([row]))
+                if await cursor.fetchone() is not None:
+                    await conn.rollback()
+                    return None
+                if user_agents:
+                    await conn.execute(INSERT_USER_AGENTS_SQL, [list(column) for column in zip(*user_agents)])
+                await conn.execute(INSERT_CONSENT_LOG_SQL, row)
+                await conn.commit()
+                remember_user_agents(self.stored_user_agents, user_agents)
+                return row[0]
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error creating consent log: {e}")
+                raise
+
+    async def create_consent_logs(self, consents: List[Dict]) -> List[str]:
+        """Создать несколько записей о согласии одним INSERT, вернуть UUID созданных (без повторов)"""
+        if not consents:
+            return []
+
+        rows = [consent_log_params(consent_data) for consent_data in consents]
+        user_agents = user_agent_rows(consents, self.stored_user_agents)
+
+        async with self.connection('create_consent_logs') as conn:
+            try:
+                await conn.execute(LOCK_CONSENT_IDS_SQL, ([row[0] for row in rows],))
+                cursor = await conn.execute(SELECT_EXISTING_CONSENT_IDS_SQL, existing_consent_ids_params(rows))
+                rows = new_consent_log_rows(rows, [r['consent_log_id'] for r in await cursor.fetchall()])
+                if not rows:
+                    await conn.rollback()
+                    return []
+                if user_agents:
+                    await conn.execute(INSERT_USER_AGENTS_SQL, [list(column) for column in zip(*user_agents)])
+                await conn.execute(*build_consent_logs_insert(rows))
+                await conn.commit()
+                remember_user_agents(self.stored_user_agents, user_agents)
+                return [row[0] for row in rows]
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error creating consent logs batch: {e}")
+                raise
+
+    async def get_consents_by_session(self, session_id: str) -> List[Dict]:
+        """Получить все согласия для сессии (пустой ответ реплики перепроверяется в основной БД)"""
+        async with self.read_connection('get_consents_by_session') as conn:
+            cursor = await conn.execute(SELECT_CONSENTS_BY_SESSION_SQL, (session_id,))
+            results = [dict(row) for row in await cursor.fetchall()]
+            if results or conn.read_target == PRIMARY:
+                return results
+
+        self.replicas.record_fallback('read_your_writes')
+        async with self.connection('get_consents_by_session') as conn:
+            cursor = await conn.execute(SELECT_CONSENTS_BY_SESSION_SQL, (session_id,))
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_session_consent_status(self, session_id: str) -> Dict:
+        """Получить сводный статус согласий сессии (неполный статус с реплики перечитывается)"""
+        async with self.read_connection('get_session_consent_status') as conn:
+            cursor = await conn.execute(SELECT_SESSION_STATUS_SQL, (session_id,))
+            status = decode_session_status(await cursor.fetchone())
+            if conn.read_target == PRIMARY or session_status_complete(status):
+                return status
+
+        self.replicas.record_fallback('read_your_writes')
+        async with self.connection('get_session_consent_status') as conn:
+            cursor = await conn.execute(SELECT_SESSION_STATUS_SQL, (session_id,))
+            return decode_session_status(await cursor.fetchone())
+
+    async def get_session_consent_statuses(self, session_ids: List[str]) -> Dict[str, Dict]:
+        """Получить сводные статусы согласий для многих сессий одним запросом"""
+        async with self.read_connection('get_session_consent_statuses') as conn:
+            statuses = await self._select_session_statuses(conn, session_ids)
+            if conn.read_target == PRIMARY:
+                return statuses
+
+        stale = [session_id for session_id, status in statuses.items() if not session_status_complete(status)]
+        if stale:
+            self.replicas.record_fallback('read_your_writes')
+            async with self.connection('get_session_consent_statuses') as conn:
+                statuses.update(await self._select_session_statuses(conn, stale))
+        return statuses
+
+    @staticmethod
+    async def _select_session_statuses(conn, session_ids: List[str]) -> Dict[str, Dict]:
+        cursor = await conn.execute(SELECT_SESSION_STATUSES_SQL, (session_ids,))
+        rows = {str(row['session_id']): row for row in await cursor.fetchall()}
+        return {
+            session_id: decode_session_status(rows.get(session_id))
+            for session_id in session_ids
+        }
+
+    async def create_document_snapshot(self, snapshot_data: Dict) -> str:
+        """Создать snapshot документа, вернуть его UUID"""
+        async with self.connection('create_document_snapshot') as conn:
+            try:
+                # Текст сохраняется, только если такого ещё нет (см. TicketDatabase)
+                cursor = await conn.execute(DOCUMENT_BLOB_EXISTS_SQL, (snapshot_data['content_hash'],))
+                if not (await cursor.fetchone())['blob_exists']:
+                    cursor = await conn.execute(
+                        SELECT_ACTIVE_DOCUMENT_SQL,
+                        (snapshot_data['document_type'], snapshot_data['language'])
+                    )
+                    active = await cursor.fetchone()
+                    base_blobs = []
+                    if active:
+                        cursor = await conn.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (active['content_hash'],))
+                        base_blobs = await cursor.fetchall()
+                    blob = build_document_blob(snapshot_data, base_blobs)
+                    await conn.execute(INSERT_DOCUMENT_BLOB_SQL, document_blob_params(blob))
+
+                # Деактивируем предыдущие версии этого документа
+                await conn.execute(
+                    DEACTIVATE_DOCUMENT_SNAPSHOTS_SQL,
+                    (snapshot_data['document_type'], snapshot_data['language'])
+                )
+                cursor = await conn.execute(INSERT_DOCUMENT_SNAPSHOT_SQL, document_snapshot_params(snapshot_data))
+                result = await cursor.fetchone()
+                await conn.execute(NOTIFY_DOCUMENT_SNAPSHOTS_SQL, (
+                    DOCUMENT_SNAPSHOTS_CHANNEL,
+                    f"{snapshot_data['document_type']}:{snapshot_data['language']}:{snapshot_data['version']}"
+                ))
+                await conn.commit()
+                return str(result['snapshot_id'])
+            except Exception as e:
+                await conn.rollback()
+                logger.error(f"Error creating document snapshot: {e}")
+                raise
+
+    async def get_active_document(self, document_type: str, language: str) -> Optional[Dict]:
+        """Получить активную версию документа"""
+        async with self.connection('get_active_document') as conn:
+            cursor = await conn.execute(SELECT_ACTIVE_DOCUMENT_SQL, (document_type, language))
+            result = await cursor.fetchone()
+            return dict(result) if result else None
+
+    async def get_active_documents(self) -> List[Dict]:
+        """Получить активные версии всех документов одним запросом"""
+        async with self.connection('get_active_documents') as conn:
+            cursor = await conn.execute(SELECT_ACTIVE_DOCUMENTS_SQL)
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_document_text(self, content_hash: str) -> Optional[str]:
+        """Получить текст документа по SHA-256 хешу (None, если его нет)"""
+        async with self.read_connection('get_document_text') as conn:
+            cursor = await conn.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (content_hash,))
+            full_text = document_text_from_chain(content_hash, await cursor.fetchall())
+            if full_text is not None or conn.read_target == PRIMARY:
+                return full_text
+
+        self.replicas.record_fallback('read_your_writes')
+        async with self.connection('get_document_text') as conn:
+            cursor = await conn.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (content_hash,))
+            return document_text_from_chain(content_hash, await cursor.fetchall())
+
+    async def get_consent_stats(self, date_from: Optional[str] = None) -> Dict:
+        """Получить статистику по согласиям"""
+        query, params = consent_stats_query(date_from)
+        async with self.read_connection('get_consent_stats') as conn:
+            cursor = await conn.execute(query, params)
+            result = await cursor.fetchone()
+            return dict(result) if result else {}
+
+    async def search_consents(self, filters: Dict, limit: int, after: Optional[Tuple] = None) -> List[Dict]:
+        """Страница поиска согласий, от новых к старым (см. consent_search_query)"""
+        query, params = consent_search_query(filters, limit, after)
+        async with self.read_connection('search_consents') as conn:
+            cursor = await conn.execute(query, params)
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_consent_rollup(self, periods: List[Tuple[str, object, object]]) -> Tuple[List[Dict], Dict[int, int]]:
+        """Получить статистику согласий из агрегатов (см. TicketDatabase.get_consent_rollup)"""
+        async with self.read_connection('get_consent_rollup') as conn:
+            cursor = await conn.execute(*consent_rollup_query(SELECT_CONSENT_ROLLUP_SQL, periods))
+            rows = [dict(row) for row in await cursor.fetchall()]
+            cursor = await conn.execute(*consent_rollup_query(SELECT_CONSENT_HLL_SQL, periods))
+            registers = {row['register']: row['rank'] for row in await cursor.fetchall()}
+            return rows, registers
+
+    async def get_consent_rollup_series(self, granularity: str, bucket_from, bucket_to) -> List[Dict]:
+        """Получить число согласий по часам или дням"""
+        async with self.read_connection('get_consent_rollup_series') as conn:
+            cursor = await conn.execute(SELECT_CONSENT_ROLLUP_SERIES_SQL, (granularity, bucket_from, bucket_to))
+            return [dict(row) for row in await cursor.fetchall()]
+
+    @staticmethod
+    async def _export_document_texts(conn) -> List[List[str]]:
+        """Распакованные тексты документов - параметры EXPORT_DOCUMENT_TEXTS_CTE_SQL"""
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(SELECT_DOCUMENT_BLOBS_SQL)
+            texts = decode_document_blobs(await cursor.fetchall())
+        return [list(texts.keys()), list(texts.values())]
+
+    async def stream_consent_export(self, query: str, params: List,
+                                    fetch_size: int = CONSENT_EXPORT_FETCH_SIZE,
+                                    with_texts: bool = False) -> AsyncIterator[List[Dict]]:
+        """Выгрузить результат запроса пачками (отдельное соединение, server-side курсор)"""
+        read_url = await self.get_read_url()
+        async with await psycopg.AsyncConnection.connect(read_url, row_factory=dict_row) as conn:
+            await conn.execute("SET TIME ZONE 'UTC'")
+            if with_texts:
+                params = await self._export_document_texts(conn) + list(params)
+            async with conn.cursor(name='consent_export') as cursor:
+                cursor.itersize = fetch_size
+                await cursor.execute(query, params)
+                while True:
+                    rows = await cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def stream_consent_export_csv(self, query: str, params: List,
+                                        with_texts: bool = False) -> AsyncIterator[bytes]:
+        """Выгрузить результат запроса в CSV через COPY TO STDOUT"""
+        read_url = await self.get_read_url()
+        async with await psycopg.AsyncConnection.connect(read_url) as conn:
+            await conn.execute("SET TIME ZONE 'UTC'")
+            if with_texts:
+                params = await self._export_document_texts(conn) + list(params)
+            async with conn.cursor() as cursor:
+                copy_query = f"COPY ({query}) TO STDOUT (FORMAT csv, HEADER)"
+                async with cursor.copy(copy_query, params) as copy:
+                    async for chunk in copy:
+                        yield bytes(chunk)
@@ -4,126 +4,1657 @@
 """
 
 import os
+import time
 import uuid
-from datetime import datetime
-from typing import Optional, Dict, List
+import threading
+from contextlib import contextmanager, ExitStack
+from typing import Optional, Dict, List, Tuple, Iterator
 import logging
 
 # Используем psycopg (как в основном боте)
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+from metrics import (
+    TimedConnection, observe_db_phase, DB_CONNECTIONS_IN_USE, DB_POOL_MAX_CONNECTIONS
+)
+from document_store import encode_document_text, decode_document_blobs, plan_blob_compaction
+from user_agents import user_agent_id, classify_user_agent, USER_AGENT_CACHE_SIZE
+from db_replicas import (
+    ReplicaRouter, REPLICA_LAG_SQL, DB_REPLICA_TIMEOUT, DB_REPLICA_POOL_MAX_SIZE,
+    PRIMARY, session_status_complete,
+)
 
 logger = logging.getLogger(__name__)
 
 # Подключение к БД (та же, что и у бота)
+# Проверяется при первом обращении к БД, а не при импорте
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is required")
-
 # Render использует postgres://, но psycopg требует postgresql://
-if DATABASE_URL.startswith("postgres://"):
+if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Пул соединений (свой в каждом воркере gunicorn).
+# БД общая с Telegram ботом: всего соединений от сервиса
+# не больше DB_POOL_MAX_SIZE * количество воркеров
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "5"))
+# В async режиме один воркер держит сотни одновременных запросов,
+# и его пулу (database_async.py) нужно больше соединений
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX_SIZE", "20"))
+# Сколько секунд ждать свободное соединение, прежде чем вернуть ошибку
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Простаивающие дольше этого соединения закрываются (сверх min_size)
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+# Соединение пересоздаётся не реже, чем раз в max_lifetime секунд
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+
+# На сколько месяцев вперёд создавать партиции consent_logs при миграции
+CONSENT_PARTITIONS_AHEAD = int(os.getenv("CONSENT_PARTITIONS_AHEAD", "3"))
+# Сколько строк выгрузки читать из server-side курсора за раз
+CONSENT_EXPORT_FETCH_SIZE = int(os.getenv("CONSENT_EXPORT_FETCH_SIZE", "5000"))
+# Ключ advisory lock, под которым применяются миграции схемы
+SCHEMA_LOCK_KEY = 7310001
+# Класс advisory lock (первая половина ключа) для вставки согласий с одним consent_log_id
+CONSENT_ID_LOCK_CLASS = 7310002
+# Повтор согласия ищется среди записей с тем же consent_log_id и временем
+# в пределах этого интервала от нового (время клиента у ретрая может отличаться)
+CONSENT_DEDUP_WINDOW = os.getenv("CONSENT_DEDUP_WINDOW", "24 hours")
+# Применять миграции при первом обращении к БД (для локальной разработки;
+# в продакшене - python migrations.py при деплое)
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() == "true"
+
+# Канал NOTIFY об изменении активных версий документов (см. document_cache.py)
+DOCUMENT_SNAPSHOTS_CHANNEL = "document_snapshots_changed"
+
+# Точность HyperLogLog для подсчёта уникальных сессий: 2^12 регистров,
+# стандартная ошибка около 1.6%
+CONSENT_HLL_PRECISION = 12
+
+# Биты документов в consent_session_status.consent_mask
+CONSENT_DOCUMENT_BITS = {
+    'ticket_terms': 1,
+    'refund_policy': 2,
+    'privacy_policy': 4,
+}
+
+
+# ========================================
+# SQL запросы (общие для TicketDatabase и AsyncTicketDatabase)
+# ========================================
+
+# Выражение для consent_mask по группе строк consent_logs
+CONSENT_MASK_SQL = (
+    "COALESCE(bit_or(CASE WHEN consent_given THEN CASE document_type "
+    + " ".join(f"WHEN '{doc}' THEN {bit}" for doc, bit in CONSENT_DOCUMENT_BITS.items())
+    + " END END), 0)::smallint"
+)
+
+# Колонки consent_logs в порядке создания таблицы
+CONSENT_LOG_COLUMNS = (
+    "consent_log_id, purchase_id, session_id, document_type, document_version, "
+    "document_hash, consent_given, consent_text, consent_timestamp, client_ip, "
+    "client_ip_forwarded, user_agent, ip_country, referrer_url, page_url, "
+    "created_at, document_language"
+)
+
+# Счётчики согласий по часам и дням для набора строк {source}
+# (new_rows в триггере или consent_logs при заполнении)
+CONSENT_ROLLUP_UPSERT_SQL = """
+        INSERT INTO consent_stats_rollup AS s (
+            granularity, bucket, document_type, document_version,
+            ip_country, consent_given, consent_count
+        )
+        SELECT
+            g.granularity,
+            date_trunc(g.granularity, c.consent_timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+            c.document_type, c.document_version,
+            COALESCE(c.ip_country, ''), c.consent_given, COUNT(*)
+        FROM {source} c
+        CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+        GROUP BY 1, 2, 3, 4, 5, 6
+        ON CONFLICT (granularity, bucket, document_type, document_version, ip_country, consent_given)
+        DO UPDATE SET consent_count = s.consent_count + EXCLUDED.consent_count
+"""
+
+# HyperLogLog регистры уникальных сессий по часам и дням для набора строк {source}.
+# Хеш сессии - первые 64 бита md5: старшие CONSENT_HLL_PRECISION бит - номер
+# регистра, в регистре - максимальная позиция первой единицы в остальных битах.
+# Хранятся только ненулевые регистры, объединение периодов - max(rank)
+CONSENT_HLL_UPSERT_SQL = f"""
+        INSERT INTO consent_sessions_hll AS s (granularity, bucket, register, rank)
+        SELECT
+            g.granularity,
+            date_trunc(g.granularity, c.consent_timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+            substring(h.hash FROM 1 FOR {CONSENT_HLL_PRECISION})::integer,
+            max(COALESCE(
+                NULLIF(position(B'1' IN substring(h.hash FROM {CONSENT_HLL_PRECISION + 1})), 0),
+                {64 - CONSENT_HLL_PRECISION + 1}
+            ))
+        FROM {{source}} c
+        CROSS JOIN LATERAL (
+            SELECT ('x' || substr(md5(c.session_id::text), 1, 16))::bit(64) AS hash
+        ) h
+        CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+        GROUP BY 1, 2, 3
+        ON CONFLICT (granularity, bucket, register)
+        DO UPDATE SET rank = EXCLUDED.rank WHERE s.rank < EXCLUDED.rank
+"""
+
+SCHEMA_STATEMENTS = [
+    # Переход на партиционирование: старая (обычная) таблица consent_logs
+    # переименовывается и ниже подключается как партиция consent_logs_legacy
+    # со всеми записями до начала текущего месяца
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT 1 FROM pg_class
+            WHERE oid = to_regclass('consent_logs') AND relkind = 'r'
+        ) THEN
+            ALTER TABLE consent_logs ADD COLUMN IF NOT EXISTS document_language TEXT;
+            -- Партиция не может иметь триггер с transition table
+            DROP TRIGGER IF EXISTS trg_consent_session_status ON consent_logs;
+            ALTER TABLE consent_logs RENAME TO consent_logs_unpartitioned;
+            -- Первичный ключ партиции должен совпадать с ключом consent_logs
+            ALTER TABLE consent_logs_unpartitioned DROP CONSTRAINT consent_logs_pkey;
+            ALTER TABLE consent_logs_unpartitioned
+                ADD CONSTRAINT consent_logs_legacy_pkey PRIMARY KEY (consent_log_id, consent_timestamp);
+            ALTER INDEX IF EXISTS idx_consent_session RENAME TO consent_logs_legacy_session_idx;
+            ALTER INDEX IF EXISTS idx_consent_type RENAME TO consent_logs_legacy_type_idx;
+            ALTER INDEX IF EXISTS idx_consent_timestamp RENAME TO consent_logs_legacy_timestamp_idx;
+        END IF;
+    END
+    $$
+    """,
+    
+    # Таблица consent_logs (логи согласий), помесячные партиции по consent_timestamp
+    """
+    CREATE TABLE IF NOT EXISTS consent_logs (
+        consent_log_id UUID NOT NULL DEFAULT gen_random_uuid(),
+        purchase_id UUID,
+        session_id UUID NOT NULL,
+        
+        -- Имя ограничения совпадает со старой таблицей (иначе её не подключить)
+        document_type TEXT NOT NULL 
+            CONSTRAINT consent_logs_document_type_check CHECK (document_type IN ('ticket_terms', 'refund_policy', 'privacy_policy')),
+        
+        document_version TEXT NOT NULL,
+        document_hash TEXT NOT NULL,
+        
+        consent_given BOOLEAN NOT NULL DEFAULT TRUE,
+        consent_text TEXT,
+        consent_timestamp TIMESTAMPTZ NOT NULL,
+        
+        client_ip TEXT,
+        client_ip_forwarded TEXT,
+        user_agent TEXT,
+        ip_country TEXT,
+        referrer_url TEXT,
+        page_url TEXT,
+        
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        
+        -- Язык документа, с которым согласился пользователь
+        document_language TEXT,
+        
+        -- Ключ партиционированной таблицы обязан включать ключ партиционирования
+        PRIMARY KEY (consent_log_id, consent_timestamp)
+    ) PARTITION BY RANGE (consent_timestamp)
+    """,
+    
+    # Записи, для которых нет помесячной партиции (например, с неверными часами клиента)
+    """
+    CREATE TABLE IF NOT EXISTS consent_logs_default
+    PARTITION OF consent_logs DEFAULT
+    """,
+    
+    # Подключение старой таблицы как партиции [MINVALUE, начало текущего месяца).
+    # Записи с более поздним consent_timestamp переносятся в consent_logs_default,
+    # откуда consent_logs_ensure_partitions разложит их по месяцам
+    f"""
+    DO $$
+    DECLARE
+        legacy_bound TIMESTAMPTZ := date_trunc('month', NOW() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    BEGIN
+        IF to_regclass('consent_logs_unpartitioned') IS NOT NULL THEN
+            WITH moved AS (
+                DELETE FROM consent_logs_unpartitioned
+                WHERE consent_timestamp >= legacy_bound
+                RETURNING {CONSENT_LOG_COLUMNS}
+            )
+            INSERT INTO consent_logs_default ({CONSENT_LOG_COLUMNS})
+            SELECT {CONSENT_LOG_COLUMNS} FROM moved;
+            
+            EXECUTE format(
+                'ALTER TABLE consent_logs ATTACH PARTITION consent_logs_unpartitioned '
+                'FOR VALUES FROM (MINVALUE) TO (%L)',
+                legacy_bound
+            );
+            ALTER TABLE consent_logs_unpartitioned RENAME TO consent_logs_legacy;
+        END IF;
+    END
+    $$
+    """,
+    
+    # Индексы для consent_logs (создаются на каждой партиции)
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_session 
+    ON consent_logs(session_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_type 
+    ON consent_logs(document_type)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_timestamp 
+    ON consent_logs(consent_timestamp)
+    """,
+    
+    # Создание помесячных партиций consent_logs_YYYY_MM от текущего месяца
+    # на months_ahead месяцев вперёд (границы - по UTC). Записи нового месяца,
+    # уже попавшие в consent_logs_default, переносятся в его партицию.
+    # Возвращает число созданных партиций
+    """
+    CREATE OR REPLACE FUNCTION consent_logs_ensure_partitions(months_ahead INTEGER)
+    RETURNS INTEGER AS $$
+    DECLARE
+        current_month TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+        month_start TIMESTAMPTZ;
+        month_end TIMESTAMPTZ;
+        partition_name TEXT;
+        created INTEGER := 0;
+    BEGIN
+        FOR i IN 0..months_ahead LOOP
+            month_start := (current_month + make_interval(months => i)) AT TIME ZONE 'UTC';
+            month_end := (current_month + make_interval(months => i + 1)) AT TIME ZONE 'UTC';
+            partition_name := 'consent_logs_' || to_char(current_month + make_interval(months => i), 'YYYY_MM');
+            
+            CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+            
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE consent_logs INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                partition_name
+            );
+            EXECUTE format(
+                'WITH moved AS ('
+                '    DELETE FROM consent_logs_default'
+                '    WHERE consent_timestamp >= %L AND consent_timestamp < %L'
+                '    RETURNING *'
+                ') INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE consent_logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            created := created + 1;
+        END LOOP;
+        RETURN created;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    f"SELECT consent_logs_ensure_partitions({CONSENT_PARTITIONS_AHEAD})",
+    
+    # Таблица document_snapshots (архив версий документов)
+    """
+    CREATE TABLE IF NOT EXISTS document_snapshots (
+        snapshot_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        
+        document_type TEXT NOT NULL 
+            CHECK (document_type IN ('ticket_terms', 'refund_policy', 'privacy_policy')),
+        
+        version TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        
+        full_text TEXT NOT NULL,
+        language TEXT NOT NULL CHECK (language IN ('ru', 'en', 'he')),
+        
+        is_active BOOLEAN DEFAULT TRUE,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        created_by TEXT,
+        
+        UNIQUE(document_type, language, version)
+    )
+    """,
+    
+    # Индекс для document_snapshots
+    """
+    CREATE INDEX IF NOT EXISTS idx_snapshots_active 
+    ON document_snapshots(document_type, language, is_active)
+    """,
+    
+    # Сводный статус согласий сессии (для /api/consent/verify одним lookup по ключу).
+    # consent_mask - OR битов CONSENT_DOCUMENT_BITS по записям с consent_given = TRUE
+    """
+    CREATE TABLE IF NOT EXISTS consent_session_status (
+        session_id UUID PRIMARY KEY,
+        consent_mask SMALLINT NOT NULL DEFAULT 0,
+        total_logged INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    
+    # Однократное заполнение сводки по уже существующим записям
+    f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM consent_session_status LIMIT 1) THEN
+            INSERT INTO consent_session_status (session_id, consent_mask, total_logged)
+            SELECT session_id, {CONSENT_MASK_SQL}, COUNT(*)
+            FROM consent_logs
+            GROUP BY session_id
+            ON CONFLICT (session_id) DO NOTHING;
+        END IF;
+    END
+    $$
+    """,
+    
+    # Сводка обновляется триггером один раз на INSERT (а не на каждую строку),
+    # поэтому пачка из трёх согласий сессии - это один upsert
+    f"""
+    CREATE OR REPLACE FUNCTION consent_session_status_refresh() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO consent_session_status AS s (session_id, consent_mask, total_logged, updated_at)
+        SELECT session_id, {CONSENT_MASK_SQL}, COUNT(*), NOW()
+        FROM new_rows
+        GROUP BY session_id
+        ON CONFLICT (session_id) DO UPDATE SET
+            consent_mask = s.consent_mask | EXCLUDED.consent_mask,
+            total_logged = s.total_logged + EXCLUDED.total_logged,
+            updated_at = EXCLUDED.updated_at;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DROP TRIGGER IF EXISTS trg_consent_session_status ON consent_logs
+    """,
+    """
+    CREATE TRIGGER trg_consent_session_status
+    AFTER INSERT ON consent_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION consent_session_status_refresh()
+    """,
+    
+    # Статистика согласий по часам и дням (для /api/admin/stats)
+    """
+    CREATE TABLE IF NOT EXISTS consent_stats_rollup (
+        granularity TEXT NOT NULL CHECK (granularity IN ('hour', 'day')),
+        bucket TIMESTAMPTZ NOT NULL,
+        document_type TEXT NOT NULL,
+        document_version TEXT NOT NULL,
+        ip_country TEXT NOT NULL DEFAULT '',
+        consent_given BOOLEAN NOT NULL,
+        consent_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (granularity, bucket, document_type, document_version, ip_country, consent_given)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS consent_sessions_hll (
+        granularity TEXT NOT NULL CHECK (granularity IN ('hour', 'day')),
+        bucket TIMESTAMPTZ NOT NULL,
+        register SMALLINT NOT NULL,
+        rank SMALLINT NOT NULL,
+        PRIMARY KEY (granularity, bucket, register)
+    )
+    """,
+    
+    # Однократное заполнение статистики по уже существующим записям
+    f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM consent_stats_rollup LIMIT 1) THEN
+            {CONSENT_ROLLUP_UPSERT_SQL.format(source='consent_logs')};
+            {CONSENT_HLL_UPSERT_SQL.format(source='consent_logs')};
+        END IF;
+    END
+    $$
+    """,
+    
+    # Как и сводка сессий, статистика обновляется один раз на INSERT
+    f"""
+    CREATE OR REPLACE FUNCTION consent_stats_refresh() RETURNS trigger AS $$
+    BEGIN
+        {CONSENT_ROLLUP_UPSERT_SQL.format(source='new_rows')};
+        {CONSENT_HLL_UPSERT_SQL.format(source='new_rows')};
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DROP TRIGGER IF EXISTS trg_consent_stats ON consent_logs
+    """,
+    """
+    CREATE TRIGGER trg_consent_stats
+    AFTER INSERT ON consent_logs
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION consent_stats_refresh()
+    """,
+]
+
+# Тексты документов - отдельно, по SHA-256 хешу и в сжатом виде
+# (см. document_store.py). Миграция переносит существующие тексты
+# как есть (encoding = 'none'), сжимает их python migrations.py
+DOCUMENT_BLOBS_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS document_blobs (
+        content_hash TEXT PRIMARY KEY,
+        encoding TEXT NOT NULL CHECK (encoding IN ('none', 'zstd', 'zstd-delta')),
+        base_hash TEXT REFERENCES document_blobs(content_hash),
+        delta_depth SMALLINT NOT NULL DEFAULT 0,
+        original_size INTEGER NOT NULL,
+        data BYTEA NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        CHECK ((encoding = 'zstd-delta') = (base_hash IS NOT NULL))
+    )
+    """,
+    # Данные уже сжаты zstd - TOAST не должен сжимать их ещё раз
+    """
+    ALTER TABLE document_blobs ALTER COLUMN data SET STORAGE EXTERNAL
+    """,
+    """
+    INSERT INTO document_blobs (content_hash, encoding, original_size, data, created_at)
+    SELECT DISTINCT ON (content_hash)
+        content_hash, 'none', octet_length(full_text), convert_to(full_text, 'UTF8'), created_at
+    FROM document_snapshots
+    ORDER BY content_hash, created_at
+    ON CONFLICT (content_hash) DO NOTHING
+    """,
+    """
+    ALTER TABLE document_snapshots DROP COLUMN full_text
+    """,
+    """
+    ALTER TABLE document_snapshots
+    ADD CONSTRAINT document_snapshots_content_hash_fkey
+    FOREIGN KEY (content_hash) REFERENCES document_blobs(content_hash)
+    """,
+]
+
+# Поля consent_logs, входящие в хеш записи (record_hash): (колонка, вид).
+# Тот же хеш по тем же правилам считает consent_ledger.py при проверке.
+# ip_country не входит: geoip.py backfill заполняет её позже
+CONSENT_LEDGER_FIELDS = [
+    ('consent_log_id', 'uuid'),
+    ('purchase_id', 'uuid'),
+    ('session_id', 'uuid'),
+    ('document_type', 'text'),
+    ('document_version', 'text'),
+    ('document_hash', 'text'),
+    ('document_language', 'text'),
+    ('consent_given', 'bool'),
+    ('consent_text', 'text'),
+    ('consent_timestamp', 'timestamp'),
+    ('client_ip', 'text'),
+    ('client_ip_forwarded', 'text'),
+    ('user_agent', 'text'),
+    ('referrer_url', 'text'),
+    ('page_url', 'text'),
+    ('created_at', 'timestamp'),
+]
+
+# Поле в тексте записи: NULL -> '-', иначе '<длина>:<значение>'
+# (время - микросекунды от 1970-01-01 UTC, bool - '1' / '0')
+CONSENT_LEDGER_FIELD_SQL = {
+    'text': "c.{column}",
+    'uuid': "c.{column}::text",
+    'bool': "CASE WHEN c.{column} THEN '1' WHEN NOT c.{column} THEN '0' END",
+    'timestamp': "(extract(epoch FROM c.{column}) * 1000000)::bigint::text",
+}
+
+
+def consent_record_text_sql(overrides: Optional[Dict[str, str]] = None) -> str:
+    """Текст записи для хеша; overrides - свои выражения для отдельных колонок"""
+    overrides = overrides or {}
+    return " ||\n            ".join(
+        f"consent_ledger_field({overrides.get(column) or CONSENT_LEDGER_FIELD_SQL[kind].format(column=column)})"
+        for column, kind in CONSENT_LEDGER_FIELDS
+    )
+
+
+CONSENT_RECORD_TEXT_SQL = consent_record_text_sql()
+
+# Журнал целостности согласий (см. consent_ledger.py): хеш каждой записи
+# считается при INSERT независимо от других записей (без общей блокировки),
+# а цепочку образуют блоки по created_at с корнем дерева Меркла
+CONSENT_LEDGER_STATEMENTS = [
+    """
+    ALTER TABLE consent_logs ADD COLUMN IF NOT EXISTS record_hash BYTEA
+    """,
+    """
+    CREATE OR REPLACE FUNCTION consent_ledger_field(value TEXT) RETURNS TEXT AS $$
+        SELECT CASE WHEN value IS NULL THEN '-' ELSE length(value) || ':' || value END
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION consent_record_hash(c consent_logs) RETURNS BYTEA AS $$
+        SELECT sha256(convert_to(
+            {CONSENT_RECORD_TEXT_SQL},
+            'UTF8'
+        ))
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION consent_record_hash_set() RETURNS trigger AS $$
+    BEGIN
+        NEW.record_hash := consent_record_hash(NEW);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    DROP TRIGGER IF EXISTS trg_consent_record_hash ON consent_logs
+    """,
+    """
+    CREATE TRIGGER trg_consent_record_hash
+    BEFORE INSERT ON consent_logs
+    FOR EACH ROW EXECUTE FUNCTION consent_record_hash_set()
+    """,
+    # Блоки журнала выбираются по created_at; записи внутри партиции
+    # идут примерно по времени вставки, так что BRIN почти ничего не стоит
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_logs_created_at
+    ON consent_logs USING brin (created_at)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS consent_ledger_blocks (
+        block_start TIMESTAMPTZ PRIMARY KEY,
+        block_end TIMESTAMPTZ NOT NULL,
+        row_count INTEGER NOT NULL,
+        merkle_root TEXT NOT NULL,
+        prev_hash TEXT NOT NULL,
+        block_hash TEXT NOT NULL UNIQUE,
+        sealed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+]
+
+# Индексы под запросы TicketDatabase (проверка планов - python benchmark.py plans)
+QUERY_INDEXES_STATEMENTS = [
+    # Согласия сессии по времени: без сортировки и без чтения таблицы
+    # (index only scan по всем колонкам SELECT_CONSENTS_BY_SESSION_SQL)
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_session_timestamp
+    ON consent_logs(session_id, consent_timestamp)
+    INCLUDE (consent_log_id, document_type, document_version, consent_given)
+    """,
+    """
+    DROP INDEX IF EXISTS idx_consent_session
+    """,
+    # У document_type три значения: индекс не выбирает ни один запрос,
+    # а обновляется при каждой вставке
+    """
+    DROP INDEX IF EXISTS idx_consent_type
+    """,
+    # Выгрузка и geoip.py backfill идут в порядке (consent_timestamp, consent_log_id)
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_timestamp_id
+    ON consent_logs(consent_timestamp, consent_log_id)
+    """,
+    """
+    DROP INDEX IF EXISTS idx_consent_timestamp
+    """,
+    # Активных версий - по одной на документ и язык: частичный индекс
+    # маленький и уже отсортирован для ORDER BY created_at DESC
+    """
+    CREATE INDEX IF NOT EXISTS idx_snapshots_active_created
+    ON document_snapshots(document_type, language, created_at DESC)
+    WHERE is_active
+    """,
+    """
+    DROP INDEX IF EXISTS idx_snapshots_active
+    """,
+]
+
+# Строка user agent записи: своя (сохранённая до справочника) или из user_agents
+RESOLVED_USER_AGENT_SQL = (
+    "COALESCE(c.user_agent, "
+    "(SELECT ua.user_agent FROM user_agents ua WHERE ua.user_agent_id = c.user_agent_id))"
+)
+
+# Справочник user agent (см. user_agents.py): строка хранится один раз,
+# в consent_logs - только user_agent_id. Хеш записи считается по самой
+# строке, поэтому не зависит от того, где она хранится
+USER_AGENTS_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS user_agents (
+        user_agent_id BIGINT PRIMARY KEY,
+        user_agent TEXT NOT NULL,
+        browser VARCHAR(50) NOT NULL,
+        os VARCHAR(50) NOT NULL,
+        device VARCHAR(20) NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    ALTER TABLE consent_logs ADD COLUMN IF NOT EXISTS user_agent_id BIGINT
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION consent_record_hash(c consent_logs) RETURNS BYTEA AS $$
+        SELECT sha256(convert_to(
+            {consent_record_text_sql({'user_agent': RESOLVED_USER_AGENT_SQL})},
+            'UTF8'
+        ))
+    $$ LANGUAGE sql STABLE
+    """,
+]
+
+# Страница согласия без параметров запроса и якоря (utm_* и т.п. у одной
+# страницы разные); обрезана, чтобы длинный URL не превысил размер строки индекса
+CONSENT_PAGE_SQL = "left(split_part(split_part({column}, '#', 1), '?', 1), 500)"
+CONSENT_PAGE_MAX_LENGTH = 500
+
+# Индексы под поиск согласий поддержкой (GET /api/admin/consents): каждый
+# фильтр плюс (consent_timestamp, consent_log_id) - порядок страниц, поэтому
+# любая страница читает из индекса только свои строки
+CONSENT_SEARCH_INDEXES_STATEMENTS = [
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_client_ip_timestamp
+    ON consent_logs(client_ip, consent_timestamp, consent_log_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_consent_version_timestamp
+    ON consent_logs(document_version, consent_timestamp, consent_log_id)
+    """,
+    f"""
+    CREATE INDEX IF NOT EXISTS idx_consent_page_timestamp
+    ON consent_logs(({CONSENT_PAGE_SQL.format(column='page_url')}), consent_timestamp, consent_log_id)
+    """,
+]
+
+# Миграция 7 создавала таблицу ключей согласий consent_log_keys; повторы
+# теперь ищутся по первичному ключу consent_logs (SELECT_EXISTING_CONSENT_IDS_SQL),
+# таблица удаляется миграцией 8
+CONSENT_LOG_KEYS_STATEMENTS = []
+DROP_CONSENT_LOG_KEYS_STATEMENTS = [
+    """
+    DROP TABLE IF EXISTS consent_log_keys
+    """,
+]
+
+# Версионированные миграции схемы: (версия, имя, SQL запросы).
+# Применяются по порядку командой python migrations.py, каждая один раз.
+# Любое изменение схемы - новая миграция в конце списка.
+SCHEMA_MIGRATIONS = [
+    (1, 'initial_schema', SCHEMA_STATEMENTS),
+    (2, 'document_blobs', DOCUMENT_BLOBS_STATEMENTS),
+    (3, 'consent_ledger', CONSENT_LEDGER_STATEMENTS),
+    (4, 'query_indexes', QUERY_INDEXES_STATEMENTS),
+    (5, 'user_agents', USER_AGENTS_STATEMENTS),
+    (6, 'consent_search_indexes', CONSENT_SEARCH_INDEXES_STATEMENTS),
+    (7, 'consent_log_keys', CONSENT_LOG_KEYS_STATEMENTS),
+    (8, 'drop_consent_log_keys', DROP_CONSENT_LOG_KEYS_STATEMENTS),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# Миграции с нескольких машин/процессов применяются по очереди
+SCHEMA_LOCK_SQL = f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_KEY})"
+
+CREATE_SCHEMA_MIGRATIONS_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+        duration_ms INTEGER
+    )
+"""
+
+SCHEMA_MIGRATIONS_EXISTS_SQL = "SELECT to_regclass('schema_migrations') IS NOT NULL AS table_exists"
+
+SELECT_SCHEMA_MIGRATIONS_SQL = """
+    SELECT version, name, applied_at, duration_ms
+    FROM schema_migrations
+    ORDER BY version
+"""
+
+INSERT_SCHEMA_MIGRATION_SQL = """
+    INSERT INTO schema_migrations (version, name, duration_ms)
+    VALUES (%s, %s, %s)
+"""
+
+# Вставки согласий с одним consent_log_id идут по очереди (до конца
+# транзакции): иначе два ретрая с разным временем оба не найдут друг друга
+LOCK_CONSENT_IDS_SQL = f"""
+    SELECT pg_advisory_xact_lock({CONSENT_ID_LOCK_CLASS}, hashtext(consent_log_id))
+    FROM (SELECT DISTINCT unnest(%s::text[]) AS consent_log_id ORDER BY 1) AS ids
+"""
+
+# Уже сохранённые повторы (см. consent_dedup.py): тот же consent_log_id
+# с временем в пределах CONSENT_DEDUP_WINDOW. Первичный ключ начинается
+# с consent_log_id, а окно по времени оставляет только партиции рядом с
+# временем согласия, поэтому это несколько поисков по индексу, а не
+# просмотр всех партиций
+SELECT_EXISTING_CONSENT_IDS_SQL = """
+    SELECT DISTINCT c.consent_log_id
+    FROM unnest(%s::uuid[], %s::timestamptz[]) AS k(consent_log_id, consent_timestamp)
+    JOIN consent_logs c
+      ON c.consent_log_id = k.consent_log_id
+     AND c.consent_timestamp BETWEEN k.consent_timestamp - %s::interval
+                                 AND k.consent_timestamp + %s::interval
+"""
+
+# ON CONFLICT - страховка для точного повтора (тот же ключ партиций)
+INSERT_CONSENT_LOG_SQL = """
+    INSERT INTO consent_logs (
+        consent_log_id,
+        session_id, document_type, document_version, document_hash,
+        document_language,
+        consent_given, consent_text, consent_timestamp,
+        client_ip, client_ip_forwarded, user_agent_id,
+        ip_country, referrer_url, page_url
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (consent_log_id, consent_timestamp) DO NOTHING
+"""
+
+INSERT_CONSENT_LOGS_BATCH_SQL = """
+    INSERT INTO consent_logs (
+        consent_log_id,
+        session_id, document_type, document_version, document_hash,
+        document_language,
+        consent_given, consent_text, consent_timestamp,
+        client_ip, client_ip_forwarded, user_agent_id,
+        ip_country, referrer_url, page_url
+    ) VALUES
+    {values}
+    ON CONFLICT (consent_log_id, consent_timestamp) DO NOTHING
+"""
+
+# Строки user agent, которых ещё нет в справочнике (вставляются в той же
+# транзакции перед согласиями: триггер хеша записи читает строку по ID)
+INSERT_USER_AGENTS_SQL = """
+    INSERT INTO user_agents (user_agent_id, user_agent, browser, os, device)
+    SELECT * FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::text[], %s::text[])
+    ON CONFLICT (user_agent_id) DO NOTHING
+"""
+
+SELECT_CONSENTS_BY_SESSION_SQL = """
+    SELECT 
+        consent_log_id, session_id, document_type,
+        document_version, consent_given, consent_timestamp
+    FROM consent_logs
+    WHERE session_id = %s
+    ORDER BY consent_timestamp ASC
+"""
+
+SELECT_SESSION_STATUS_SQL = """
+    SELECT session_id, consent_mask, total_logged
+    FROM consent_session_status
+    WHERE session_id = %s
+"""
+
+SELECT_SESSION_STATUSES_SQL = """
+    SELECT session_id, consent_mask, total_logged
+    FROM consent_session_status
+    WHERE session_id = ANY(%s::uuid[])
+"""
+
+# Счётчики и HLL регистры за набор периодов: {periods} - условия вида
+# (granularity = %s AND bucket >= %s AND bucket < %s), соединённые OR
+SELECT_CONSENT_ROLLUP_SQL = """
+    SELECT document_type, document_version, ip_country, consent_given,
+           SUM(consent_count)::bigint AS consent_count
+    FROM consent_stats_rollup
+    WHERE {periods}
+    GROUP BY document_type, document_version, ip_country, consent_given
+"""
+
+SELECT_CONSENT_ROLLUP_SERIES_SQL = """
+    SELECT bucket, SUM(consent_count)::bigint AS consent_count
+    FROM consent_stats_rollup
+    WHERE granularity = %s AND bucket >= %s AND bucket < %s
+    GROUP BY bucket
+    ORDER BY bucket
+"""
+
+SELECT_CONSENT_HLL_SQL = """
+    SELECT register, MAX(rank) AS rank
+    FROM consent_sessions_hll
+    WHERE {periods}
+    GROUP BY register
+"""
+
+# Записи без страны для geoip.py backfill, по порядку (consent_timestamp,
+# consent_log_id) начиная после заданной пары (по индексу idx_consent_timestamp_id)
+SELECT_CONSENTS_WITHOUT_COUNTRY_SQL = """
+    SELECT consent_log_id, consent_timestamp, client_ip
+    FROM consent_logs
+    WHERE ip_country IS NULL AND client_ip IS NOT NULL
+      AND consent_timestamp >= %(after_timestamp)s
+      AND (consent_timestamp > %(after_timestamp)s OR consent_log_id > %(after_id)s)
+    ORDER BY consent_timestamp, consent_log_id
+    LIMIT %(limit)s
+"""
+
+# Записи со строкой user agent (сохранённые до справочника) для
+# user_agents.py backfill, в том же порядке, что и geoip.py backfill
+SELECT_CONSENTS_WITH_USER_AGENT_SQL = """
+    SELECT consent_log_id, consent_timestamp, user_agent
+    FROM consent_logs
+    WHERE user_agent IS NOT NULL
+      AND consent_timestamp >= %(after_timestamp)s
+      AND (consent_timestamp > %(after_timestamp)s OR consent_log_id > %(after_id)s)
+    ORDER BY consent_timestamp, consent_log_id
+    LIMIT %(limit)s
+"""
+
+# Перенос строки в справочник пачкой (id, время, user_agent_id): строки
+# справочника вставляются до этого запроса, поэтому record_hash не меняется
+UPDATE_CONSENT_USER_AGENTS_SQL = """
+    UPDATE consent_logs c
+    SET user_agent_id = m.user_agent_id, user_agent = NULL
+    FROM unnest(%s::uuid[], %s::timestamptz[], %s::bigint[])
+        AS m(consent_log_id, consent_timestamp, user_agent_id)
+    WHERE c.consent_log_id = m.consent_log_id
+      AND c.consent_timestamp = m.consent_timestamp
+      AND c.user_agent IS NOT NULL
+"""
+
+SELECT_USER_AGENTS_SQL = """
+    SELECT user_agent_id, user_agent, browser, os, device
+    FROM user_agents
+    ORDER BY user_agent_id
+"""
+
+UPDATE_USER_AGENT_FAMILIES_SQL = """
+    UPDATE user_agents ua
+    SET browser = m.browser, os = m.os, device = m.device
+    FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::text[])
+        AS m(user_agent_id, browser, os, device)
+    WHERE ua.user_agent_id = m.user_agent_id
+"""
+
+# Заполнение ip_country пачкой (id, время, страна). Триггеры статистики
+# срабатывают только на INSERT, поэтому счётчики этих записей в том же
+# запросе переносятся из ip_country = '' в их страну
+UPDATE_CONSENT_COUNTRIES_SQL = f"""
+    WITH countries AS (
+        SELECT *
+        FROM unnest(%s::uuid[], %s::timestamptz[], %s::text[])
+            AS m(consent_log_id, consent_timestamp, ip_country)
+    ),
+    updated AS (
+        UPDATE consent_logs c
+        SET ip_country = m.ip_country
+        FROM countries m
+        WHERE c.consent_log_id = m.consent_log_id
+          AND c.consent_timestamp = m.consent_timestamp
+          AND c.ip_country IS NULL
+        RETURNING c.consent_timestamp, c.document_type, c.document_version,
+                  c.ip_country, c.consent_given
+    ),
+    uncounted AS (
+        UPDATE consent_stats_rollup s
+        SET consent_count = s.consent_count - r.consent_count
+        FROM (
+            SELECT
+                g.granularity,
+                date_trunc(g.granularity, u.consent_timestamp AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket,
+                u.document_type, u.document_version, u.consent_given, COUNT(*) AS consent_count
+            FROM updated u
+            CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+            GROUP BY 1, 2, 3, 4, 5
+        ) r
+        WHERE s.granularity = r.granularity AND s.bucket = r.bucket
+          AND s.document_type = r.document_type AND s.document_version = r.document_version
+          AND s.ip_country = '' AND s.consent_given = r.consent_given
+    ),
+    counted AS ({CONSENT_ROLLUP_UPSERT_SQL.format(source='updated')})
+    SELECT COUNT(*) AS updated FROM updated
+"""
+
+DEACTIVATE_DOCUMENT_SNAPSHOTS_SQL = """
+    UPDATE document_snapshots
+    SET is_active = FALSE
+    WHERE document_type = %s 
+    AND language = %s 
+    AND is_active = TRUE
+"""
+
+INSERT_DOCUMENT_SNAPSHOT_SQL = """
+    INSERT INTO document_snapshots (
+        document_type, version, content_hash,
+        language, created_by
+    ) VALUES (
+        %s, %s, %s, %s, %s
+    )
+    RETURNING snapshot_id
+"""
+
+# Текст уже сохранён (под другой версией или другим документом)
+DOCUMENT_BLOB_EXISTS_SQL = """
+    SELECT EXISTS (SELECT 1 FROM document_blobs WHERE content_hash = %s) AS blob_exists
+"""
+
+# Повтор того же текста из параллельной загрузки не вставляется
+INSERT_DOCUMENT_BLOB_SQL = """
+    INSERT INTO document_blobs (
+        content_hash, encoding, base_hash, delta_depth, original_size, data
+    ) VALUES (
+        %s, %s, %s, %s, %s, %s
+    )
+    ON CONFLICT (content_hash) DO NOTHING
+"""
+
+# Запись текста и все записи, от которых она зависит (base_hash дельт).
+# LATERAL с LIMIT (подзапрос не разворачивается в обычный JOIN) - чтобы
+# каждый шаг был поиском по ключу, а не hash join со всей таблицей:
+# планировщик не знает, что цепочка короткая
+SELECT_DOCUMENT_BLOB_CHAIN_SQL = """
+    WITH RECURSIVE chain AS (
+        SELECT content_hash, encoding, base_hash, delta_depth, data, 0 AS position
+        FROM document_blobs
+        WHERE content_hash = %s
+        UNION ALL
+        SELECT b.content_hash, b.encoding, b.base_hash, b.delta_depth, b.data, chain.position + 1
+        FROM chain
+        CROSS JOIN LATERAL (
+            SELECT * FROM document_blobs WHERE content_hash = chain.base_hash LIMIT 1
+        ) b
+    )
+    SELECT content_hash, encoding, base_hash, delta_depth, data
+    FROM chain
+    ORDER BY position
+"""
+
+SELECT_DOCUMENT_BLOBS_SQL = """
+    SELECT content_hash, encoding, base_hash, delta_depth, data
+    FROM document_blobs
+"""
+
+SELECT_DOCUMENT_SNAPSHOT_HASHES_SQL = """
+    SELECT content_hash, document_type, language
+    FROM document_snapshots
+    ORDER BY created_at, snapshot_id
+"""
+
+UPDATE_DOCUMENT_BLOB_SQL = """
+    UPDATE document_blobs
+    SET encoding = %s, base_hash = %s, delta_depth = %s, data = %s
+    WHERE content_hash = %s
+    AND encoding = 'none'
+"""
+
+DOCUMENT_BLOB_STATS_SQL = """
+    SELECT
+        encoding,
+        COUNT(*) AS blobs,
+        COALESCE(SUM(original_size), 0) AS original_bytes,
+        COALESCE(SUM(octet_length(data)), 0) AS stored_bytes
+    FROM document_blobs
+    GROUP BY encoding
+    ORDER BY encoding
+"""
+
+SELECT_ACTIVE_DOCUMENT_SQL = """
+    SELECT
+        snapshot_id, document_type, language, version,
+        content_hash, is_active, created_at, created_by
+    FROM document_snapshots
+    WHERE document_type = %s 
+    AND language = %s 
+    AND is_active = TRUE
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+SELECT_ACTIVE_DOCUMENTS_SQL = """
+    SELECT DISTINCT ON (document_type, language)
+        snapshot_id, document_type, language, version,
+        content_hash, created_at
+    FROM document_snapshots
+    WHERE is_active = TRUE
+    ORDER BY document_type, language, created_at DESC
+"""
+
+NOTIFY_DOCUMENT_SNAPSHOTS_SQL = "SELECT pg_notify(%s, %s)"
+
+CONSENT_STATS_SQL = """
+    SELECT 
+        COUNT(*) as total_consents,
+        COUNT(DISTINCT session_id) as unique_sessions,
+        COUNT(*) FILTER (WHERE document_type = 'ticket_terms') as ticket_terms_count,
+        COUNT(*) FILTER (WHERE document_type = 'refund_policy') as refund_policy_count,
+        COUNT(*) FILTER (WHERE document_type = 'privacy_policy') as privacy_policy_count
+    FROM consent_logs
+"""
+
+# Выгрузка согласий вместе с версией документа, с которой согласился
+# пользователь (document_snapshots уникальны по type/language/version)
+EXPORT_CONSENTS_SQL = """{text_cte}
+    SELECT
+        c.consent_log_id, c.session_id, c.purchase_id,
+        c.document_type, c.document_version, c.document_hash, c.document_language,
+        c.consent_given, c.consent_text, c.consent_timestamp,
+        c.client_ip, c.client_ip_forwarded,
+        COALESCE(c.user_agent, ua.user_agent) AS user_agent, c.ip_country,
+        c.referrer_url, c.page_url, c.created_at,
+        s.snapshot_id, s.content_hash AS snapshot_hash,
+        (s.content_hash = c.document_hash) AS snapshot_hash_matches{text_column}
+    FROM consent_logs c
+    LEFT JOIN document_snapshots s
+        ON s.document_type = c.document_type
+        AND s.version = c.document_version
+        AND s.language = COALESCE(c.document_language, %s){text_join}
+    LEFT JOIN user_agents ua ON ua.user_agent_id = c.user_agent_id
+    {where}
+    ORDER BY c.consent_timestamp, c.consent_log_id
+"""
+
+# Поиск согласий (consent_search.py): от новых к старым, страница после
+# курсора (consent_timestamp, consent_log_id), без текстов и user agent
+SEARCH_CONSENTS_SQL = """
+    SELECT
+        c.consent_log_id, c.session_id, c.purchase_id,
+        c.document_type, c.document_version, c.document_language,
+        c.consent_given, c.consent_timestamp,
+        c.client_ip, c.ip_country, c.page_url
+    FROM consent_logs c
+    {where}
+    ORDER BY c.consent_timestamp DESC, c.consent_log_id DESC
+    LIMIT %s
+"""
+
+# Тексты документов для выгрузки с текстом: распаковываются в Python и
+# передаются массивами (content_hash, full_text) - без временной таблицы,
+# чтобы выгрузка работала и на реплике (там запись невозможна)
+EXPORT_DOCUMENT_TEXTS_CTE_SQL = """
+    WITH export_document_texts AS (
+        SELECT * FROM unnest(%s::text[], %s::text[]) AS t(content_hash, full_text)
+    )"""
+
+SELECT_CONSENT_LEDGER_BLOCKS_SQL = """
+    SELECT block_start, block_end, row_count, merkle_root, prev_hash, block_hash, sealed_at
+    FROM consent_ledger_blocks
+    ORDER BY block_start
+"""
+
+SELECT_LAST_CONSENT_LEDGER_BLOCK_SQL = """
+    SELECT block_start, block_end, row_count, merkle_root, prev_hash, block_hash, sealed_at
+    FROM consent_ledger_blocks
+    ORDER BY block_start DESC
+    LIMIT 1
+"""
+
+SELECT_FIRST_CONSENT_CREATED_AT_SQL = "SELECT min(created_at) AS first_created_at FROM consent_logs"
+
+COUNT_CONSENTS_CREATED_BEFORE_SQL = "SELECT COUNT(*) AS consents FROM consent_logs WHERE created_at < %s"
+
+# Записи без хеша (сохранённые до журнала) получают его при запечатывании блока
+FILL_CONSENT_RECORD_HASHES_SQL = """
+    UPDATE consent_logs c
+    SET record_hash = consent_record_hash(c)
+    WHERE c.created_at >= %s AND c.created_at < %s
+    AND c.record_hash IS NULL
+"""
+
+# Порядок записей в блоке - порядок листьев дерева Меркла
+SELECT_CONSENT_RECORD_HASHES_SQL = """
+    SELECT record_hash
+    FROM consent_logs
+    WHERE created_at >= %s AND created_at < %s
+    ORDER BY created_at, consent_log_id
+"""
+
+# Строка user agent - из справочника, если запись её не хранит
+SELECT_CONSENT_LEDGER_ROWS_SQL = f"""
+    SELECT {', '.join(
+        'COALESCE(c.user_agent, ua.user_agent) AS user_agent' if column == 'user_agent' else f'c.{column}'
+        for column, _ in CONSENT_LEDGER_FIELDS
+    )}, c.record_hash
+    FROM consent_logs c
+    LEFT JOIN user_agents ua ON ua.user_agent_id = c.user_agent_id
+    WHERE c.created_at >= %s AND c.created_at < %s
+    ORDER BY c.created_at, c.consent_log_id
+"""
+
+# Выгрузка в аналитическое хранилище (consent_analytics.py): новые записи
+# по created_at (BRIN индекс журнала), без IP адресов и текстов, с семействами
+# user agent из справочника (у записей до справочника они пустые)
+SELECT_CONSENT_ANALYTICS_ROWS_SQL = """
+    SELECT
+        c.consent_log_id, c.session_id, c.document_type, c.document_version, c.document_language,
+        c.consent_given, c.consent_timestamp, c.created_at, c.ip_country,
+        c.referrer_url, c.page_url, COALESCE(c.user_agent, ua.user_agent) AS user_agent,
+        ua.browser, ua.os, ua.device
+    FROM consent_logs c
+    LEFT JOIN user_agents ua ON ua.user_agent_id = c.user_agent_id
+    WHERE c.created_at >= %s AND c.created_at < %s
+"""
+
+# Блок добавляется, только если он продолжает текущий конец цепочки
+# (параллельный seal уже мог добавить этот блок)
+INSERT_CONSENT_LEDGER_BLOCK_SQL = """
+    INSERT INTO consent_ledger_blocks (
+        block_start, block_end, row_count, merkle_root, prev_hash, block_hash
+    )
+    SELECT %s, %s, %s, %s, %s, %s
+    WHERE %s = COALESCE(
+        (SELECT block_hash FROM consent_ledger_blocks ORDER BY block_start DESC LIMIT 1), %s
+    )
+    ON CONFLICT DO NOTHING
+    RETURNING block_start
+"""
+
+ENSURE_CONSENT_PARTITIONS_SQL = "SELECT consent_logs_ensure_partitions(%s) AS created"
+
+# Партиции consent_logs и отсоединённые от неё таблицы consent_logs_*
+# (bound = NULL у отсоединённых, они ждут архивации)
+SELECT_CONSENT_PARTITIONS_SQL = """
+    SELECT
+        c.relname AS partition_name,
+        c.relispartition AS attached,
+        pg_get_expr(c.relpartbound, c.oid) AS bound,
+        obj_description(c.oid, 'pg_class') AS description,
+        c.reltuples::bigint AS estimated_rows,
+        pg_total_relation_size(c.oid) AS total_bytes
+    FROM pg_class c
+    WHERE c.relkind = 'r'
+    AND c.relnamespace = current_schema()::regnamespace
+    AND c.relname LIKE 'consent\\_logs\\_%'
+    AND (
+        c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'consent_logs'::regclass)
+        OR NOT c.relispartition
+    )
+    ORDER BY c.relname
+"""
+
+
+def consent_log_params(consent_data: Dict) -> Tuple:
+    """Параметры INSERT_CONSENT_LOG_SQL для одной записи (ID генерируется, если его нет)"""
+    return (
+        str(consent_data.get('consent_log_id') or uuid.uuid4()),
+        consent_data['session_id'],
+        consent_data['document_type'],
+        consent_data['document_version'],
+        consent_data['document_hash'],
+        consent_data.get('document_language'),
+        consent_data['consent_given'],
+        consent_data.get('consent_text'),
+        consent_data['consent_timestamp'],
+        consent_data.get('client_ip'),
+        consent_data.get('client_ip_forwarded'),
+        user_agent_id(consent_data.get('user_agent')),
+        consent_data.get('ip_country'),
+        consent_data.get('referrer_url'),
+        consent_data.get('page_url')
+    )
+
+
+def existing_consent_ids_params(rows: List[Tuple]) -> Tuple:
+    """Параметры SELECT_EXISTING_CONSENT_IDS_SQL для строк consent_log_params"""
+    return (
+        [row[0] for row in rows], [row[8] for row in rows],
+        CONSENT_DEDUP_WINDOW, CONSENT_DEDUP_WINDOW
+    )
+
+
+def new_consent_log_rows(rows: List[Tuple], existing_ids) -> List[Tuple]:
+    """
+    Строки consent_log_params без уже сохранённых (SELECT_EXISTING_CONSENT_IDS_SQL);
+    повтор ID внутри пачки сохраняется один раз
+    """
+    seen = {str(consent_log_id) for consent_log_id in existing_ids}
+    new_rows = []
+    for row in rows:
+        consent_log_id = str(uuid.UUID(row[0]))
+        if consent_log_id not in seen:
+            seen.add(consent_log_id)
+            new_rows.append(row)
+    return new_rows
+
+
+def build_consent_logs_insert(rows: List[Tuple]) -> Tuple[str, List]:
+    """
+    Собрать многострочный INSERT для пачки согласий
+    
+    Args:
+        rows: параметры записей (consent_log_params)
+    
+    Returns:
+        (запрос, параметры)
+    """
+    params = []
+    for row in rows:
+        params.extend(row)
+    
+    row_placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    values_sql = ",\n".join([row_placeholders] * len(rows))
+    
+    return INSERT_CONSENT_LOGS_BATCH_SQL.format(values=values_sql), params
+
+
+def user_agent_rows(consents: List[Dict], stored: set) -> List[Tuple]:
+    """
+    Строки справочника user_agents для пачки согласий (без уже сохранённых
+    этим процессом) - столбцами для INSERT_USER_AGENTS_SQL
+    """
+    rows = {}
+    for consent_data in consents:
+        info = classify_user_agent(consent_data.get('user_agent'))
+        if info and info['user_agent_id'] not in stored:
+            rows[info['user_agent_id']] = (
+                info['user_agent_id'], info['user_agent'], info['browser'], info['os'], info['device']
+            )
+    return list(rows.values())
+
+
+def remember_user_agents(stored: set, rows: List[Tuple]):
+    """Запомнить сохранённые (после commit) строки справочника, не больше кеша классификации"""
+    if len(stored) + len(rows) > USER_AGENT_CACHE_SIZE:
+        stored.clear()
+    stored.update(row[0] for row in rows)
+
+
+def decode_session_status(row: Optional[Dict]) -> Dict:
+    """
+    Развернуть строку consent_session_status в статус по документам
+    
+    Returns:
+        {'consents': {document_type: bool, ...}, 'total_logged': int}
+    """
+    mask = row['consent_mask'] if row else 0
+    return {
+        'consents': {doc: bool(mask & bit) for doc, bit in CONSENT_DOCUMENT_BITS.items()},
+        'total_logged': row['total_logged'] if row else 0
+    }
+
+
+def document_snapshot_params(snapshot_data: Dict) -> Tuple:
+    """Параметры INSERT_DOCUMENT_SNAPSHOT_SQL"""
+    return (
+        snapshot_data['document_type'],
+        snapshot_data['version'],
+        snapshot_data['content_hash'],
+        snapshot_data['language'],
+        snapshot_data.get('created_by')
+    )
+
+
+def build_document_blob(snapshot_data: Dict, base_blobs: List[Dict]) -> Dict:
+    """
+    Запись document_blobs для текста snapshot
+    
+    Args:
+        base_blobs: SELECT_DOCUMENT_BLOB_CHAIN_SQL для активной версии
+                    документа (дельта строится к ней) или пустой список
+    """
+    base = None
+    if base_blobs:
+        base_hash = base_blobs[0]['content_hash']
+        base = {
+            'content_hash': base_hash,
+            'full_text': decode_document_blobs(base_blobs)[base_hash],
+            'delta_depth': base_blobs[0]['delta_depth'],
+        }
+    return encode_document_text(snapshot_data['full_text'], snapshot_data['content_hash'], base)
+
+
+def document_blob_params(blob: Dict) -> Tuple:
+    """Параметры INSERT_DOCUMENT_BLOB_SQL"""
+    return (
+        blob['content_hash'],
+        blob['encoding'],
+        blob['base_hash'],
+        blob['delta_depth'],
+        blob['original_size'],
+        blob['data']
+    )
+
+
+def document_text_from_chain(content_hash: str, blobs: List[Dict]) -> Optional[str]:
+    """Текст по результату SELECT_DOCUMENT_BLOB_CHAIN_SQL (None, если текста нет)"""
+    if not blobs:
+        return None
+    return decode_document_blobs(blobs)[content_hash]
+
+
+def consent_stats_query(date_from: Optional[str] = None) -> Tuple[str, List]:
+    """Запрос статистики согласий (с необязательной начальной датой)"""
+    query = CONSENT_STATS_SQL
+    params = []
+    if date_from:
+        query += " WHERE consent_timestamp >= %s"
+        params.append(date_from)
+    return query, params
+
+
+def consent_rollup_query(template: str, periods: List[Tuple[str, object, object]]) -> Tuple[str, List]:
+    """
+    Подставить набор периодов в SELECT_CONSENT_ROLLUP_SQL / SELECT_CONSENT_HLL_SQL
+    
+    Args:
+        periods: [(granularity, bucket_from, bucket_to), ...]
+    """
+    conditions = []
+    params = []
+    for granularity, bucket_from, bucket_to in periods:
+        conditions.append("(granularity = %s AND bucket >= %s AND bucket < %s)")
+        params.extend([granularity, bucket_from, bucket_to])
+    return template.format(periods=" OR ".join(conditions) or "FALSE"), params
+
+
+def consent_export_query(default_language: str, date_from: Optional[str] = None,
+                         date_to: Optional[str] = None, document_type: Optional[str] = None,
+                         session_id: Optional[str] = None,
+                         include_text: bool = True) -> Tuple[str, List]:
+    """
+    Запрос выгрузки согласий (EXPORT_CONSENTS_SQL) с фильтрами
+    
+    Args:
+        default_language: язык документа для записей без document_language
+        date_from, date_to: диапазон consent_timestamp [date_from, date_to)
+        include_text: добавить полный текст документа (snapshot_text);
+                      массивы текстов (первые два параметра запроса)
+                      добавляет stream_consent_export(with_texts=True)
+    """
+    conditions = []
+    params = [default_language]
+    if date_from:
+        conditions.append("c.consent_timestamp >= %s")
+        params.append(date_from)
+    if date_to:
+        conditions.append("c.consent_timestamp < %s")
+        params.append(date_to)
+    if document_type:
+        conditions.append("c.document_type = %s")
+        params.append(document_type)
+    if session_id:
+        conditions.append("c.session_id = %s")
+        params.append(session_id)
+    
+    query = EXPORT_CONSENTS_SQL.format(
+        text_cte=EXPORT_DOCUMENT_TEXTS_CTE_SQL if include_text else "",
+        text_column=",\n        t.full_text AS snapshot_text" if include_text else "",
+        text_join="\n    LEFT JOIN export_document_texts t ON t.content_hash = s.content_hash" if include_text else "",
+        where=("WHERE " + " AND ".join(conditions)) if conditions else ""
+    )
+    return query, params
+
+
+def consent_search_query(filters: Dict, limit: int, after: Optional[Tuple] = None) -> Tuple[str, List]:
+    """
+    Запрос страницы поиска согласий (SEARCH_CONSENTS_SQL)
+    
+    Args:
+        filters: date_from, date_to (диапазон consent_timestamp), document_type,
+                 document_version, session_id, client_ip, page (CONSENT_PAGE_SQL)
+        limit: сколько записей прочитать
+        after: (consent_timestamp, consent_log_id) последней записи прошлой
+               страницы или None для первой
+    """
+    conditions = []
+    params = []
+    if after:
+        # Отдельное условие по времени отсекает партиции новее курсора
+        conditions.append("c.consent_timestamp <= %s")
+        conditions.append("(c.consent_timestamp, c.consent_log_id) < (%s, %s)")
+        params.extend([after[0], after[0], after[1]])
+    if filters.get('date_from'):
+        conditions.append("c.consent_timestamp >= %s")
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        conditions.append("c.consent_timestamp < %s")
+        params.append(filters['date_to'])
+    for field in ('document_type', 'document_version', 'session_id', 'client_ip'):
+        if filters.get(field):
+            conditions.append(f"c.{field} = %s")
+            params.append(filters[field])
+    if filters.get('page'):
+        conditions.append(f"{CONSENT_PAGE_SQL.format(column='c.page_url')} = %s")
+        params.append(filters['page'])
+    params.append(limit)
+    
+    query = SEARCH_CONSENTS_SQL.format(
+        where=("WHERE " + "\n      AND ".join(conditions)) if conditions else ""
+    )
+    return query, params
+
 
 class TicketDatabase:
     """Класс для работы с БД билетов и согласий"""
     
     def __init__(self):
         self.database_url = DATABASE_URL
-        self.init_database()
+        self.pool = ConnectionPool(
+            self.database_url,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            max_idle=DB_POOL_MAX_IDLE,
+            max_lifetime=DB_POOL_MAX_LIFETIME,
+            kwargs={'row_factory': dict_row},
+            # Соединения замеряют время execute/commit (см. metrics.py)
+            connection_class=TimedConnection,
+            reset=TimedConnection.reset_operation,
+            # Проверяем соединение перед выдачей из пула,
+            # чтобы не получить разорванное после рестарта PostgreSQL
+            check=ConnectionPool.check_connection,
+            name='ticket-consent',
+            # Пул открывается при первом обращении (open), чтобы импорт
+            # приложения не зависел от доступности БД
+            open=False,
+        )
+        # Реплики для чтений (см. db_replicas.py), свой пул на каждую
+        self.replicas = ReplicaRouter()
+        self.replica_pools = {
+            target.name: ConnectionPool(
+                target.url,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_REPLICA_POOL_MAX_SIZE,
+                timeout=DB_REPLICA_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                kwargs={'row_factory': dict_row},
+                connection_class=TimedConnection,
+                reset=TimedConnection.reset_operation,
+                check=ConnectionPool.check_connection,
+                name=f'ticket-consent-{target.name}',
+                open=False,
+            )
+            for target in self.replicas.replicas
+        }
+        # ID строк user agent, уже сохранённых в справочнике (user_agents.py)
+        self.stored_user_agents = set()
+        self._open_lock = threading.Lock()
+        self._opened = False
+        DB_POOL_MAX_CONNECTIONS.inc(DB_POOL_MAX_SIZE)
     
-    def get_connection(self):
-        """Получить подключение к БД"""
-        return psycopg.connect(self.database_url, row_factory=dict_row)
+    def open(self):
+        """
+        Открыть пул соединений (вызывается при первом обращении к БД)
+        
+        Не ждёт соединения с БД: если она недоступна, запросы получат
+        PoolTimeout (503), а пул будет переподключаться в фоне.
+        С DB_AUTO_MIGRATE=true здесь же применяются новые миграции.
+        """
+        with self._open_lock:
+            if self._opened:
+                return
+            if not self.database_url:
+                raise ValueError("DATABASE_URL environment variable is required")
+            self.pool.open(wait=False)
+            for pool in self.replica_pools.values():
+                pool.open(wait=False)
+            self._opened = True
+        
+        if DB_AUTO_MIGRATE:
+            try:
+                self.migrate()
+            except Exception as e:
+                logger.error(f"Auto migration failed: {e}")
     
-    def init_database(self):
-        """Инициализация таблиц для билетов"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    @contextmanager
+    def get_connection(self, operation: str = 'other'):
+        """
+        Получить подключение к БД из пула
+        
+        Использование:
+            with self.get_connection('create_consent_log') as conn:
+                ...
+        
+        operation - имя операции в метриках времени ожидания
+        соединения, execute и commit.
+        При выходе из блока соединение возвращается в пул.
+        Если свободного соединения нет дольше DB_POOL_TIMEOUT,
+        выбрасывается psycopg_pool.PoolTimeout.
+        """
+        if not self._opened:
+            self.open()
         
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            observe_db_phase(operation, 'acquire', started)
+            conn.operation = operation
+            DB_CONNECTIONS_IN_USE.inc()
+            try:
+                yield conn
+            finally:
+                DB_CONNECTIONS_IN_USE.dec()
+    
+    @contextmanager
+    def get_read_connection(self, operation: str = 'other'):
+        """
+        Соединение для чтения: с реплики, если есть подходящая, иначе
+        из основного пула (get_connection)
+        
+        Реплика проверяется (доступность, отставание) не чаще раза в
+        DB_REPLICA_CHECK_INTERVAL; если соединение с ней не получено за
+        DB_REPLICA_TIMEOUT, берётся следующая реплика или основная БД.
+        conn.read_target - откуда читаем ('primary', 'replica1', ...).
+        """
+        if not self._opened:
+            self.open()
+        
+        for target in self._usable_replicas():
+            with ExitStack() as stack:
+                started = time.perf_counter()
+                try:
+                    conn = stack.enter_context(self.replica_pools[target.name].connection())
+                except (PoolTimeout, psycopg.OperationalError) as e:
+                    self.replicas.mark_failed(target, e)
+                    continue
+                observe_db_phase(operation, 'acquire', started)
+                conn.operation = operation
+                conn.read_target = target.name
+                with self.replicas.track(target):
+                    yield conn
+                return
+        
+        with self.get_connection(operation) as conn, self.replicas.track(self.replicas.primary):
+            conn.read_target = PRIMARY
+            yield conn
+    
+    def get_read_url(self) -> str:
+        """URL для долгого чтения на отдельном соединении (выгрузки): реплика или основная БД"""
+        if not self._opened:
+            self.open()
+        for target in self._usable_replicas():
+            return target.url
+        return self.database_url
+    
+    def _usable_replicas(self) -> Iterator:
+        """Реплики по кругу, прошедшие проверку; если ни одной - отметка no_replica"""
+        for target in self.replicas.candidates():
+            if self.replicas.claim_check(target):
+                self._check_replica(target)
+            if target.usable(self.replicas.max_lag):
+                yield target
+        if self.replicas.enabled:
+            self.replicas.record_fallback('no_replica')
+    
+    def _check_replica(self, target):
+        """Проверить доступность и отставание реплики"""
         try:
-            # Таблица consent_logs (логи согласий)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS consent_logs (
-                    consent_log_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                    purchase_id UUID,
-                    session_id UUID NOT NULL,
-                    
-                    document_type TEXT NOT NULL 
-                        CHECK (document_type IN ('ticket_terms', 'refund_policy', 'privacy_policy')),
-                    
-                    document_version TEXT NOT NULL,
-                    document_hash TEXT NOT NULL,
-                    
-                    consent_given BOOLEAN NOT NULL DEFAULT TRUE,
-                    consent_text TEXT,
-                    consent_timestamp TIMESTAMPTZ NOT NULL,
-                    
-                    client_ip TEXT,
-                    client_ip_forwarded TEXT,
-                    user_agent TEXT,
-                    ip_country TEXT,
-                    referrer_url TEXT,
-                    page_url TEXT,
-                    
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                )
-            """)
-            
-            # Индексы для consent_logs
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_consent_session 
-                ON consent_logs(session_id)
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_consent_type 
-                ON consent_logs(document_type)
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_consent_timestamp 
-                ON consent_logs(consent_timestamp)
-            """)
-            
-            # Таблица document_snapshots (архив версий документов)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS document_snapshots (
-                    snapshot_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
-                    
-                    document_type TEXT NOT NULL 
-                        CHECK (document_type IN ('ticket_terms', 'refund_policy', 'privacy_policy')),
-                    
-                    version TEXT NOT NULL,
-                    content_hash TEXT NOT NULL,
-                    
-                    full_text TEXT NOT NULL,
-                    language TEXT NOT NULL CHECK (language IN ('ru', 'en', 'he')),
-                    
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                    created_by TEXT,
-                    
-                    UNIQUE(document_type, language, version)
-                )
-            """)
-            
-            # Индекс для document_snapshots
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_snapshots_active 
-                ON document_snapshots(document_type, language, is_active)
-            """)
-            
-            conn.commit()
-            logger.info("Database tables initialized successfully")
+            with self.replica_pools[target.name].connection() as conn:
+                conn.operation = 'replica_check'
+                row = conn.execute(REPLICA_LAG_SQL).fetchone()
+        except (PoolTimeout, psycopg.Error) as e:
+            logger.warning(f"Replica {target.name} is unavailable: {e}")
+            self.replicas.mark_failed(target, e)
+            return
+        if not row['in_recovery']:
+            logger.warning(f"Replica {target.name} is not in recovery (not a standby?)")
+        self.replicas.record_check(target, row['lag_seconds'])
+    
+    def get_pool_stats(self) -> Dict:
+        """
+        Статистика пула соединений (для мониторинга)
+        
+        Returns:
+            Словарь с текущим состоянием и счётчиками пула
+        """
+        stats = self.pool.get_stats()
+        stats.update({
+            'min_size': self.pool.min_size,
+            'max_size': self.pool.max_size,
+            'timeout': self.pool.timeout,
+        })
+        return stats
+    
+    def get_replica_stats(self) -> Dict:
+        """Состояние реплик, время чтений по целям и пулы реплик (для мониторинга)"""
+        stats = self.replicas.get_stats()
+        for name, pool in self.replica_pools.items():
+            stats['targets'][name]['pool'] = pool.get_stats()
+        return stats
+    
+    def close(self):
+        """Закрыть пулы соединений"""
+        self.pool.close()
+        for pool in self.replica_pools.values():
+            pool.close()
+    
+    def migrate(self) -> List[int]:
+        """
+        Применить новые миграции схемы (SCHEMA_MIGRATIONS) одной транзакцией
+        
+        Returns:
+            Версии применённых миграций (пусто, если схема актуальна)
+        """
+        with self.get_connection('migrate') as conn:
+            cursor = conn.cursor()
             
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Error initializing database: {e}")
-            raise
-        finally:
-            conn.close()
+            try:
+                cursor.execute(SCHEMA_LOCK_SQL)
+                cursor.execute(CREATE_SCHEMA_MIGRATIONS_SQL)
+                cursor.execute(SELECT_SCHEMA_MIGRATIONS_SQL)
+                applied_versions = {row['version'] for row in cursor.fetchall()}
+                
+                applied = []
+                for version, name, statements in SCHEMA_MIGRATIONS:
+                    if version in applied_versions:
+                        continue
+                    started = time.perf_counter()
+                    for statement in statements:
+                        cursor.execute(statement)
+                    duration_ms = int((time.perf_counter() - started) * 1000)
+                    cursor.execute(INSERT_SCHEMA_MIGRATION_SQL, (version, name, duration_ms))
+                    logger.info(f"Migration {version} ({name}) applied in {duration_ms} ms")
+                    applied.append(version)
+                
+                conn.commit()
+                return applied
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error applying migrations: {e}")
+                raise
+    
+    def get_applied_migrations(self) -> List[Dict]:
+        """Применённые миграции схемы (пусто, если миграций ещё не было)"""
+        with self.get_connection('get_applied_migrations') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SCHEMA_MIGRATIONS_EXISTS_SQL)
+            if not cursor.fetchone()['table_exists']:
+                return []
+            cursor.execute(SELECT_SCHEMA_MIGRATIONS_SQL)
+            return cursor.fetchall()
     
-    def create_consent_log(self, consent_data: Dict) -> str:
+    def create_consent_log(self, consent_data: Dict) -> Optional[str]:
         """
         Создать запись о согласии
         
@@ -131,50 +1662,79 @@ class TicketDatabase:
             consent_data: словарь с данными согласия
         
         Returns:
-            UUID созданной записи (строка)
+            UUID созданной записи (строка) или None, если запись
+            с тем же consent_log_id уже есть (повтор согласия)
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        row = consent_log_params(consent_data)
+        user_agents = user_agent_rows([consent_data], self.stored_user_agents)
         
-        try:
-            cursor.execute("""
-                INSERT INTO consent_logs (
-                    session_id, document_type, document_version, document_hash,
-                    consent_given, consent_text, consent_timestamp,
-                    client_ip, client_ip_forwarded, user_agent,
-                    ip_country, referrer_url, page_url
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-                )
-                RETURNING consent_log_id
-            """, (
-                consent_data['session_id'],
-                consent_data['document_type'],
-                consent_data['document_version'],
-                consent_data['document_hash'],
-                consent_data['consent_given'],
-                consent_data.get('consent_text'),
-                consent_data['consent_timestamp'],
-                consent_data.get('client_ip'),
-                consent_data.get('client_ip_forwarded'),
-                consent_data.get('user_agent'),
-                consent_data.get('ip_country'),
-                consent_data.get('referrer_url'),
-                consent_data.get('page_url')
-            ))
+        with self.get_connection('create_consent_log') as conn:
+            cursor = conn.cursor()
             
-            result = cursor.fetchone()
-            consent_log_id = str(result['consent_log_id'])
-            
-            conn.commit()
-            return consent_log_id
+            try:
+                cursor.execute(LOCK_CONSENT_IDS_SQL, ([row[0]],))
+                cursor.execute(SELECT_EXISTING_CONSENT_IDS_SQL, existing_consent_ids_params([row]))
+                if cursor.fetchone() is not None:
+                    conn.rollback()
+                    return None
+                
+                if user_agents:
+                    cursor.execute(INSERT_USER_AGENTS_SQL, [list(column) for column in zip(*user_agents)])
+                
+                cursor.execute(INSERT_CONSENT_LOG_SQL, row)
+                
+                conn.commit()
+                remember_user_agents(self.stored_user_agents, user_agents)
+                return row[0]
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error creating consent log: {e}")
+                raise
+    
+    def create_consent_logs(self, consents: List[Dict]) -> List[str]:
+        """
+        Создать несколько записей о согласии одним INSERT в одной транзакции
+        
+        Записи с уже сохранённым consent_log_id (повторы) не вставляются.
+        
+        Args:
+            consents: список словарей с данными согласий
+        
+        Returns:
+            Список UUID созданных записей (строки, в порядке входных
+            данных, без повторов)
+        """
+        if not consents:
+            return []
+        
+        rows = [consent_log_params(consent_data) for consent_data in consents]
+        user_agents = user_agent_rows(consents, self.stored_user_agents)
+        
+        with self.get_connection('create_consent_logs') as conn:
+            cursor = conn.cursor()
             
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Error creating consent log: {e}")
-            raise
-        finally:
-            conn.close()
+            try:
+                cursor.execute(LOCK_CONSENT_IDS_SQL, ([row[0] for row in rows],))
+                cursor.execute(SELECT_EXISTING_CONSENT_IDS_SQL, existing_consent_ids_params(rows))
+                rows = new_consent_log_rows(rows, [r['consent_log_id'] for r in cursor.fetchall()])
+                if not rows:
+                    conn.rollback()
+                    return []
+                
+                if user_agents:
+                    cursor.execute(INSERT_USER_AGENTS_SQL, [list(column) for column in zip(*user_agents)])
+                
+                cursor.execute(*build_consent_logs_insert(rows))
+                
+                conn.commit()
+                remember_user_agents(self.stored_user_agents, user_agents)
+                return [row[0] for row in rows]
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error creating consent logs batch: {e}")
+                raise
     
     def get_consents_by_session(self, session_id: str) -> List[Dict]:
         """
@@ -186,78 +1746,139 @@ class TicketDatabase:
         Returns:
             Список словарей с согласиями
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.get_read_connection('get_consents_by_session') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_CONSENTS_BY_SESSION_SQL, (session_id,))
+            
+            results = [dict(row) for row in cursor.fetchall()]
+            if results or conn.read_target == PRIMARY:
+                return results
         
-        try:
-            cursor.execute("""
-                SELECT 
-                    consent_log_id, session_id, document_type,
-                    document_version, consent_given, consent_timestamp
-                FROM consent_logs
-                WHERE session_id = %s
-                ORDER BY consent_timestamp ASC
-            """, (session_id,))
+        # Реплика могла ещё не получить только что сохранённые согласия
+        self.replicas.record_fallback('read_your_writes')
+        with self.get_connection('get_consents_by_session') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_CONSENTS_BY_SESSION_SQL, (session_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_session_consent_status(self, session_id: str) -> Dict:
+        """
+        Получить сводный статус согласий сессии (один lookup по первичному ключу)
+        
+        Args:
+            session_id: UUID сессии
+        
+        Returns:
+            {'consents': {document_type: bool, ...}, 'total_logged': int}
+        """
+        with self.get_read_connection('get_session_consent_status') as conn:
+            cursor = conn.cursor()
             
-            results = cursor.fetchall()
-            return [dict(row) for row in results]
+            cursor.execute(SELECT_SESSION_STATUS_SQL, (session_id,))
             
-        finally:
-            conn.close()
+            status = decode_session_status(cursor.fetchone())
+            if conn.read_target == PRIMARY or session_status_complete(status):
+                return status
+        
+        # Реплика могла ещё не получить только что сохранённые согласия
+        self.replicas.record_fallback('read_your_writes')
+        with self.get_connection('get_session_consent_status') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_SESSION_STATUS_SQL, (session_id,))
+            return decode_session_status(cursor.fetchone())
+    
+    def get_session_consent_statuses(self, session_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Получить сводные статусы согласий для многих сессий одним запросом
+        
+        Args:
+            session_ids: список UUID сессий
+        
+        Returns:
+            Словарь session_id -> статус (как в get_session_consent_status)
+        """
+        with self.get_read_connection('get_session_consent_statuses') as conn:
+            statuses = self._select_session_statuses(conn, session_ids)
+            if conn.read_target == PRIMARY:
+                return statuses
+        
+        # Неполные статусы с реплики перечитываются из основной БД:
+        # реплика могла ещё не получить только что сохранённые согласия
+        stale = [session_id for session_id, status in statuses.items() if not session_status_complete(status)]
+        if stale:
+            self.replicas.record_fallback('read_your_writes')
+            with self.get_connection('get_session_consent_statuses') as conn:
+                statuses.update(self._select_session_statuses(conn, stale))
+        return statuses
+    
+    @staticmethod
+    def _select_session_statuses(conn, session_ids: List[str]) -> Dict[str, Dict]:
+        cursor = conn.cursor()
+        cursor.execute(SELECT_SESSION_STATUSES_SQL, (session_ids,))
+        rows = {str(row['session_id']): row for row in cursor.fetchall()}
+        return {
+            session_id: decode_session_status(rows.get(session_id))
+            for session_id in session_ids
+        }
     
     def create_document_snapshot(self, snapshot_data: Dict) -> str:
         """
         Создать snapshot документа
         
+        Текст сохраняется в document_blobs, только если такого текста
+        (по content_hash) ещё нет - сжатым, по возможности дельтой
+        к активной версии документа.
+        
         Args:
             snapshot_data: словарь с данными документа
         
         Returns:
             UUID созданного snapshot (строка)
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            # Деактивируем предыдущие версии этого документа
-            cursor.execute("""
-                UPDATE document_snapshots
-                SET is_active = FALSE
-                WHERE document_type = %s 
-                AND language = %s 
-                AND is_active = TRUE
-            """, (snapshot_data['document_type'], snapshot_data['language']))
-            
-            # Создаём новую версию
-            cursor.execute("""
-                INSERT INTO document_snapshots (
-                    document_type, version, content_hash,
-                    full_text, language, created_by
-                ) VALUES (
-                    %s, %s, %s, %s, %s, %s
-                )
-                RETURNING snapshot_id
-            """, (
-                snapshot_data['document_type'],
-                snapshot_data['version'],
-                snapshot_data['content_hash'],
-                snapshot_data['full_text'],
-                snapshot_data['language'],
-                snapshot_data.get('created_by')
-            ))
-            
-            result = cursor.fetchone()
-            snapshot_id = str(result['snapshot_id'])
-            
-            conn.commit()
-            return snapshot_id
+        with self.get_connection('create_document_snapshot') as conn:
+            cursor = conn.cursor()
             
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Error creating document snapshot: {e}")
-            raise
-        finally:
-            conn.close()
+            try:
+                cursor.execute(DOCUMENT_BLOB_EXISTS_SQL, (snapshot_data['content_hash'],))
+                if not cursor.fetchone()['blob_exists']:
+                    cursor.execute(
+                        SELECT_ACTIVE_DOCUMENT_SQL,
+                        (snapshot_data['document_type'], snapshot_data['language'])
+                    )
+                    active = cursor.fetchone()
+                    base_blobs = []
+                    if active:
+                        cursor.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (active['content_hash'],))
+                        base_blobs = cursor.fetchall()
+                    blob = build_document_blob(snapshot_data, base_blobs)
+                    cursor.execute(INSERT_DOCUMENT_BLOB_SQL, document_blob_params(blob))
+                
+                # Деактивируем предыдущие версии этого документа
+                cursor.execute(
+                    DEACTIVATE_DOCUMENT_SNAPSHOTS_SQL,
+                    (snapshot_data['document_type'], snapshot_data['language'])
+                )
+                
+                # Создаём новую версию
+                cursor.execute(INSERT_DOCUMENT_SNAPSHOT_SQL, document_snapshot_params(snapshot_data))
+                
+                result = cursor.fetchone()
+                snapshot_id = str(result['snapshot_id'])
+                
+                # Уведомляем воркеры о смене активной версии (доставится при COMMIT)
+                cursor.execute(NOTIFY_DOCUMENT_SNAPSHOTS_SQL, (
+                    DOCUMENT_SNAPSHOTS_CHANNEL,
+                    f"{snapshot_data['document_type']}:{snapshot_data['language']}:{snapshot_data['version']}"
+                ))
+                
+                conn.commit()
+                return snapshot_id
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error creating document snapshot: {e}")
+                raise
     
     def get_active_document(self, document_type: str, language: str) -> Optional[Dict]:
         """
@@ -270,25 +1891,90 @@ class TicketDatabase:
         Returns:
             Словарь с данными документа или None
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("""
-                SELECT *
-                FROM document_snapshots
-                WHERE document_type = %s 
-                AND language = %s 
-                AND is_active = TRUE
-                ORDER BY created_at DESC
-                LIMIT 1
-            """, (document_type, language))
+        with self.get_connection('get_active_document') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_ACTIVE_DOCUMENT_SQL, (document_type, language))
             
             result = cursor.fetchone()
             return dict(result) if result else None
+    
+    def get_active_documents(self) -> List[Dict]:
+        """
+        Получить активные версии всех документов одним запросом
+        
+        Returns:
+            Список словарей (по одному на пару document_type, language),
+            без текстов - их загружает get_document_text
+        """
+        with self.get_connection('get_active_documents') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_ACTIVE_DOCUMENTS_SQL)
             
-        finally:
-            conn.close()
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_document_text(self, content_hash: str) -> Optional[str]:
+        """
+        Получить текст документа по SHA-256 хешу
+        
+        Returns:
+            Текст или None, если такого текста нет
+        """
+        with self.get_read_connection('get_document_text') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (content_hash,))
+            
+            full_text = document_text_from_chain(content_hash, cursor.fetchall())
+            if full_text is not None or conn.read_target == PRIMARY:
+                return full_text
+        
+        # Только что загруженный текст мог ещё не дойти до реплики
+        self.replicas.record_fallback('read_your_writes')
+        with self.get_connection('get_document_text') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_DOCUMENT_BLOB_CHAIN_SQL, (content_hash,))
+            return document_text_from_chain(content_hash, cursor.fetchall())
+    
+    def compact_document_blobs(self) -> int:
+        """
+        Сжать тексты, сохранённые без сжатия (encoding = 'none')
+        
+        Returns:
+            Число сжатых текстов
+        """
+        with self.get_connection('compact_document_blobs') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(SELECT_DOCUMENT_SNAPSHOT_HASHES_SQL)
+                snapshots = cursor.fetchall()
+                cursor.execute(SELECT_DOCUMENT_BLOBS_SQL)
+                blobs = cursor.fetchall()
+                
+                compacted = 0
+                for blob in plan_blob_compaction(snapshots, blobs):
+                    cursor.execute(UPDATE_DOCUMENT_BLOB_SQL, (
+                        blob['encoding'], blob['base_hash'], blob['delta_depth'],
+                        blob['data'], blob['content_hash']
+                    ))
+                    compacted += cursor.rowcount
+                
+                conn.commit()
+                return compacted
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error compacting document blobs: {e}")
+                raise
+    
+    def get_document_blob_stats(self) -> List[Dict]:
+        """Число текстов и их размер (исходный и хранимый) по кодировкам"""
+        with self.get_connection('get_document_blob_stats') as conn:
+            cursor = conn.cursor()
+            cursor.execute(DOCUMENT_BLOB_STATS_SQL)
+            return cursor.fetchall()
     
     def get_consent_stats(self, date_from: Optional[str] = None) -> Dict:
         """
@@ -300,30 +1986,430 @@ class TicketDatabase:
         Returns:
             Словарь со статистикой
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            query = """
-                SELECT 
-                    COUNT(*) as total_consents,
-                    COUNT(DISTINCT session_id) as unique_sessions,
-                    COUNT(*) FILTER (WHERE document_type = 'ticket_terms') as ticket_terms_count,
-                    COUNT(*) FILTER (WHERE document_type = 'refund_policy') as refund_policy_count,
-                    COUNT(*) FILTER (WHERE document_type = 'privacy_policy') as privacy_policy_count
-                FROM consent_logs
-            """
-            
-            params = []
-            if date_from:
-                query += " WHERE consent_timestamp >= %s"
-                params.append(date_from)
+        with self.get_read_connection('get_consent_stats') as conn:
+            cursor = conn.cursor()
             
+            query, params = consent_stats_query(date_from)
             cursor.execute(query, params)
             result = cursor.fetchone()
             
             return dict(result) if result else {}
+    
+    def search_consents(self, filters: Dict, limit: int, after: Optional[Tuple] = None) -> List[Dict]:
+        """
+        Страница поиска согласий, от новых к старым (см. consent_search_query)
+        
+        Returns:
+            Не больше limit записей без текстов и user agent
+        """
+        query, params = consent_search_query(filters, limit, after)
+        
+        with self.get_read_connection('search_consents') as conn:
+            cursor = conn.cursor()
             
-        finally:
-            conn.close()
-
+            cursor.execute(query, params)
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def ensure_consent_partitions(self, months_ahead: int = CONSENT_PARTITIONS_AHEAD) -> int:
+        """
+        Создать помесячные партиции consent_logs на months_ahead месяцев вперёд
+        
+        Returns:
+            Число созданных партиций
+        """
+        with self.get_connection('ensure_consent_partitions') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(ENSURE_CONSENT_PARTITIONS_SQL, (months_ahead,))
+                result = cursor.fetchone()
+                
+                conn.commit()
+                return result['created']
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error creating consent partitions: {e}")
+                raise
+    
+    def get_consent_ledger_blocks(self) -> List[Dict]:
+        """Все блоки журнала целостности по порядку"""
+        with self.get_connection('get_consent_ledger_blocks') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_CONSENT_LEDGER_BLOCKS_SQL)
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_last_consent_ledger_block(self) -> Optional[Dict]:
+        """Последний блок журнала (None, если журнал пуст)"""
+        with self.get_connection('get_last_consent_ledger_block') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_LAST_CONSENT_LEDGER_BLOCK_SQL)
+            result = cursor.fetchone()
+            return dict(result) if result else None
+    
+    def get_first_consent_created_at(self):
+        """Время создания самой ранней записи consent_logs (None, если записей нет)"""
+        with self.get_connection('get_first_consent_created_at') as conn:
+            cursor = conn.cursor()
+            cursor.execute(SELECT_FIRST_CONSENT_CREATED_AT_SQL)
+            return cursor.fetchone()['first_created_at']
+    
+    def count_consents_created_before(self, created_at) -> int:
+        """Число записей consent_logs с created_at раньше заданного"""
+        with self.get_connection('count_consents_created_before') as conn:
+            cursor = conn.cursor()
+            cursor.execute(COUNT_CONSENTS_CREATED_BEFORE_SQL, (created_at,))
+            return cursor.fetchone()['consents']
+    
+    def get_consent_record_hashes(self, created_from, created_to) -> List[bytes]:
+        """
+        Хеши записей с created_at в [created_from, created_to) в порядке блока
+        
+        Записям без хеша он сначала проставляется (в той же транзакции).
+        """
+        with self.get_connection('get_consent_record_hashes') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(FILL_CONSENT_RECORD_HASHES_SQL, (created_from, created_to))
+                cursor.execute(SELECT_CONSENT_RECORD_HASHES_SQL, (created_from, created_to))
+                record_hashes = [bytes(row['record_hash']) for row in cursor.fetchall()]
+                
+                conn.commit()
+                return record_hashes
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error reading consent record hashes: {e}")
+                raise
+    
+    def add_consent_ledger_block(self, block: Dict, genesis_hash: str) -> bool:
+        """
+        Добавить блок в конец журнала
+        
+        Returns:
+            False, если block['prev_hash'] уже не конец цепочки
+            (блок добавил параллельный seal)
+        """
+        with self.get_connection('add_consent_ledger_block') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(INSERT_CONSENT_LEDGER_BLOCK_SQL, (
+                    block['block_start'], block['block_end'], block['row_count'],
+                    block['merkle_root'], block['prev_hash'], block['block_hash'],
+                    block['prev_hash'], genesis_hash
+                ))
+                added = cursor.fetchone() is not None
+                
+                conn.commit()
+                return added
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error adding consent ledger block: {e}")
+                raise
+    
+    def stream_consent_ledger_rows(self, created_from, created_to,
+                                   fetch_size: int = CONSENT_EXPORT_FETCH_SIZE) -> Iterator[List[Dict]]:
+        """
+        Записи с created_at в [created_from, created_to) в порядке блоков журнала
+        
+        Как и выгрузка, читает через server-side курсор на отдельном
+        соединении (с реплики, если она есть: блоки запечатываются с
+        задержкой CONSENT_LEDGER_SEAL_DELAY, намного больше её отставания).
+        """
+        with psycopg.connect(self.get_read_url(), row_factory=dict_row) as conn:
+            with conn.cursor(name='consent_ledger') as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(SELECT_CONSENT_LEDGER_ROWS_SQL, (created_from, created_to))
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield rows
+    
+    def stream_consent_analytics_rows(self, created_from, created_to,
+                                      fetch_size: int = CONSENT_EXPORT_FETCH_SIZE) -> Iterator[List[Dict]]:
+        """
+        Записи с created_at в [created_from, created_to) для аналитического
+        хранилища (consent_analytics.py): server-side курсор на отдельном
+        соединении, с реплики, если она есть
+        """
+        with psycopg.connect(self.get_read_url(), row_factory=dict_row) as conn:
+            with conn.cursor(name='consent_analytics') as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(SELECT_CONSENT_ANALYTICS_ROWS_SQL, (created_from, created_to))
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield rows
+    
+    def get_consent_partitions(self) -> List[Dict]:
+        """
+        Получить партиции consent_logs (и отсоединённые, ещё не удалённые)
+        
+        Returns:
+            Список словарей: partition_name, attached, bound,
+            description (COMMENT таблицы), estimated_rows, total_bytes
+        """
+        with self.get_connection('get_consent_partitions') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_CONSENT_PARTITIONS_SQL)
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def get_consent_rollup(self, periods: List[Tuple[str, object, object]]) -> Tuple[List[Dict], Dict[int, int]]:
+        """
+        Получить статистику согласий из почасовых/подневных агрегатов
+        
+        Args:
+            periods: [(granularity, bucket_from, bucket_to), ...]
+        
+        Returns:
+            (счётчики по document_type/document_version/ip_country/consent_given,
+             объединённые HLL регистры уникальных сессий {register: rank})
+        """
+        with self.get_read_connection('get_consent_rollup') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(*consent_rollup_query(SELECT_CONSENT_ROLLUP_SQL, periods))
+            rows = [dict(row) for row in cursor.fetchall()]
+            
+            cursor.execute(*consent_rollup_query(SELECT_CONSENT_HLL_SQL, periods))
+            registers = {row['register']: row['rank'] for row in cursor.fetchall()}
+            
+            return rows, registers
+    
+    def get_consent_rollup_series(self, granularity: str, bucket_from, bucket_to) -> List[Dict]:
+        """Получить число согласий по часам или дням"""
+        with self.get_read_connection('get_consent_rollup_series') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_CONSENT_ROLLUP_SERIES_SQL, (granularity, bucket_from, bucket_to))
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def rebuild_consent_stats(self):
+        """
+        Пересчитать агрегаты статистики по consent_logs
+        
+        На время пересчёта новые согласия ждут (блокировка consent_logs).
+        Записи отсоединённых (архивированных) партиций в статистику
+        больше не попадут.
+        """
+        with self.get_connection('rebuild_consent_stats') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute("LOCK TABLE consent_logs IN SHARE MODE")
+                cursor.execute("TRUNCATE consent_stats_rollup, consent_sessions_hll")
+                cursor.execute(CONSENT_ROLLUP_UPSERT_SQL.format(source='consent_logs'))
+                cursor.execute(CONSENT_HLL_UPSERT_SQL.format(source='consent_logs'))
+                
+                conn.commit()
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error rebuilding consent stats: {e}")
+                raise
+    
+    def get_consents_without_country(self, after: Optional[Tuple] = None, limit: int = 5000) -> List[Dict]:
+        """
+        Получить следующую пачку записей без ip_country (с client_ip)
+        
+        Args:
+            after: (consent_timestamp, consent_log_id) последней записи
+                   прошлой пачки или None для первой
+        
+        Returns:
+            Список словарей: consent_log_id, consent_timestamp, client_ip
+        """
+        after_timestamp, after_id = after or ('-infinity', uuid.UUID(int=0))
+        
+        with self.get_connection('get_consents_without_country') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_CONSENTS_WITHOUT_COUNTRY_SQL, {
+                'after_timestamp': after_timestamp,
+                'after_id': after_id,
+                'limit': limit
+            })
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def set_consent_countries(self, countries: List[Tuple[str, object, str]]) -> int:
+        """
+        Заполнить ip_country и перенести счётчики статистики в эти страны
+        
+        Args:
+            countries: [(consent_log_id, consent_timestamp, ip_country), ...]
+        
+        Returns:
+            Число обновлённых записей (уже заполненные не меняются)
+        """
+        with self.get_connection('set_consent_countries') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(UPDATE_CONSENT_COUNTRIES_SQL, [list(column) for column in zip(*countries)])
+                result = cursor.fetchone()
+                
+                conn.commit()
+                return result['updated']
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error setting consent countries: {e}")
+                raise
+    
+    def get_consents_with_user_agent(self, after: Optional[Tuple] = None, limit: int = 5000) -> List[Dict]:
+        """
+        Получить следующую пачку записей со строкой user agent (до справочника)
+        
+        Args:
+            after: (consent_timestamp, consent_log_id) последней записи
+                   прошлой пачки или None для первой
+        
+        Returns:
+            Список словарей: consent_log_id, consent_timestamp, user_agent
+        """
+        after_timestamp, after_id = after or ('-infinity', uuid.UUID(int=0))
+        
+        with self.get_connection('get_consents_with_user_agent') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_CONSENTS_WITH_USER_AGENT_SQL, {
+                'after_timestamp': after_timestamp,
+                'after_id': after_id,
+                'limit': limit
+            })
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def set_consent_user_agents(self, consents: List[Dict]) -> int:
+        """
+        Перенести строки user agent записей в справочник user_agents
+        
+        Args:
+            consents: [{'consent_log_id', 'consent_timestamp', 'user_agent'}, ...]
+        
+        Returns:
+            Число обновлённых записей
+        """
+        user_agents = user_agent_rows(consents, set())
+        mapping = [
+            (consent['consent_log_id'], consent['consent_timestamp'], user_agent_id(consent['user_agent']))
+            for consent in consents if consent['user_agent']
+        ]
+        
+        with self.get_connection('set_consent_user_agents') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                if user_agents:
+                    cursor.execute(INSERT_USER_AGENTS_SQL, [list(column) for column in zip(*user_agents)])
+                if mapping:
+                    cursor.execute(UPDATE_CONSENT_USER_AGENTS_SQL, [list(column) for column in zip(*mapping)])
+                
+                conn.commit()
+                remember_user_agents(self.stored_user_agents, user_agents)
+                return cursor.rowcount if mapping else 0
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error setting consent user agents: {e}")
+                raise
+    
+    def get_user_agents(self) -> List[Dict]:
+        """Получить все строки справочника user_agents"""
+        with self.get_connection('get_user_agents') as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(SELECT_USER_AGENTS_SQL)
+            
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def update_user_agent_families(self, families: List[Tuple[int, str, str, str]]) -> int:
+        """
+        Обновить семейства строк справочника
+        
+        Args:
+            families: [(user_agent_id, browser, os, device), ...]
+        
+        Returns:
+            Число обновлённых строк
+        """
+        with self.get_connection('update_user_agent_families') as conn:
+            cursor = conn.cursor()
+            
+            try:
+                cursor.execute(UPDATE_USER_AGENT_FAMILIES_SQL, [list(column) for column in zip(*families)])
+                
+                conn.commit()
+                return cursor.rowcount
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Error updating user agent families: {e}")
+                raise
+    
+    @staticmethod
+    def _export_document_texts(conn) -> List[List[str]]:
+        """Распакованные тексты документов - параметры EXPORT_DOCUMENT_TEXTS_CTE_SQL"""
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(SELECT_DOCUMENT_BLOBS_SQL)
+            texts = decode_document_blobs(cursor.fetchall())
+        return [list(texts.keys()), list(texts.values())]
+    
+    def stream_consent_export(self, query: str, params: List,
+                              fetch_size: int = CONSENT_EXPORT_FETCH_SIZE,
+                              with_texts: bool = False) -> Iterator[List[Dict]]:
+        """
+        Выгрузить результат запроса пачками через server-side курсор
+        
+        Выгрузка может идти минутами, поэтому использует отдельное
+        соединение, а не соединение из пула запросов API, и читает
+        с реплики, если она есть.
+        
+        Args:
+            with_texts: запрос использует export_document_texts
+                        (consent_export_query с include_text)
+        
+        Yields:
+            Списки из не более fetch_size строк (словари)
+        """
+        with psycopg.connect(self.get_read_url(), row_factory=dict_row) as conn:
+            conn.execute("SET TIME ZONE 'UTC'")
+            if with_texts:
+                params = self._export_document_texts(conn) + list(params)
+            with conn.cursor(name='consent_export') as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield rows
+    
+    def stream_consent_export_csv(self, query: str, params: List,
+                                  with_texts: bool = False) -> Iterator[bytes]:
+        """
+        Выгрузить результат запроса в CSV (с заголовком) через COPY TO STDOUT
+        
+        Yields:
+            Куски CSV в том виде, в каком их отдаёт PostgreSQL
+        """
+        with psycopg.connect(self.get_read_url()) as conn:
+            # Время в CSV - в UTC, независимо от настроек сервера
+            conn.execute("SET TIME ZONE 'UTC'")
+            if with_texts:
+                params = self._export_document_texts(conn) + list(params)
+            with conn.cursor() as cursor:
+                copy_query = f"COPY ({query}) TO STDOUT (FORMAT csv, HEADER)"
+                with cursor.copy(copy_query, params) as copy:
+                    for chunk in copy:
+                        yield bytes(chunk)
@@ -0,0 +1,204 @@
+"""
+Чтение с реплик PostgreSQL (DATABASE_REPLICA_URLS)
+
+Основная БД общая с Telegram ботом и принимает вставки согласий при
+покупке, поэтому тяжёлые чтения - статистика, выгрузки, проверки
+согласий - можно отправлять на реплики (streaming replication):
+- реплики выбираются по кругу (round-robin);
+- раз в DB_REPLICA_CHECK_INTERVAL секунд реплика проверяется перед
+  использованием: доступна ли и насколько отстаёт (REPLICA_LAG_SQL);
+  отстающие больше DB_REPLICA_MAX_LAG секунд и недоступные пропускаются
+  до следующей проверки;
+- если подходящей реплики нет или соединение с ней не получено за
+  DB_REPLICA_TIMEOUT, чтение идёт в основную БД;
+- чтение своих записей: реплика может ещё не получить только что
+  сохранённые согласия, поэтому неполный статус сессии с реплики
+  перечитывается из основной БД (согласия только добавляются, так что
+  полный статус с реплики верен).
+
+Без DATABASE_REPLICA_URLS все запросы идут в основную БД, как раньше.
+Время чтений по целям (primary, replica1, ...) - в /api/admin/pool-stats
+и в метрике consent_api_db_read_duration_seconds.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+
+from metrics import observe_db_read, record_db_read_fallback
+
+# Реплики через запятую (postgresql://...), пусто - только основная БД
+DATABASE_REPLICA_URLS = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
+]
+# Реплики, отстающие больше (секунд), не используются
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "10"))
+# Как часто (секунд) проверять доступность и отставание реплики
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+# Сколько секунд ждать соединение с репликой, прежде чем читать из основной БД
+DB_REPLICA_TIMEOUT = float(os.getenv("DB_REPLICA_TIMEOUT", "1"))
+# Размер пула соединений с каждой репликой (в каждом воркере)
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", "5"))
+
+# Сколько последних чтений хранится для перцентилей времени
+LATENCY_SAMPLES = 1000
+
+PRIMARY = 'primary'
+
+# Отставание реплики: 0, если всё полученное уже применено (или это не
+# реплика), иначе время с последней применённой транзакции
+REPLICA_LAG_SQL = """
+    SELECT
+        pg_is_in_recovery() AS in_recovery,
+        CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END::float AS lag_seconds
+"""
+
+
+class ReadTarget:
+    """Основная БД или реплика: состояние и время чтений"""
+
+    def __init__(self, name: str, url: Optional[str] = None):
+        self.name = name
+        self.url = url
+        self.host = conninfo_to_dict(url).get('host') if url else None
+        self.healthy = True
+        self.lag_seconds: Optional[float] = None
+        self.checked_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.reads = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def usable(self, max_lag: float) -> bool:
+        return self.healthy and self.lag_seconds is not None and self.lag_seconds <= max_lag
+
+    def get_stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))] * 1000, 2)
+
+        stats = {
+            'reads': self.reads,
+            'errors': self.errors,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+        }
+        if self.url:
+            stats.update({
+                'host': self.host,
+                'healthy': self.healthy,
+                'lag_seconds': self.lag_seconds,
+                'checked_ago': round(time.monotonic() - self.checked_at, 1) if self.checked_at else None,
+                'last_error': self.last_error,
+            })
+        return stats
+
+
+class ReplicaRouter:
+    """
+    Выбор цели для чтения (без ввода-вывода: соединения и проверки
+    выполняют TicketDatabase и AsyncTicketDatabase)
+    """
+
+    def __init__(self, urls: List[str] = DATABASE_REPLICA_URLS,
+                 max_lag: float = DB_REPLICA_MAX_LAG,
+                 check_interval: float = DB_REPLICA_CHECK_INTERVAL):
+        self.primary = ReadTarget(PRIMARY)
+        self.replicas = [ReadTarget(f"replica{number}", url) for number, url in enumerate(urls, 1)]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.fallbacks: Dict[str, int] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def candidates(self) -> List[ReadTarget]:
+        """Реплики по кругу, начиная со следующей; недоступные - только если пора проверить"""
+        if not self.replicas:
+            return []
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        ordered = self.replicas[start:] + self.replicas[:start]
+        return [target for target in ordered if target.healthy or self._check_due(target)]
+
+    def _check_due(self, target: ReadTarget) -> bool:
+        return target.checked_at is None or time.monotonic() - target.checked_at >= self.check_interval
+
+    def claim_check(self, target: ReadTarget) -> bool:
+        """True, если пора проверить реплику (проверяет только один поток)"""
+        with self._lock:
+            if not self._check_due(target):
+                return False
+            target.checked_at = time.monotonic()
+            return True
+
+    def record_check(self, target: ReadTarget, lag_seconds: float):
+        target.healthy = True
+        target.lag_seconds = lag_seconds
+        target.last_error = None
+
+    def mark_failed(self, target: ReadTarget, error: Exception):
+        """Реплика недоступна до следующей проверки"""
+        target.healthy = False
+        target.checked_at = time.monotonic()
+        target.last_error = f"{type(error).__name__}: {error}"[:200]
+
+    def record_fallback(self, reason: str):
+        """Чтение ушло в основную БД: no_replica или read_your_writes"""
+        with self._lock:
+            self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        record_db_read_fallback(reason)
+
+    @contextmanager
+    def track(self, target: ReadTarget):
+        """Замерить чтение; ошибка соединения выводит реплику из ротации"""
+        started = time.perf_counter()
+        try:
+            yield
+        except psycopg.OperationalError as e:
+            target.errors += 1
+            if target.url:
+                self.mark_failed(target, e)
+            raise
+        except Exception:
+            target.errors += 1
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            target.reads += 1
+            target.latencies.append(seconds)
+            observe_db_read(target.name, seconds)
+
+    def get_stats(self) -> Dict:
+        return {
+            'max_lag': self.max_lag,
+            'targets': {
+                target.name: target.get_stats() for target in [self.primary] + self.replicas
+            },
+            'fallbacks': dict(self.fallbacks),
+        }
+
+
+def session_status_complete(status: Dict) -> bool:
+    """Все документы сессии подтверждены: такой статус с реплики не устареет"""
+    return all(status['consents'].values())
@@ -0,0 +1,190 @@
+"""
+Кеш активных версий документов в памяти процесса
+
+Хранит для каждой пары (document_type, language) активную версию и
+её SHA-256 хеш. Тексты нужны только GET /api/documents/<type>, поэтому
+загружаются по хешу при первом запросе (get_text) и хранятся, пока
+версия активна. Версии загружаются одним запросом при старте,
+перезагружается по истечении TTL или после инвалидации:
+- локально - сразу после create_document_snapshot в этом процессе;
+- в остальных воркерах - по уведомлению PostgreSQL NOTIFY
+  (канал DOCUMENT_SNAPSHOTS_CHANNEL), которое отправляет
+  create_document_snapshot в той же транзакции.
+
+Если перезагрузка не удалась (БД недоступна, пул занят), кеш остаётся
+на прежних версиях и пробует снова через RELOAD_RETRY_DELAY секунд.
+Сверка согласий берёт версии через find(): он не ждёт перезагрузку,
+которую уже выполняет другой поток, и не бросает исключений - пока
+версии не загружены, сверка просто пропускается.
+
+В асинхронном режиме кеш создаётся без db: устаревший кеш перезагружает
+сам api_async.py через replace() (или reload_failed() при ошибке),
+а тексты добавляет через put_text().
+"""
+
+import os
+import time
+import threading
+import logging
+from typing import Dict, List, Optional
+
+import psycopg
+
+from database_tickets import DOCUMENT_SNAPSHOTS_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд кеш считается актуальным без уведомлений
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "300"))
+# Пауза перед переподключением LISTEN-соединения (секунды)
+LISTEN_RECONNECT_DELAY = 5.0
+# Пауза перед повтором неудавшейся перезагрузки кеша (секунды)
+RELOAD_RETRY_DELAY = 5.0
+
+
+class DocumentCache:
+    """Кеш активных документов: (document_type, language) -> версия, хеш"""
+
+    def __init__(self, db=None, ttl: float = DOCUMENT_CACHE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self._documents: Dict = {}
+        self._texts: Dict[str, str] = {}
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._listener = None
+        self._stats = {'hits': 0, 'reloads': 0, 'reload_errors': 0, 'invalidations': 0}
+
+    def get(self, document_type: str, language: str) -> Optional[Dict]:
+        """Активная версия документа (без запросов к БД, пока кеш актуален)"""
+        self._ensure_fresh()
+        self._stats['hits'] += 1
+        return self._documents.get((document_type, language))
+
+    def find(self, document_type: str, language: str) -> Optional[Dict]:
+        """Активная версия для сверки согласия (None, если версии ещё не загружены)"""
+        self._ensure_fresh(strict=False)
+        self._stats['hits'] += 1
+        return self._documents.get((document_type, language))
+
+    def all(self) -> List[Dict]:
+        """Все активные документы"""
+        self._ensure_fresh()
+        return list(self._documents.values())
+
+    def get_text(self, content_hash: str) -> Optional[str]:
+        """Текст документа по хешу (без db - только уже загруженный)"""
+        text = self._texts.get(content_hash)
+        if text is None and self.db is not None:
+            text = self.db.get_document_text(content_hash)
+            self.put_text(content_hash, text)
+        return text
+
+    def put_text(self, content_hash: str, text: Optional[str]):
+        # Тексты неактивных версий не нужны (а текст по хешу не меняется)
+        if text is not None and any(doc['content_hash'] == content_hash for doc in self._documents.values()):
+            self._texts[content_hash] = text
+
+    def is_stale(self) -> bool:
+        return time.monotonic() >= self._expires_at
+
+    def needs_reload(self, strict: bool = True) -> bool:
+        """
+        Пора перезагрузить кеш; strict=False - только если с последней
+        неудачной попытки прошло RELOAD_RETRY_DELAY
+        """
+        return self.is_stale() and (strict or time.monotonic() >= self._retry_at)
+
+    def replace(self, documents: List[Dict]):
+        """Заменить содержимое кеша (результат get_active_documents)"""
+        self._documents = {
+            (doc['document_type'], doc['language']): doc for doc in documents
+        }
+        active_hashes = {doc['content_hash'] for doc in documents}
+        self._texts = {
+            content_hash: text for content_hash, text in self._texts.items()
+            if content_hash in active_hashes
+        }
+        self._expires_at = time.monotonic() + self.ttl
+        self._loaded = True
+        self._stats['reloads'] += 1
+
+    def reload_failed(self, error: Exception, strict: bool = True):
+        """
+        Перезагрузка не удалась: прежние версии отдаются ещё RELOAD_RETRY_DELAY
+        секунд; если их нет, ошибка пробрасывается (strict) или сверка
+        согласий идёт без версий
+        """
+        self._stats['reload_errors'] += 1
+        self._retry_at = time.monotonic() + RELOAD_RETRY_DELAY
+        if self._loaded:
+            self._expires_at = self._retry_at
+        elif strict:
+            raise error
+        logger.warning(
+            f"Document cache reload failed, serving {'stale' if self._loaded else 'no'} versions: {error}"
+        )
+
+    def reload(self):
+        """Перезагрузить кеш из БД"""
+        with self._lock:
+            self.replace(self.db.get_active_documents())
+
+    def invalidate(self):
+        """Пометить кеш устаревшим (перезагрузится при следующем обращении)"""
+        self._expires_at = 0.0
+        self._stats['invalidations'] += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            **self._stats,
+            'documents': len(self._documents),
+            'texts': len(self._texts),
+            'ttl': self.ttl,
+            'stale': self.is_stale(),
+        }
+
+    def _ensure_fresh(self, strict: bool = True):
+        if self.db is None or not self.needs_reload(strict):
+            return
+        # Перезагрузку уже выполняет другой поток: ждём её, только если
+        # без неё нечего отдать (и ошибка нужна вызывающему)
+        if not self._lock.acquire(blocking=strict and not self._loaded):
+            return
+        try:
+            # Пока ждали блокировку, кеш мог обновить другой поток
+            if self.needs_reload(strict):
+                try:
+                    self.replace(self.db.get_active_documents())
+                except Exception as e:
+                    self.reload_failed(e, strict)
+        finally:
+            self._lock.release()
+
+    # ========================================
+    # Инвалидация между воркерами (LISTEN/NOTIFY)
+    # ========================================
+
+    def start_listener(self, database_url: str):
+        """Запустить фоновый поток, слушающий уведомления об изменении документов"""
+        self._listener = threading.Thread(
+            target=self._listen, args=(database_url,),
+            name='document-cache-listener', daemon=True
+        )
+        self._listener.start()
+
+    def _listen(self, database_url: str):
+        while True:
+            try:
+                with psycopg.connect(database_url, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {DOCUMENT_SNAPSHOTS_CHANNEL}")
+                    # Пока соединения не было, уведомления могли потеряться
+                    self.invalidate()
+                    for notify in conn.notifies():
+                        logger.info(f"Document snapshots changed: {notify.payload}")
+                        self.invalidate()
+            except Exception as e:
+                logger.warning(f"Document cache listener error, reconnecting: {e}")
+                time.sleep(LISTEN_RECONNECT_DELAY)
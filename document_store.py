@@ -0,0 +1,176 @@
+"""
+Хранение текстов документов (таблица document_blobs)
+
+Текст хранится один раз по своему SHA-256 хешу (content_hash), а
+document_snapshots ссылается на него. Если тот же текст загружают под
+новой версией (или повторно), добавляется только строка
+document_snapshots, текст не сжимается и не пишется ещё раз.
+
+Кодировки текста (document_blobs.encoding):
+- none       - UTF-8 как есть (тексты, перенесённые миграцией 2, пока их
+               не пережал python migrations.py; или без пакета zstandard);
+- zstd       - сжатый zstd;
+- zstd-delta - сжатый zstd со словарём из текста предыдущей версии
+               (base_hash): в длинных юридических текстах от версии к
+               версии меняются отдельные пункты, и такая запись занимает
+               десятки байт вместо килобайт.
+Цепочка дельт ограничена DOCUMENT_DELTA_MAX_DEPTH, чтобы чтение текста
+не требовало распаковки всей истории.
+
+Тексты читаются только когда нужны (GET /api/documents/<type>, выгрузка
+с текстом): кеш документов держит версии и хеши, а тексты подгружает по
+хешу и хранит, пока версия активна.
+"""
+
+import os
+import hashlib
+import logging
+import importlib.util
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Уровень сжатия zstd (1-22): тексты загружаются редко, а скорость
+# распаковки от уровня почти не зависит
+DOCUMENT_ZSTD_LEVEL = int(os.getenv("DOCUMENT_ZSTD_LEVEL", "19"))
+# Тексты короче (в байтах UTF-8) сжимаются без дельты
+DOCUMENT_DELTA_MIN_SIZE = int(os.getenv("DOCUMENT_DELTA_MIN_SIZE", "4096"))
+# Максимальная длина цепочки дельт, 0 - без дельт
+DOCUMENT_DELTA_MAX_DEPTH = int(os.getenv("DOCUMENT_DELTA_MAX_DEPTH", "10"))
+
+ZSTANDARD_AVAILABLE = importlib.util.find_spec('zstandard') is not None
+
+if ZSTANDARD_AVAILABLE:
+    import zstandard
+else:
+    logger.warning("zstandard is not installed, document texts are stored uncompressed")
+
+
+def content_hash_for(full_text: str) -> str:
+    """SHA-256 хеш текста документа (адрес текста в document_blobs)"""
+    return hashlib.sha256(full_text.encode('utf-8')).hexdigest()
+
+
+def _raw_dictionary(base_data: bytes):
+    return zstandard.ZstdCompressionDict(base_data, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+def encode_document_text(full_text: str, content_hash: str, base: Optional[Dict] = None) -> Dict:
+    """
+    Запись document_blobs для текста
+
+    Args:
+        base: текст предыдущей версии для дельты -
+              {'content_hash', 'full_text', 'delta_depth'} или None
+
+    Returns:
+        {'content_hash', 'encoding', 'base_hash', 'delta_depth', 'original_size', 'data'}
+    """
+    data = full_text.encode('utf-8')
+    blob = {
+        'content_hash': content_hash,
+        'encoding': 'none',
+        'base_hash': None,
+        'delta_depth': 0,
+        'original_size': len(data),
+        'data': data,
+    }
+    if not ZSTANDARD_AVAILABLE:
+        return blob
+
+    blob['encoding'] = 'zstd'
+    blob['data'] = zstandard.ZstdCompressor(level=DOCUMENT_ZSTD_LEVEL).compress(data)
+
+    if (base and base['content_hash'] != content_hash
+            and len(data) >= DOCUMENT_DELTA_MIN_SIZE
+            and base['delta_depth'] < DOCUMENT_DELTA_MAX_DEPTH):
+        compressor = zstandard.ZstdCompressor(
+            level=DOCUMENT_ZSTD_LEVEL, dict_data=_raw_dictionary(base['full_text'].encode('utf-8'))
+        )
+        delta = compressor.compress(data)
+        # Дельта нужна, только если заметно меньше самостоятельной записи
+        if len(delta) < len(blob['data']) // 2:
+            blob.update(
+                encoding='zstd-delta', base_hash=base['content_hash'],
+                delta_depth=base['delta_depth'] + 1, data=delta,
+            )
+    return blob
+
+
+def decode_document_blobs(blobs: List[Dict]) -> Dict[str, str]:
+    """
+    Распаковать записи document_blobs
+
+    Args:
+        blobs: записи (content_hash, encoding, base_hash, data) в любом
+               порядке; для дельт среди них должны быть и базовые версии
+
+    Returns:
+        {content_hash: текст}
+    """
+    by_hash = {blob['content_hash']: blob for blob in blobs}
+    raw: Dict[str, bytes] = {}
+
+    def decode(content_hash: str) -> bytes:
+        if content_hash in raw:
+            return raw[content_hash]
+        # Цепочка от записи до первой уже распакованной или самостоятельной
+        chain = [by_hash[content_hash]]
+        while chain[-1]['encoding'] == 'zstd-delta' and chain[-1]['base_hash'] not in raw:
+            chain.append(by_hash[chain[-1]['base_hash']])
+        for blob in reversed(chain):
+            data = bytes(blob['data'])
+            if blob['encoding'] == 'zstd':
+                data = zstandard.ZstdDecompressor().decompress(data)
+            elif blob['encoding'] == 'zstd-delta':
+                data = zstandard.ZstdDecompressor(
+                    dict_data=_raw_dictionary(raw[blob['base_hash']])
+                ).decompress(data)
+            raw[blob['content_hash']] = data
+        return raw[content_hash]
+
+    return {content_hash: decode(content_hash).decode('utf-8') for content_hash in by_hash}
+
+
+def plan_blob_compaction(snapshots: List[Dict], blobs: List[Dict]) -> List[Dict]:
+    """
+    Пережать несжатые (encoding = 'none') тексты
+
+    Версии каждого документа перебираются по времени создания, и текст
+    кодируется дельтой к предыдущей версии того же документа. Базой
+    становится только уже обработанный текст, поэтому цепочки дельт
+    не замыкаются в цикл.
+
+    Args:
+        snapshots: (content_hash, document_type, language) в порядке created_at
+        blobs: все записи document_blobs
+
+    Returns:
+        Новые записи document_blobs для текстов, которые стоит перезаписать
+    """
+    if not ZSTANDARD_AVAILABLE:
+        return []
+
+    texts = decode_document_blobs(blobs)
+    depths = {blob['content_hash']: blob['delta_depth'] for blob in blobs if blob['encoding'] != 'none'}
+    pending = {blob['content_hash'] for blob in blobs if blob['encoding'] == 'none'}
+    previous: Dict = {}
+    encoded = []
+
+    for snapshot in snapshots:
+        content_hash = snapshot['content_hash']
+        document_key = (snapshot['document_type'], snapshot['language'])
+        base_hash = previous.get(document_key)
+        previous[document_key] = content_hash
+        if content_hash not in pending:
+            continue
+        pending.discard(content_hash)
+
+        base = None
+        if base_hash in depths:
+            base = {'content_hash': base_hash, 'full_text': texts[base_hash], 'delta_depth': depths[base_hash]}
+        blob = encode_document_text(texts[content_hash], content_hash, base)
+        depths[content_hash] = blob['delta_depth']
+        encoded.append(blob)
+
+    return encoded
@@ -0,0 +1,209 @@
+"""
+Страна по IP (consent_logs.ip_country) по локальной базе MaxMind
+
+База в формате MaxMind DB (GeoLite2-Country.mmdb, GeoIP2-Country или
+совместимые, например DB-IP Lite Country) открывается через mmap один
+раз в каждом воркере при первом обращении; страницы файла делят все
+процессы через кеш ОС. Результаты кешируются (LRU по IP, а для IPv4 -
+ещё и по сети /24, если вся /24 относится к одной стране), так что
+повторный поиск - микросекунды, без сетевых запросов.
+
+Файл базы можно обновлять на лету (новая версия пишется рядом и
+переименовывается поверх): раз в GEOIP_RELOAD_INTERVAL секунд воркер
+сверяет время изменения файла и переоткрывает базу.
+
+Без GEOIP_DATABASE_PATH (или без пакета maxminddb) ip_country не заполняется.
+
+Команды:
+    python geoip.py lookup IP [IP ...]
+        показать страну для адресов
+    python geoip.py backfill [--batch-size 5000]
+        заполнить ip_country у существующих записей consent_logs
+        (пачками; счётчики /api/admin/stats переносятся вместе с ними)
+"""
+
+import os
+import time
+import logging
+import argparse
+import threading
+import importlib.util
+from functools import lru_cache, partial
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database_tickets import TicketDatabase
+
+logger = logging.getLogger(__name__)
+
+# Путь к файлу .mmdb (например, GeoLite2-Country.mmdb)
+GEOIP_DATABASE_PATH = os.getenv("GEOIP_DATABASE_PATH")
+# Сколько адресов (и отдельно сетей /24) помнит каждый воркер
+GEOIP_CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "65536"))
+# Как часто (секунд) проверять, не заменён ли файл базы
+GEOIP_RELOAD_INTERVAL = float(os.getenv("GEOIP_RELOAD_INTERVAL", "60"))
+# Записей за один проход backfill
+GEOIP_BACKFILL_BATCH_SIZE = int(os.getenv("GEOIP_BACKFILL_BATCH_SIZE", "5000"))
+
+MAXMINDDB_AVAILABLE = importlib.util.find_spec('maxminddb') is not None
+
+if MAXMINDDB_AVAILABLE:
+    import maxminddb
+
+MISSING = object()
+
+
+def record_country(record) -> Optional[str]:
+    """ISO код страны из записи базы (country, иначе registered_country)"""
+    if not isinstance(record, dict):
+        return None
+    for key in ('country', 'registered_country'):
+        iso_code = (record.get(key) or {}).get('iso_code')
+        if iso_code:
+            return iso_code
+    return None
+
+
+def lookup_country(reader, ip_address: str) -> Tuple[Optional[str], Optional[int]]:
+    """(страна, длина префикса сети в базе) или (None, None) для не-IP"""
+    try:
+        record, prefix_len = reader.get_with_prefix_len(ip_address)
+    except ValueError:
+        return None, None
+    return record_country(record), prefix_len
+
+
+class GeoIPDatabase:
+    """Поиск страны по IP с кешем и переоткрытием обновлённого файла базы"""
+
+    def __init__(self, path: str, cache_size: int = GEOIP_CACHE_SIZE,
+                 reload_interval: float = GEOIP_RELOAD_INTERVAL):
+        self.path = path
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._checked_at = None
+        self._lookup = None
+        self._networks: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return
+                reader = maxminddb.open_database(self.path, maxminddb.MODE_AUTO)
+            except (OSError, RuntimeError, ValueError) as e:
+                # Файл ещё дописывается или пропал - работаем со старой версией
+                logger.warning(f"GeoIP database {self.path} not loaded: {e}")
+                return
+
+            # Старый reader не закрываем: им могут пользоваться другие потоки,
+            # mmap освободится вместе с последней ссылкой
+            self._lookup = lru_cache(maxsize=self.cache_size)(partial(lookup_country, reader))
+            self._networks = {}
+            self._mtime = mtime
+            metadata = reader.metadata()
+            logger.info(f"GeoIP database loaded: {metadata.database_type} "
+                        f"built {time.strftime('%Y-%m-%d', time.gmtime(metadata.build_epoch))}")
+
+    def country(self, ip_address: str) -> Optional[str]:
+        """ISO код страны (например, 'IL') или None, если неизвестна"""
+        self._reload_if_changed()
+        lookup, networks = self._lookup, self._networks
+        if lookup is None:
+            return None
+
+        network = ip_address.rpartition('.')[0] if ':' not in ip_address else None
+        if network:
+            country = networks.get(network, MISSING)
+            if country is not MISSING:
+                return country
+
+        country, prefix_len = lookup(ip_address)
+        if network and prefix_len is not None and prefix_len <= 24:
+            if len(networks) >= self.cache_size:
+                networks.clear()
+            networks[network] = country
+        return country
+
+
+if GEOIP_DATABASE_PATH and not MAXMINDDB_AVAILABLE:
+    logger.warning("GEOIP_DATABASE_PATH is set, but maxminddb is not installed")
+
+geoip_database = GeoIPDatabase(GEOIP_DATABASE_PATH) if GEOIP_DATABASE_PATH and MAXMINDDB_AVAILABLE else None
+
+
+def get_ip_country(ip_address: Optional[str]) -> Optional[str]:
+    """Страна по IP для consent_logs.ip_country (None без базы GeoIP)"""
+    if geoip_database is None or not ip_address:
+        return None
+    return geoip_database.country(ip_address)
+
+
+def backfill(db: TicketDatabase, batch_size: int):
+    """Заполнить ip_country у записей, сохранённых без страны"""
+    started = time.perf_counter()
+    after = None
+    scanned = updated = 0
+
+    while True:
+        rows = db.get_consents_without_country(after, batch_size)
+        if not rows:
+            break
+        after = (rows[-1]['consent_timestamp'], rows[-1]['consent_log_id'])
+
+        countries = {ip: get_ip_country(ip) for ip in {row['client_ip'] for row in rows}}
+        found = [
+            (row['consent_log_id'], row['consent_timestamp'], countries[row['client_ip']])
+            for row in rows if countries[row['client_ip']]
+        ]
+        if found:
+            updated += db.set_consent_countries(found)
+        scanned += len(rows)
+        print(f"   {scanned} записей просмотрено, {updated} обновлено (до {after[0]:%Y-%m-%d %H:%M})")
+
+    print(f"✅ ip_country заполнена у {updated} из {scanned} записей "
+          f"за {time.perf_counter() - started:.1f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Страна по IP для consent_logs")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    lookup = commands.add_parser('lookup', help="показать страну для адресов")
+    lookup.add_argument('ip_addresses', nargs='+')
+
+    backfill_parser = commands.add_parser('backfill', help="заполнить ip_country у существующих записей")
+    backfill_parser.add_argument('--batch-size', type=int, default=GEOIP_BACKFILL_BATCH_SIZE)
+
+    args = parser.parse_args()
+
+    if geoip_database is None:
+        print("❌ Ошибка: укажите GEOIP_DATABASE_PATH (файл .mmdb) и установите maxminddb")
+        exit(1)
+
+    if args.command == 'lookup':
+        for ip_address in args.ip_addresses:
+            print(f"{ip_address:<40} {get_ip_country(ip_address) or '-'}")
+        return
+
+    db = TicketDatabase()
+    try:
+        backfill(db, args.batch_size)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
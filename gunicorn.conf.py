@@ -0,0 +1,67 @@
+"""
+Конфигурация gunicorn
+
+SERVER_MODE выбирает режим работы сервиса:
+- sync  (по умолчанию) - Flask приложение api.py, синхронные воркеры
+- async - Quart приложение api_async.py на asyncio (воркеры uvicorn);
+  пул соединений воркера - ASYNC_DB_POOL_MAX_SIZE (по умолчанию 20)
+  вместо DB_POOL_MAX_SIZE, отложенная запись (CONSENT_WRITE_MODE=write_behind)
+  не поддерживается - сервер не запустится
+
+Метрики Prometheus воркеры пишут в PROMETHEUS_MULTIPROC_DIR,
+/metrics отдаёт их сумму по всем воркерам (см. metrics.py).
+Корзины лимитов запросов воркеры делят через RATE_LIMIT_SHARED_PATH
+(см. rate_limit.py).
+"""
+
+import os
+import shutil
+import tempfile
+
+SERVER_MODE = os.getenv("SERVER_MODE", "sync")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+timeout = 120
+
+if SERVER_MODE == "async":
+    if os.getenv("CONSENT_WRITE_MODE", "sync") == "write_behind":
+        raise RuntimeError("CONSENT_WRITE_MODE=write_behind is not supported with SERVER_MODE=async")
+    wsgi_app = "api_async:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    # Один процесс держит сотни одновременных запросов
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+else:
+    wsgi_app = "api:app"
+    worker_class = "sync"
+    workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+# Должна быть задана до импорта prometheus_client в воркерах
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "consent-api-metrics")
+)
+
+# Общие для воркеров корзины лимитов запросов
+os.environ.setdefault(
+    "RATE_LIMIT_SHARED_PATH",
+    os.path.join(tempfile.gettempdir(), "consent-api-ratelimit")
+)
+
+from prometheus_client import multiprocess  # noqa: E402
+
+
+def on_starting(server):
+    # Метрики прошлого запуска (pid воркеров могут повториться) не нужны
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Корзины прошлого запуска тоже
+    try:
+        os.remove(os.environ["RATE_LIMIT_SHARED_PATH"])
+    except FileNotFoundError:
+        pass
+
+
+def child_exit(server, worker):
+    # Убираем gauge завершившегося воркера (соединения, пул)
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,252 @@
+"""
+Метрики Prometheus
+
+- время ответа по маршрутам (и отдельно разбор JSON тела запроса);
+- время фаз работы с БД в каждом методе TicketDatabase / AsyncTicketDatabase:
+  acquire (ожидание соединения из пула), execute, commit;
+- время чтений по цели (основная БД или реплика, см. db_replicas.py);
+- число соединений с БД (открыто, занято, максимум пула);
+- ошибки по типам исключений;
+- время загрузки приложения в каждом воркере.
+
+Под gunicorn каждый воркер пишет метрики в PROMETHEUS_MULTIPROC_DIR
+(задаётся в gunicorn.conf.py), а /metrics собирает их со всех воркеров.
+Без этой переменной (локальный запуск) метрики хранятся в памяти процесса.
+"""
+
+import os
+import time
+
+import psycopg
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+    CONTENT_TYPE_LATEST, generate_latest, multiprocess,
+)
+
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+# Если задан, /metrics требует заголовок Authorization: Bearer <ключ>
+METRICS_API_KEY = os.getenv("METRICS_API_KEY")
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+HTTP_REQUEST_DURATION = Histogram(
+    'consent_api_http_request_duration_seconds',
+    'Время обработки HTTP запроса',
+    ['method', 'route', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUEST_PHASE_DURATION = Histogram(
+    'consent_api_http_request_phase_duration_seconds',
+    'Время отдельных фаз обработки HTTP запроса (json_parse)',
+    ['route', 'phase'],
+    buckets=LATENCY_BUCKETS,
+)
+ERRORS = Counter(
+    'consent_api_errors_total',
+    'Ошибки обработки запросов по типу исключения',
+    ['route', 'error_type'],
+)
+CONSENT_DUPLICATES = Counter(
+    'consent_api_consent_duplicates_total',
+    'Отброшенные повторы согласий: memory - по недавним ID воркера, database - по ключу в БД',
+    ['source'],
+)
+USER_AGENT_CACHE = Counter(
+    'consent_api_user_agent_cache_total',
+    'Классификация user agent (user_agents.py): hit - из LRU кеша, miss - разбор правилами',
+    ['result'],
+)
+CONSENT_QUEUE_DEPTH = Gauge(
+    'consent_api_consent_queue_depth',
+    'Записей в очереди отложенной записи (consent_queue.py), ещё не сохранённых в БД',
+    multiprocess_mode='livesum',
+)
+CONSENT_QUEUE_FLUSH_DURATION = Histogram(
+    'consent_api_consent_queue_flush_seconds',
+    'Время сохранения пачки из очереди отложенной записи в БД',
+    buckets=LATENCY_BUCKETS,
+)
+DB_PHASE_DURATION = Histogram(
+    'consent_api_db_phase_duration_seconds',
+    'Время фаз работы с БД: acquire, execute, commit',
+    ['operation', 'phase'],
+    buckets=LATENCY_BUCKETS,
+)
+DB_READ_DURATION = Histogram(
+    'consent_api_db_read_duration_seconds',
+    'Время чтений, которые можно отправить на реплику, по цели: primary, replica1, ...',
+    ['target'],
+    buckets=LATENCY_BUCKETS,
+)
+DB_READ_FALLBACKS = Counter(
+    'consent_api_db_read_fallbacks_total',
+    'Чтения, ушедшие в основную БД: no_replica - нет доступной реплики, '
+    'read_your_writes - реплика ещё не получила записи сессии',
+    ['reason'],
+)
+DB_CONNECTIONS_OPENED = Counter(
+    'consent_api_db_connections_opened_total',
+    'Открыто соединений с БД',
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    'consent_api_db_connections_in_use',
+    'Соединений с БД, выданных из пула',
+    multiprocess_mode='livesum',
+)
+DB_POOL_MAX_CONNECTIONS = Gauge(
+    'consent_api_db_pool_max_connections',
+    'Максимум соединений в пулах всех воркеров',
+    multiprocess_mode='livesum',
+)
+BOOT_DURATION = Gauge(
+    'consent_api_boot_seconds',
+    'Время импорта и инициализации приложения в воркере',
+    multiprocess_mode='liveall',
+)
+
+
+def observe_boot(started: float) -> float:
+    """Записать время загрузки приложения (от started), вернуть его в секундах"""
+    seconds = time.perf_counter() - started
+    BOOT_DURATION.set(seconds)
+    return seconds
+
+
+def observe_db_phase(operation: str, phase: str, started: float):
+    DB_PHASE_DURATION.labels(operation, phase).observe(time.perf_counter() - started)
+
+
+def observe_db_read(target: str, seconds: float):
+    DB_READ_DURATION.labels(target).observe(seconds)
+
+
+def record_db_read_fallback(reason: str):
+    DB_READ_FALLBACKS.labels(reason).inc()
+
+
+def observe_request(method: str, route: str, status: int, started: float):
+    HTTP_REQUEST_DURATION.labels(method, route, status).observe(time.perf_counter() - started)
+
+
+def observe_request_phase(route: str, phase: str, started: float):
+    HTTP_REQUEST_PHASE_DURATION.labels(route, phase).observe(time.perf_counter() - started)
+
+
+def record_consent_duplicates(source: str, count: int = 1):
+    if count:
+        CONSENT_DUPLICATES.labels(source).inc(count)
+
+
+def set_consent_queue_depth(depth: int):
+    CONSENT_QUEUE_DEPTH.set(depth)
+
+
+def observe_consent_queue_flush(seconds: float):
+    CONSENT_QUEUE_FLUSH_DURATION.observe(seconds)
+
+
+def record_user_agent_cache(result: str):
+    USER_AGENT_CACHE.labels(result).inc()
+
+
+def record_error(route: str, error_type: str):
+    ERRORS.labels(route, error_type).inc()
+
+
+def route_label(request_obj) -> str:
+    """Шаблон маршрута (/api/consent/verify/<session_id>), а не конкретный URL"""
+    rule = request_obj.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def is_metrics_request_allowed(request_obj) -> bool:
+    if not METRICS_API_KEY:
+        return True
+    return request_obj.headers.get('Authorization') == f"Bearer {METRICS_API_KEY}"
+
+
+def render_metrics():
+    """Метрики в текстовом формате Prometheus: (тело, Content-Type)"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# ========================================
+# Соединения psycopg с замером execute / commit
+# ========================================
+
+class TimedCursor(psycopg.Cursor):
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            observe_db_phase(self.connection.operation, 'execute', started)
+
+
+class TimedConnection(psycopg.Connection):
+    """
+    Соединение для ConnectionPool(connection_class=...)
+
+    operation - имя метода TicketDatabase, который сейчас
+    держит соединение (ставится в get_connection, сбрасывается
+    в reset_operation после возврата в пул - уже после commit
+    при выходе из pool.connection()).
+    """
+
+    operation = 'pool'
+
+    @staticmethod
+    def reset_operation(conn):
+        conn.operation = TimedConnection.operation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+        DB_CONNECTIONS_OPENED.inc()
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            observe_db_phase(self.operation, 'commit', started)
+
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    async def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            observe_db_phase(self.connection.operation, 'execute', started)
+
+
+class TimedAsyncConnection(psycopg.AsyncConnection):
+    """Асинхронный вариант TimedConnection"""
+
+    operation = 'pool'
+
+    @staticmethod
+    async def reset_operation(conn):
+        conn.operation = TimedAsyncConnection.operation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedAsyncCursor
+        DB_CONNECTIONS_OPENED.inc()
+
+    async def commit(self):
+        started = time.perf_counter()
+        try:
+            await super().commit()
+        finally:
+            observe_db_phase(self.operation, 'commit', started)
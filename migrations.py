@@ -0,0 +1,105 @@
+"""
+Миграции схемы БД
+
+Схема меняется только здесь, а не при старте воркеров: миграции
+(SCHEMA_MIGRATIONS в database_tickets.py) применяются по порядку, каждая
+один раз, номера применённых хранятся в таблице schema_migrations.
+
+Команды:
+    python migrations.py [migrate]
+        применить новые миграции, создать партиции consent_logs
+        на CONSENT_PARTITIONS_AHEAD месяцев вперёд и сжать тексты
+        документов, сохранённые без сжатия (запускать один раз
+        при деплое: Render Pre-Deploy Command, release в Procfile)
+    python migrations.py status
+        показать применённые и ожидающие миграции и размер текстов документов
+
+Готовность воркера к работе с этой схемой проверяет /ready.
+"""
+
+import time
+import argparse
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database_tickets import TicketDatabase, SCHEMA_MIGRATIONS, SCHEMA_VERSION, CONSENT_PARTITIONS_AHEAD
+
+
+def pending_migrations(applied_migrations: List[Dict]) -> List[Tuple[int, str]]:
+    """Миграции, которые ещё не применены: [(версия, имя), ...]"""
+    applied_versions = {migration['version'] for migration in applied_migrations}
+    return [
+        (version, name) for version, name, _ in SCHEMA_MIGRATIONS
+        if version not in applied_versions
+    ]
+
+
+def build_readiness_status(applied_migrations: List[Dict], boot_seconds: float) -> Tuple[Dict, int]:
+    """Ответ /ready по применённым миграциям: (тело, HTTP статус)"""
+    pending = pending_migrations(applied_migrations)
+    return {
+        'status': 'not_ready' if pending else 'ready',
+        'schema_version': max((m['version'] for m in applied_migrations), default=0),
+        'expected_schema_version': SCHEMA_VERSION,
+        'pending_migrations': [version for version, _ in pending],
+        'boot_seconds': round(boot_seconds, 3),
+    }, 503 if pending else 200
+
+
+def migrate(db: TicketDatabase, months_ahead: int):
+    started = time.perf_counter()
+    applied = db.migrate()
+    if applied:
+        print(f"✅ Применены миграции: {', '.join(str(version) for version in applied)}")
+    else:
+        print(f"✅ Схема актуальна (версия {SCHEMA_VERSION})")
+
+    created = db.ensure_consent_partitions(months_ahead)
+    print(f"✅ Создано партиций: {created}")
+
+    compacted = db.compact_document_blobs()
+    if compacted:
+        print(f"✅ Сжато текстов документов: {compacted}")
+    print(f"⏱️ {time.perf_counter() - started:.2f} с")
+
+
+def show_status(db: TicketDatabase):
+    applied_migrations = db.get_applied_migrations()
+    for migration in applied_migrations:
+        print(f"✅ {migration['version']:>4} {migration['name']:<32} "
+              f"{migration['applied_at']:%Y-%m-%d %H:%M} ({migration['duration_ms']} мс)")
+    for version, name in pending_migrations(applied_migrations):
+        print(f"⏳ {version:>4} {name:<32} не применена")
+
+    if any(migration['name'] == 'document_blobs' for migration in applied_migrations):
+        for row in db.get_document_blob_stats():
+            print(f"📄 {row['encoding']:<10} текстов: {row['blobs']:>5}, "
+                  f"{row['original_bytes'] / 1024:.1f} KB -> {row['stored_bytes'] / 1024:.1f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    commands = parser.add_subparsers(dest='command')
+
+    migrate_parser = commands.add_parser('migrate', help="применить новые миграции (по умолчанию)")
+    migrate_parser.add_argument('--months-ahead', type=int, default=CONSENT_PARTITIONS_AHEAD)
+
+    commands.add_parser('status', help="показать состояние миграций")
+
+    args = parser.parse_args()
+    db = TicketDatabase()
+
+    try:
+        if args.command == 'status':
+            show_status(db)
+        else:
+            migrate(db, getattr(args, 'months_ahead', CONSENT_PARTITIONS_AHEAD))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
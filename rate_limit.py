@@ -0,0 +1,202 @@
+"""
+Ограничение частоты запросов (token bucket)
+
+Публичные endpoints согласий открыты всему интернету, а каждый запрос
+берёт соединение из пула общей с ботом БД. Поэтому до любой работы
+с БД запрос проверяется по двум корзинам токенов:
+- по IP клиента (get_trusted_client_ip: адрес из X-Forwarded-For,
+  дописанный доверенным прокси, TRUSTED_PROXY_COUNT) - все публичные
+  endpoints согласий;
+- по session_id - каждое согласие тратит токен своей сессии.
+Пустая корзина - ответ 429 с Retry-After (через сколько секунд
+появится токен).
+
+Корзины хранятся:
+- SharedTokenBuckets - в общем для всех воркеров файле в памяти (mmap),
+  если задан RATE_LIMIT_SHARED_PATH (gunicorn.conf.py задаёт его сам):
+  лимит общий на все воркеры, как с Redis, но без отдельного сервиса;
+- MemoryTokenBuckets - в словаре процесса (локальный запуск): лимит
+  действует в каждом воркере отдельно.
+"""
+
+import os
+import math
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+
+# Запросов в минуту и размер корзины (сколько можно сразу) на IP, 0 - без лимита
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "120"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "60"))
+# Согласий в минуту и размер корзины на session_id, 0 - без лимита
+RATE_LIMIT_SESSION_PER_MINUTE = float(os.getenv("RATE_LIMIT_SESSION_PER_MINUTE", "30"))
+RATE_LIMIT_SESSION_BURST = float(os.getenv("RATE_LIMIT_SESSION_BURST", "20"))
+# Файл общих для воркеров корзин (без него - корзины в памяти процесса)
+RATE_LIMIT_SHARED_PATH = os.getenv("RATE_LIMIT_SHARED_PATH")
+# Число ячеек в общем файле (24 байта на ячейку)
+RATE_LIMIT_SHARED_SLOTS = int(os.getenv("RATE_LIMIT_SHARED_SLOTS", "65536"))
+# Максимум корзин в памяти процесса
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+def take_tokens(tokens: float, updated: float, now: float, cost: float,
+                rate: float, burst: float) -> Tuple[float, Optional[float]]:
+    """
+    Пополнить корзину на прошедшее время и взять cost токенов
+
+    Returns:
+        (токенов в корзине после запроса,
+         None если токены взяты, иначе секунд до появления нужных токенов)
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, None
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryTokenBuckets:
+    """Корзины в словаре процесса: ключ -> (токены, время обновления)"""
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, cost: float, rate: float, burst: float) -> Optional[float]:
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, retry_after = take_tokens(tokens, updated, now, cost, rate, burst)
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._evict(now)
+            self._buckets[key] = (tokens, now)
+            return retry_after
+
+    def _evict(self, now: float):
+        # Корзины, не тронутые больше минуты, при лимитах по умолчанию уже
+        # полные - они не отличаются от отсутствующих
+        full = [key for key, (_, updated) in self._buckets.items() if now - updated > 60]
+        for key in full:
+            del self._buckets[key]
+        if len(self._buckets) >= self.max_keys:
+            self._buckets.clear()
+
+
+class SharedTokenBuckets:
+    """
+    Корзины в общем файле (mmap) с фиксированным числом ячеек
+
+    Ячейка: 8 байт хеша ключа (0 - свободна), токены, время обновления.
+    Ключ ищется в PROBES ячейках подряд от своего хеша; если все
+    заняты другими ключами, вытесняется дольше всех не обновлявшаяся
+    (она скорее всего уже полная). Доступ - под fcntl.flock (между
+    процессами) и threading.Lock (между потоками одного процесса).
+    """
+
+    SLOT = struct.Struct('<Qdd')
+    PROBES = 8
+
+    def __init__(self, path: str, slots: int = RATE_LIMIT_SHARED_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+
+        size = slots * self.SLOT.size
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+
+    @staticmethod
+    def key_hash(key: str) -> int:
+        # hash() в каждом процессе свой, нужен одинаковый для всех воркеров
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def acquire(self, key: str, cost: float, rate: float, burst: float) -> Optional[float]:
+        key_hash = self.key_hash(key)
+        start = key_hash % self.slots
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                slot, tokens, updated = self._find_slot(key_hash, start)
+                if slot is None:
+                    slot, tokens, updated = self._evict_slot(start), burst, now
+                tokens, retry_after = take_tokens(tokens, updated, now, cost, rate, burst)
+                self.SLOT.pack_into(self._map, slot * self.SLOT.size, key_hash, tokens, now)
+                return retry_after
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find_slot(self, key_hash: int, start: int) -> Tuple[Optional[int], float, float]:
+        """Ячейка ключа (с токенами и временем) или None, если ключа нет"""
+        for probe in range(self.PROBES):
+            slot = (start + probe) % self.slots
+            slot_hash, tokens, updated = self.SLOT.unpack_from(self._map, slot * self.SLOT.size)
+            if slot_hash == key_hash:
+                return slot, tokens, updated
+        return None, 0.0, 0.0
+
+    def _evict_slot(self, start: int) -> int:
+        """Свободная ячейка или дольше всех не обновлявшаяся"""
+        oldest_slot, oldest_updated = start, math.inf
+        for probe in range(self.PROBES):
+            slot = (start + probe) % self.slots
+            slot_hash, _, updated = self.SLOT.unpack_from(self._map, slot * self.SLOT.size)
+            if slot_hash == 0:
+                return slot
+            if updated < oldest_updated:
+                oldest_slot, oldest_updated = slot, updated
+        return oldest_slot
+
+
+class RateLimiter:
+    """Лимиты на IP и на session_id поверх хранилища корзин"""
+
+    def __init__(self, buckets=None,
+                 ip_per_minute: float = RATE_LIMIT_IP_PER_MINUTE, ip_burst: float = RATE_LIMIT_IP_BURST,
+                 session_per_minute: float = RATE_LIMIT_SESSION_PER_MINUTE,
+                 session_burst: float = RATE_LIMIT_SESSION_BURST):
+        self.buckets = buckets or MemoryTokenBuckets()
+        self.ip_rate, self.ip_burst = ip_per_minute / 60, ip_burst
+        self.session_rate, self.session_burst = session_per_minute / 60, session_burst
+
+    def check_ip(self, ip_address: Optional[str]) -> Optional[float]:
+        """None, если запрос с этого IP разрешён, иначе Retry-After в секундах"""
+        if not self.ip_rate or not ip_address:
+            return None
+        return self.buckets.acquire(f"ip:{ip_address}", 1, self.ip_rate, self.ip_burst)
+
+    def check_sessions(self, consents_by_session: Dict[str, int]) -> Optional[float]:
+        """То же для согласий: {session_id: число согласий в запросе}"""
+        if not self.session_rate:
+            return None
+        retry_after = None
+        for session_id, count in consents_by_session.items():
+            session_retry = self.buckets.acquire(
+                f"session:{session_id}", count, self.session_rate, max(self.session_burst, count)
+            )
+            if session_retry is not None:
+                retry_after = max(retry_after or 0.0, session_retry)
+        return retry_after
+
+
+def create_rate_limiter() -> RateLimiter:
+    if RATE_LIMIT_SHARED_PATH:
+        return RateLimiter(SharedTokenBuckets(RATE_LIMIT_SHARED_PATH))
+    return RateLimiter(MemoryTokenBuckets())
+
+
+def retry_after_header(retry_after: float) -> str:
+    """Значение заголовка Retry-After (целые секунды, не меньше 1)"""
+    return str(max(1, math.ceil(retry_after)))
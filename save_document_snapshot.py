@@ -1,11 +1,48 @@
 """
-Вспомогательный скрипт для сохранения snapshots документов
-Используйте этот скрипт ПОСЛЕ развёртывания API на Render
+Загрузка snapshots документов в API (после развёртывания на Render)
+
+Документы берутся из каталога (файлы <document_type>_<language>.txt,
+например ticket_terms_ru.txt, refund_policy_he.md) или из манифеста
+JSON. Скрипт считает SHA-256 хеши текстов локально (параллельно),
+одним запросом GET /api/documents получает хеши активных версий на
+сервере и загружает только изменившиеся документы - параллельно,
+через общую HTTP сессию (соединения переиспользуются).
+
+Команды:
+    python save_document_snapshot.py [КАТАЛОГ] --version v2025-11-15
+        загрузить изменившиеся документы из каталога (по умолчанию текущего)
+    python save_document_snapshot.py --manifest documents.json
+        то же по манифесту
+    python save_document_snapshot.py ... --dry-run
+        только показать, что изменилось, ничего не загружая
+
+Манифест:
+    {
+        "version": "v2025-11-15",
+        "created_by": "admin",
+        "documents": [
+            {"document_type": "ticket_terms", "language": "ru", "file": "texts/terms_ru.txt"},
+            {"document_type": "refund_policy", "language": "he", "file": "texts/refund_he.txt",
+             "version": "v2025-12-01"}
+        ]
+    }
+Пути файлов - относительно манифеста; version и created_by документа
+заменяют общие.
+
+Нужны API_URL и ADMIN_API_KEY (в .env), для --dry-run - только API_URL.
 """
 
 import os
+import re
+import json
+import time
 import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,153 +50,244 @@ load_dotenv()
 # Конфигурация
 API_URL = os.getenv("API_URL", "http://localhost:5000")  # Замените на ваш URL
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+# Версия по умолчанию (как в .env сервиса)
+DOCUMENT_VERSION = os.getenv("DOCUMENT_VERSION")
+# Сколько документов загружать одновременно
+SNAPSHOT_UPLOAD_CONCURRENCY = int(os.getenv("SNAPSHOT_UPLOAD_CONCURRENCY", "4"))
+
+# Как в consent_common.py (скрипт запускается без зависимостей сервиса)
+ALLOWED_DOCUMENT_TYPES = ['ticket_terms', 'refund_policy', 'privacy_policy']
+ALLOWED_LANGUAGES = ['ru', 'en', 'he']
+
+DOCUMENT_FILE_RE = re.compile(
+    rf"^({'|'.join(ALLOWED_DOCUMENT_TYPES)})_({'|'.join(ALLOWED_LANGUAGES)})\.(txt|md|html)$"
+)
+
+STATUS_LABELS = {
+    'unchanged': '✔️ без изменений',
+    'new': '🆕 новый',
+    'changed': '✏️ изменён',
+    'uploaded': '✅ загружен',
+    'failed': '❌ ошибка',
+}
+
+
+def discover_directory(directory: str, version: Optional[str], created_by: str) -> List[Dict]:
+    """Документы каталога: файлы <document_type>_<language>.txt|md|html"""
+    documents = []
+    for name in sorted(os.listdir(directory)):
+        match = DOCUMENT_FILE_RE.match(name)
+        if match:
+            documents.append({
+                'document_type': match.group(1),
+                'language': match.group(2),
+                'file': os.path.join(directory, name),
+                'version': version,
+                'created_by': created_by,
+            })
+    return documents
+
 
-if not ADMIN_API_KEY:
-    print("❌ Ошибка: ADMIN_API_KEY не задан в .env файле")
-    exit(1)
-
-
-def save_snapshot(document_type, version, full_text, language="ru", created_by="admin"):
-    """
-    Сохранить snapshot документа
-    
-    Args:
-        document_type: ticket_terms | refund_policy | privacy_policy
-        version: версия документа (например, v2025-10-28)
-        full_text: полный текст документа
-        language: ru | en | he
-        created_by: кто создал snapshot
-    """
-    
-    # Вычисляем хеш
-    content_hash = hashlib.sha256(full_text.encode('utf-8')).hexdigest()
-    
-    print(f"\n📄 Сохранение snapshot документа:")
-    print(f"   Тип: {document_type}")
-    print(f"   Версия: {version}")
-    print(f"   Язык: {language}")
-    print(f"   Длина текста: {len(full_text)} символов")
-    print(f"   SHA-256 хеш: {content_hash}")
-    
-    data = {
-        "document_type": document_type,
-        "version": version,
-        "full_text": full_text,
-        "language": language,
-        "created_by": created_by
+def discover_manifest(manifest_path: str, version: Optional[str], created_by: str) -> List[Dict]:
+    """Документы из манифеста JSON (см. описание модуля)"""
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    documents = []
+    for entry in manifest['documents']:
+        documents.append({
+            'document_type': entry['document_type'],
+            'language': entry['language'],
+            'file': os.path.join(base_dir, entry['file']),
+            'version': entry.get('version') or manifest.get('version') or version,
+            'created_by': entry.get('created_by') or manifest.get('created_by') or created_by,
+        })
+    return documents
+
+
+def validate_documents(documents: List[Dict]) -> List[str]:
+    """Ошибки в списке документов (пусто, если всё в порядке)"""
+    errors = []
+    seen = set()
+    for doc in documents:
+        key = (doc['document_type'], doc['language'])
+        name = f"{doc['document_type']}/{doc['language']}"
+        if doc['document_type'] not in ALLOWED_DOCUMENT_TYPES:
+            errors.append(f"{name}: неизвестный тип документа")
+        if doc['language'] not in ALLOWED_LANGUAGES:
+            errors.append(f"{name}: неизвестный язык")
+        if not doc['version']:
+            errors.append(f"{name}: не указана версия (--version или version в манифесте)")
+        if key in seen:
+            errors.append(f"{name}: указан дважды")
+        seen.add(key)
+    return errors
+
+
+def hash_document(doc: Dict) -> Dict:
+    """Прочитать текст документа и посчитать его SHA-256 хеш (как на сервере)"""
+    try:
+        with open(doc['file'], 'r', encoding='utf-8') as f:
+            full_text = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return {**doc, 'status': 'failed', 'message': f"не прочитан: {e}"}
+
+    if not full_text.strip():
+        return {**doc, 'status': 'failed', 'message': "пустой файл"}
+
+    return {
+        **doc,
+        'full_text': full_text,
+        'size': len(full_text),
+        'content_hash': hashlib.sha256(full_text.encode('utf-8')).hexdigest(),
     }
-    
-    headers = {
-        "Content-Type": "application/json",
-        "X-API-Key": ADMIN_API_KEY
+
+
+def create_session(concurrency: int) -> requests.Session:
+    """HTTP сессия с пулом соединений на concurrency потоков"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if ADMIN_API_KEY:
+        session.headers['X-API-Key'] = ADMIN_API_KEY
+    return session
+
+
+def fetch_active_hashes(session: requests.Session) -> Dict:
+    """Хеши активных версий на сервере: {(document_type, language): документ}"""
+    response = session.get(f"{API_URL}/api/documents", timeout=30)
+    response.raise_for_status()
+    return {
+        (doc['document_type'], doc['language']): doc
+        for doc in response.json()['documents']
     }
-    
+
+
+def compare_with_server(doc: Dict, active_documents: Dict) -> Dict:
+    """Отметить документ: new / changed / unchanged"""
+    if doc.get('status') == 'failed':
+        return doc
+    active = active_documents.get((doc['document_type'], doc['language']))
+    if active is None:
+        status = 'new'
+    elif active['content_hash'] == doc['content_hash']:
+        status = 'unchanged'
+    else:
+        status = 'changed'
+    return {**doc, 'status': status, 'active_version': active['version'] if active else None}
+
+
+def upload_document(session: requests.Session, doc: Dict) -> Dict:
+    """Сохранить snapshot документа (POST /api/document-snapshot)"""
+    started = time.perf_counter()
     try:
-        response = requests.post(
-            f"{API_URL}/api/document-snapshot",
-            json=data,
-            headers=headers,
-            timeout=30
+        response = session.post(f"{API_URL}/api/document-snapshot", json={
+            'document_type': doc['document_type'],
+            'version': doc['version'],
+            'full_text': doc['full_text'],
+            'language': doc['language'],
+            'created_by': doc['created_by'],
+        }, timeout=60)
+    except requests.RequestException as e:
+        return {**doc, 'status': 'failed', 'message': f"ошибка запроса: {e}"}
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if response.status_code != 201:
+        return {**doc, 'status': 'failed', 'message': f"HTTP {response.status_code}: {response.text[:200]}"}
+
+    result = response.json()
+    if result['content_hash'] != doc['content_hash']:
+        return {**doc, 'status': 'failed', 'message': f"сервер посчитал другой хеш: {result['content_hash']}"}
+    return {**doc, 'status': 'uploaded', 'message': f"{result['snapshot_id']} ({elapsed_ms:.0f} мс)"}
+
+
+def print_report(results: List[Dict], dry_run: bool):
+    """Итоговая таблица и счётчики по статусам"""
+    print(f"\n{'=' * 100}")
+    for doc in sorted(results, key=lambda d: (d['document_type'], d['language'])):
+        line = (
+            f"{doc['document_type'] + '/' + doc['language']:<20} "
+            f"{doc['version'] or '-':<16} "
+            f"{STATUS_LABELS[doc['status']]:<18} "
+            f"{doc.get('content_hash', '')[:12]:<13}"
         )
-        
-        if response.status_code == 201:
-            result = response.json()
-            print(f"✅ Snapshot сохранён успешно!")
-            print(f"   ID: {result['snapshot_id']}")
-            return True
-        else:
-            print(f"❌ Ошибка: {response.status_code}")
-            print(f"   {response.text}")
-            return False
-    
-    except Exception as e:
-        print(f"❌ Ошибка при отправке запроса: {e}")
-        return False
-
-
-def load_document_from_file(file_path):
-    """Загрузить текст документа из файла"""
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"❌ Файл не найден: {file_path}")
-        return None
+        if doc.get('size') is not None:
+            line += f"{doc['size']:>9} симв."
+        if doc.get('active_version') and doc['status'] != 'unchanged':
+            line += f"  (на сервере {doc['active_version']})"
+        if doc.get('message'):
+            line += f"  {doc['message']}"
+        print(line)
+    print('=' * 100)
+
+    counts = {}
+    for doc in results:
+        counts[doc['status']] = counts.get(doc['status'], 0) + 1
+    summary = ", ".join(f"{STATUS_LABELS[status]}: {count}" for status, count in sorted(counts.items()))
+    print(f"{'🔍 Проверка (--dry-run)' if dry_run else '📦 Итог'}: {summary}")
 
 
 def main():
-    """
-    Пример использования:
-    
-    1. Сохраните тексты документов в файлы:
-       - ticket_terms_ru.txt
-       - refund_policy_ru.txt
-       - privacy_policy_ru.txt
-    
-    2. Запустите этот скрипт:
-       python save_document_snapshot.py
-    """
-    
-    print("=" * 60)
-    print("📦 Сохранение snapshots документов")
-    print("=" * 60)
-    
-    # Проверяем подключение
-    try:
-        response = requests.get(f"{API_URL}/health", timeout=10)
-        if response.status_code == 200:
-            print(f"✅ API доступен: {API_URL}")
-        else:
-            print(f"⚠️ API вернул код: {response.status_code}")
-            return
-    except Exception as e:
-        print(f"❌ API недоступен: {e}")
-        print(f"   Проверьте URL: {API_URL}")
-        return
-    
-    # Текущая версия документов
-    version = "v2025-10-28"  # Измените на актуальную версию!
-    
-    # Сохраняем snapshots
-    documents = [
-        {
-            "type": "ticket_terms",
-            "file": "ticket_terms_ru.txt",
-            "name": "Условия продажи билетов"
-        },
-        {
-            "type": "refund_policy",
-            "file": "refund_policy_ru.txt",
-            "name": "Политика возврата"
-        },
-        {
-            "type": "privacy_policy",
-            "file": "privacy_policy_ru.txt",
-            "name": "Политика конфиденциальности"
-        }
-    ]
-    
-    success_count = 0
-    
-    for doc in documents:
-        print(f"\n{'='*60}")
-        print(f"Обработка: {doc['name']}")
-        print(f"{'='*60}")
-        
-        # Загружаем текст из файла
-        text = load_document_from_file(doc['file'])
-        
-        if text:
-            if save_snapshot(doc['type'], version, text, language="ru"):
-                success_count += 1
-        else:
-            print(f"⏭️ Пропускаем {doc['name']}")
-    
-    print(f"\n{'='*60}")
-    print(f"✅ Сохранено snapshots: {success_count} из {len(documents)}")
-    print(f"{'='*60}")
+    parser = argparse.ArgumentParser(description="Загрузка snapshots документов в API")
+    parser.add_argument('directory', nargs='?', default='.',
+                        help="каталог с файлами <document_type>_<language>.txt (по умолчанию текущий)")
+    parser.add_argument('--manifest', help="манифест JSON вместо каталога")
+    parser.add_argument('--version', default=DOCUMENT_VERSION,
+                        help="версия документов (по умолчанию DOCUMENT_VERSION из .env)")
+    parser.add_argument('--created-by', default='admin')
+    parser.add_argument('--concurrency', type=int, default=SNAPSHOT_UPLOAD_CONCURRENCY,
+                        help="сколько документов загружать одновременно")
+    parser.add_argument('--dry-run', action='store_true', help="только показать изменения")
+    args = parser.parse_args()
+
+    if not args.dry_run and not ADMIN_API_KEY:
+        print("❌ Ошибка: ADMIN_API_KEY не задан в .env файле")
+        exit(1)
+
+    if args.manifest:
+        documents = discover_manifest(args.manifest, args.version, args.created_by)
+    else:
+        documents = discover_directory(args.directory, args.version, args.created_by)
+    if not documents:
+        print(f"❌ Документы не найдены: {args.manifest or args.directory}")
+        exit(1)
+
+    errors = validate_documents(documents)
+    if errors:
+        for error in errors:
+            print(f"❌ {error}")
+        exit(1)
+
+    concurrency = max(1, args.concurrency)
+    print(f"📄 Документов: {len(documents)}, API: {API_URL}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, create_session(concurrency) as session:
+        # Хеши считаются, пока идёт запрос активных версий
+        active_future = executor.submit(fetch_active_hashes, session)
+        hashed = list(executor.map(hash_document, documents))
+        try:
+            active_documents = active_future.result()
+        except requests.RequestException as e:
+            print(f"❌ API недоступен: {e}")
+            print(f"   Проверьте URL: {API_URL}")
+            exit(1)
+
+        results = [compare_with_server(doc, active_documents) for doc in hashed]
+        to_upload = [doc for doc in results if doc['status'] in ('new', 'changed')]
+        if not args.dry_run and to_upload:
+            print(f"⬆️ Загрузка {len(to_upload)} документов ({concurrency} одновременно)...")
+            uploaded = {
+                (doc['document_type'], doc['language']): doc
+                for doc in executor.map(lambda doc: upload_document(session, doc), to_upload)
+            }
+            results = [uploaded.get((doc['document_type'], doc['language']), doc) for doc in results]
+
+    print_report(results, args.dry_run)
+    if any(doc['status'] == 'failed' for doc in results):
+        exit(1)
 
 
 if __name__ == "__main__":
     main()
-
@@ -69,6 +69,22 @@
   // URL вашего API на Render
   const API_URL = 'https://ticket-consent-api.onrender.com/api/consent';
   
+  // Пакетный режим: согласия копятся и отправляются одним запросом
+  // на /api/consent/batch (вместо отдельного запроса на каждую кнопку)
+  const BATCH_MODE = true;
+  const BATCH_API_URL = API_URL + '/batch';
+  // Сколько мс ждать следующих согласий перед отправкой пакета
+  const BATCH_DELAY_MS = 1500;
+  // Максимум согласий в одном пакете (CONSENT_BATCH_MAX_SIZE на сервере)
+  const BATCH_MAX_SIZE = 20;
+  // Повтор при ошибке: задержка удваивается от RETRY_BASE_MS до RETRY_MAX_MS
+  const RETRY_BASE_MS = 2000;
+  const RETRY_MAX_MS = 60000;
+  // Неотправленные согласия хранятся в localStorage (переживают переход
+  // на оплату и перезагрузку) и отбрасываются через QUEUE_MAX_AGE_MS
+  const QUEUE_STORAGE_KEY = 'ticket_consent_queue';
+  const QUEUE_MAX_AGE_MS = 7 * 24 * 60 * 60 * 1000;
+  
   // Версии документов (обновляйте при изменении текстов)
   const DOCUMENT_VERSIONS = {
     'ticket_terms': 'v2025-10-28',      // Условия продажи билетов
@@ -76,6 +92,9 @@
     'privacy_policy': 'v2025-10-28'     // Политика конфиденциальности
   };
   
+  // Язык документов на странице (ru | en | he)
+  const DOCUMENT_LANGUAGE = 'ru';
+  
   // ========================================
   // ОРИГИНАЛЬНЫЙ КОД (НЕ МЕНЯЕМ)
   // ========================================
@@ -146,7 +165,191 @@
     }
   }
   
-  // Функция отправки согласия на сервер
+  // Функция отправки одного согласия на сервер
+  async function sendConsent(data) {
+    console.log('📤 Sending consent log:', data.document_type);
+    
+    const response = await fetch(API_URL, {
+      method: 'POST',
+      headers: { 
+        'Content-Type': 'application/json'
+      },
+      body: JSON.stringify(data)
+    });
+    
+    if (response.ok) {
+      const result = await response.json();
+      console.log('✅ Consent logged successfully:', result.consent_log_id);
+      return true;
+    } else {
+      console.warn('⚠️ Failed to log consent:', response.status);
+      return false;
+    }
+  }
+  
+  // ========================================
+  // ОЧЕРЕДЬ СОГЛАСИЙ (localStorage)
+  // ========================================
+  // Согласие удаляется из очереди, только когда сервер ответил на него
+  // (сохранено, повтор или отклонено). Повторная отправка безопасна:
+  // сервер узнаёт то же согласие по session_id, document_type,
+  // document_hash и consent_timestamp и не сохраняет его второй раз.
+  
+  let memoryQueue = [];       // очередь, если localStorage недоступен
+  let flushTimer = null;
+  let flushing = false;
+  let retryAttempt = 0;       // число неудачных отправок подряд
+  const beaconSent = new Set(); // согласия, уже отправленные через sendBeacon
+  
+  function consentKey(consent) {
+    return consent.session_id + '|' + consent.document_type + '|' + consent.consent_timestamp;
+  }
+  
+  // Функция чтения очереди (заново из localStorage - её могла изменить другая вкладка)
+  function readQueue() {
+    try {
+      const stored = JSON.parse(localStorage.getItem(QUEUE_STORAGE_KEY) || '[]');
+      if (Array.isArray(stored)) memoryQueue = stored;
+    } catch (e) {
+      // Приватный режим или запрет cookies - очередь только в памяти страницы
+    }
+    const minTime = Date.now() - QUEUE_MAX_AGE_MS;
+    memoryQueue = memoryQueue.filter(c => Date.parse(c.consent_timestamp) > minTime);
+    return memoryQueue;
+  }
+  
+  function writeQueue(queue) {
+    memoryQueue = queue;
+    try {
+      if (queue.length) localStorage.setItem(QUEUE_STORAGE_KEY, JSON.stringify(queue));
+      else localStorage.removeItem(QUEUE_STORAGE_KEY);
+    } catch (e) {
+      console.warn('Could not save consent queue to localStorage:', e);
+    }
+  }
+  
+  function removeFromQueue(consents) {
+    const keys = new Set(consents.map(consentKey));
+    writeQueue(readQueue().filter(c => !keys.has(consentKey(c))));
+  }
+  
+  function scheduleFlush(delay) {
+    clearTimeout(flushTimer);
+    flushTimer = setTimeout(flushConsents, delay);
+  }
+  
+  // Задержка повтора: экспоненциальная со случайным разбросом (jitter),
+  // чтобы браузеры, получившие ошибку одновременно, не повторяли разом;
+  // не меньше Retry-After из ответа сервера
+  function retryDelay(retryAfterSeconds) {
+    const backoff = Math.min(RETRY_MAX_MS, RETRY_BASE_MS * Math.pow(2, retryAttempt));
+    retryAttempt += 1;
+    const delay = backoff / 2 + Math.random() * backoff / 2;
+    return Math.max(delay, (retryAfterSeconds || 0) * 1000);
+  }
+  
+  // Функция отправки накопленных согласий одним запросом
+  async function flushConsents() {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+    // Следующий пакет отправит текущая отправка, когда закончится
+    if (flushing) return false;
+    
+    const batch = readQueue().slice(0, BATCH_MAX_SIZE);
+    if (batch.length === 0) return true;
+    
+    flushing = true;
+    let delivered = false;
+    let retryAfter = null;
+    try {
+      console.log('📤 Sending consent batch:', batch.map(c => c.document_type));
+      
+      const response = await fetch(BATCH_API_URL, {
+        method: 'POST',
+        headers: { 
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ consents: batch }),
+        // Запрос завершится, даже если пользователь уже ушёл со страницы
+        keepalive: true
+      });
+      
+      if (response.status === 429 || response.status >= 500) {
+        // Лимит запросов или сервер недоступен - повторим позже
+        console.warn('⚠️ Failed to log consent batch, will retry:', response.status);
+        retryAfter = parseFloat(response.headers.get('Retry-After'));
+      } else {
+        const result = await response.json().catch(() => ({}));
+        (result.results || []).forEach(item => {
+          if (item.consent_log_id) {
+            console.log('✅ Consent logged successfully:', item.consent_log_id);
+          } else {
+            console.warn('⚠️ Consent rejected:', batch[item.index].document_type, item.error);
+          }
+        });
+        if (!result.results) {
+          console.warn('⚠️ Consent batch rejected:', response.status, result.error);
+        }
+        // Отклонённые сервером согласия повтор не исправит
+        removeFromQueue(batch);
+        delivered = true;
+      }
+    } catch (error) {
+      console.error('❌ Error logging consent batch, will retry:', error);
+      // НЕ блокируем пользователя, если сервер недоступен
+    } finally {
+      flushing = false;
+    }
+    
+    if (delivered) {
+      retryAttempt = 0;
+      // Согласия, добавленные во время отправки, или остаток большой очереди
+      if (readQueue().length) scheduleFlush(0);
+    } else {
+      scheduleFlush(retryDelay(retryAfter));
+    }
+    return delivered;
+  }
+  
+  // Функция постановки согласия в очередь пакетной отправки
+  function enqueueConsent(data) {
+    writeQueue(readQueue().concat([data]));
+    // Во время паузы перед повтором новое согласие уйдёт вместе с повтором
+    if (!retryAttempt) scheduleFlush(BATCH_DELAY_MS);
+  }
+  
+  // Страница закрывается или уходит в фон (переход на оплату, сворачивание
+  // браузера на телефоне): таймер может уже не сработать, а sendBeacon
+  // браузер доставит сам. Тело отправляется как text/plain - такой запрос
+  // обходится без CORS preflight, сервер разбирает его как JSON.
+  // Доставку sendBeacon не подтверждает, поэтому согласия остаются в
+  // очереди до ответа на обычную отправку (в том числе на следующей странице).
+  function sendQueueBeacon() {
+    if (!navigator.sendBeacon) return;
+    const pending = readQueue().filter(c => !beaconSent.has(consentKey(c)));
+    for (let i = 0; i < pending.length; i += BATCH_MAX_SIZE) {
+      const batch = pending.slice(i, i + BATCH_MAX_SIZE);
+      const body = new Blob([JSON.stringify({ consents: batch })], { type: 'text/plain' });
+      if (!navigator.sendBeacon(BATCH_API_URL, body)) break;
+      batch.forEach(c => beaconSent.add(consentKey(c)));
+      console.log('📨 Consent batch sent with sendBeacon:', batch.map(c => c.document_type));
+    }
+  }
+  
+  if (BATCH_MODE) {
+    document.addEventListener('visibilitychange', function () {
+      if (document.visibilityState === 'hidden') sendQueueBeacon();
+    });
+    window.addEventListener('pagehide', sendQueueBeacon);
+    
+    // Согласия, не отправленные на прошлой странице или в прошлый визит
+    if (readQueue().length) {
+      console.log('📦 Pending consents from previous page:', memoryQueue.length);
+      scheduleFlush(0);
+    }
+  }
+  
+  // Функция логирования согласия
   async function logConsent(documentType, documentText) {
     try {
       const hash = await sha256(documentText);
@@ -156,6 +359,7 @@
         document_type: documentType,
         document_version: DOCUMENT_VERSIONS[documentType] || 'v2025-10-28',
         document_hash: hash,
+        language: DOCUMENT_LANGUAGE,
         consent_given: true,
         consent_timestamp: new Date().toISOString(),
         user_agent: navigator.userAgent,
@@ -164,24 +368,12 @@
         consent_text: `Пользователь согласился с ${documentType}`
       };
       
-      console.log('📤 Sending consent log:', documentType);
-      
-      const response = await fetch(API_URL, {
-        method: 'POST',
-        headers: { 
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(data)
-      });
-      
-      if (response.ok) {
-        const result = await response.json();
-        console.log('✅ Consent logged successfully:', result.consent_log_id);
+      if (BATCH_MODE) {
+        enqueueConsent(data);
         return true;
-      } else {
-        console.warn('⚠️ Failed to log consent:', response.status);
-        return false;
       }
+      
+      return await sendConsent(data);
     } catch (error) {
       console.error('❌ Error logging consent:', error);
       // НЕ блокируем пользователя, если сервер недоступен
@@ -247,6 +439,11 @@
     if (disclaimerBtn) { e.preventDefault(); onAccept('disclaimer', disclaimerBtn); return; }
 
     const goBtn = e.target.closest('.' + CLS_GO_NEXT);
+    if (goBtn && BATCH_MODE) {
+      // Пользователь уходит дальше - отправляем накопленные согласия сразу
+      // (не дошедшие останутся в очереди и уйдут через sendBeacon или на следующей странице)
+      flushConsents();
+    }
     if (goBtn && !(acceptedTerms && acceptedPrivacy && acceptedDisclaimer)) {
       e.preventDefault();
       let msgs = [];
@@ -0,0 +1,243 @@
+"""
+Классификация user agent и справочник user_agents
+
+Полная строка User-Agent - самая длинная колонка consent_logs, при этом
+в потоке согласий повторяются одни и те же несколько сотен строк. Поэтому
+при вставке согласия строка сохраняется один раз в таблице user_agents
+(вместе с семейством браузера, ОС и типом устройства), а в consent_logs
+пишется только её ID (user_agent_id, BIGINT):
+- ID - первые 8 байт SHA-256 строки (знаковое целое), его считает само
+  приложение, без обращения к БД;
+- классификация - упорядоченные регулярные выражения, скомпилированные
+  при импорте (первое совпадение побеждает); результат кешируется в LRU
+  кеше по строке (USER_AGENT_CACHE_SIZE), попадания и промахи - в метрике
+  consent_api_user_agent_cache_total и в /api/admin/pool-stats;
+- выгрузки, журнал целостности и аналитика получают строку обратно
+  через LEFT JOIN user_agents, хеш записи (record_hash) от переноса
+  строки в справочник не меняется.
+
+Команды:
+    python user_agents.py parse "Mozilla/5.0 ..."
+        показать ID и классификацию строки
+    python user_agents.py backfill [--batch-size 5000]
+        перенести строки user agent старых записей consent_logs в справочник
+    python user_agents.py reclassify
+        пересчитать семейства в user_agents после изменения правил
+"""
+
+import os
+import re
+import time
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from metrics import record_user_agent_cache
+
+# Сколько разных строк user agent помнит каждый воркер
+USER_AGENT_CACHE_SIZE = int(os.getenv("USER_AGENT_CACHE_SIZE", "4096"))
+# Записей за один проход backfill
+USER_AGENT_BACKFILL_BATCH_SIZE = int(os.getenv("USER_AGENT_BACKFILL_BATCH_SIZE", "5000"))
+
+OTHER = 'Other'
+
+# (семейство, выражение): проверяются по порядку, первое совпадение побеждает.
+# Порядок важен: Edge, Opera, Яндекс и Samsung содержат "Chrome/",
+# а почти все браузеры - "Safari/"
+BROWSER_RULES = [
+    ('Bot', r'(?i:bot\b|crawl|spider|slurp|curl/|wget/|python-requests)|HeadlessChrome|Lighthouse'),
+    ('Instagram', r'Instagram'),
+    ('Facebook', r'FBAN|FBAV|FB_IAB'),
+    ('Telegram', r'Telegram'),
+    ('WhatsApp', r'WhatsApp'),
+    ('Edge', r'Edg(e|A|iOS)?/'),
+    ('Opera', r'OPR/|OPiOS/|Opera'),
+    ('Yandex Browser', r'YaBrowser/|YaSearchBrowser/'),
+    ('Samsung Internet', r'SamsungBrowser/'),
+    ('Firefox', r'Firefox/|FxiOS/'),
+    ('Chrome', r'Chrome/|CriOS/'),
+    ('Safari', r'Version/[\d.]+.*Safari/'),
+    ('WebView', r'; wv\)|AppleWebKit/'),
+]
+
+OS_RULES = [
+    ('iOS', r'iPhone|iPad|iPod'),
+    ('Android', r'Android'),
+    ('Windows', r'Windows'),
+    ('ChromeOS', r'CrOS'),
+    ('macOS', r'Macintosh|Mac OS X'),
+    ('Linux', r'Linux|X11'),
+]
+
+DEVICE_RULES = [
+    ('tablet', r'iPad|Tablet|^(?!.*Mobile).*Android'),
+    ('mobile', r'Mobi|iPhone|iPod|Android'),
+]
+
+BROWSER_PATTERNS = [(name, re.compile(pattern)) for name, pattern in BROWSER_RULES]
+OS_PATTERNS = [(name, re.compile(pattern)) for name, pattern in OS_RULES]
+DEVICE_PATTERNS = [(name, re.compile(pattern)) for name, pattern in DEVICE_RULES]
+
+
+def user_agent_id(user_agent: Optional[str]) -> Optional[int]:
+    """ID строки в user_agents: первые 8 байт SHA-256 (None для пустой строки)"""
+    if not user_agent:
+        return None
+    return int.from_bytes(hashlib.sha256(user_agent.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+def _first_match(patterns: List[Tuple], user_agent: str) -> Optional[str]:
+    for name, pattern in patterns:
+        if pattern.search(user_agent):
+            return name
+    return None
+
+
+def parse_user_agent(user_agent: str) -> Dict:
+    """Семейства браузера, ОС и устройства по правилам (без кеша)"""
+    browser = _first_match(BROWSER_PATTERNS, user_agent) or OTHER
+    if browser == 'Bot':
+        device = 'bot'
+    else:
+        device = _first_match(DEVICE_PATTERNS, user_agent) or 'desktop'
+    return {
+        'browser': browser,
+        'os': _first_match(OS_PATTERNS, user_agent) or OTHER,
+        'device': device,
+    }
+
+
+class UserAgentClassifier:
+    """Классификация строк user agent с LRU кешем"""
+
+    def __init__(self, cache_size: int = USER_AGENT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def classify(self, user_agent: Optional[str]) -> Optional[Dict]:
+        """
+        Классификация строки
+
+        Returns:
+            {'user_agent_id', 'user_agent', 'browser', 'os', 'device'}
+            или None для пустой строки
+        """
+        if not user_agent:
+            return None
+
+        with self._lock:
+            info = self._cache.get(user_agent)
+            if info is not None:
+                self._cache.move_to_end(user_agent)
+                self.hits += 1
+        if info is not None:
+            record_user_agent_cache('hit')
+            return info
+
+        info = {'user_agent_id': user_agent_id(user_agent), 'user_agent': user_agent, **parse_user_agent(user_agent)}
+        with self._lock:
+            self.misses += 1
+            self._cache[user_agent] = info
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        record_user_agent_cache('miss')
+        return info
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'max_size': self.cache_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+classifier = UserAgentClassifier()
+
+
+def classify_user_agent(user_agent: Optional[str]) -> Optional[Dict]:
+    """Классификация строки общим кешем воркера"""
+    return classifier.classify(user_agent)
+
+
+def backfill(db, batch_size: int):
+    """Перенести строки user agent записей, сохранённых до справочника"""
+    started = time.perf_counter()
+    after = None
+    scanned = 0
+
+    while True:
+        rows = db.get_consents_with_user_agent(after, batch_size)
+        if not rows:
+            break
+        after = (rows[-1]['consent_timestamp'], rows[-1]['consent_log_id'])
+
+        db.set_consent_user_agents(rows)
+        scanned += len(rows)
+        print(f"   {scanned} записей перенесено (до {after[0]:%Y-%m-%d %H:%M})")
+
+    print(f"✅ Строки user agent перенесены у {scanned} записей "
+          f"за {time.perf_counter() - started:.1f} с")
+
+
+def reclassify(db):
+    """Пересчитать семейства всех строк справочника по текущим правилам"""
+    rows = db.get_user_agents()
+    changed = []
+    for row in rows:
+        parsed = parse_user_agent(row['user_agent'])
+        if (row['browser'], row['os'], row['device']) != (parsed['browser'], parsed['os'], parsed['device']):
+            changed.append((row['user_agent_id'], parsed['browser'], parsed['os'], parsed['device']))
+    if changed:
+        db.update_user_agent_families(changed)
+    print(f"✅ Строк в user_agents: {len(rows)}, изменено: {len(changed)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Справочник user agent для consent_logs")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parse_parser = commands.add_parser('parse', help="показать классификацию строки")
+    parse_parser.add_argument('user_agent')
+
+    backfill_parser = commands.add_parser('backfill', help="перенести строки старых записей в справочник")
+    backfill_parser.add_argument('--batch-size', type=int, default=USER_AGENT_BACKFILL_BATCH_SIZE)
+
+    commands.add_parser('reclassify', help="пересчитать семейства после изменения правил")
+
+    args = parser.parse_args()
+
+    if args.command == 'parse':
+        info = classify_user_agent(args.user_agent)
+        print(f"ID:         {info['user_agent_id']}")
+        print(f"Браузер:    {info['browser']}")
+        print(f"ОС:         {info['os']}")
+        print(f"Устройство: {info['device']}")
+        return
+
+    # database_tickets сам импортирует этот модуль (классификация при вставке)
+    from database_tickets import TicketDatabase
+
+    db = TicketDatabase()
+    try:
+        if args.command == 'backfill':
+            backfill(db, args.batch_size)
+        else:
+            reclassify(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()